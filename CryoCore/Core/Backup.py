@@ -0,0 +1,325 @@
+"""
+Native, parallel and incremental database dumps.
+
+Each table is written as gzip compressed JSON lines, compressed while
+the rows are streamed from the database:
+  <destination>/manifest.json
+  <destination>/schema/<table>.sql               CREATE TABLE statement
+  <destination>/<table>.<first id>-<last id>.json.gz   (append only tables)
+  <destination>/<table>.full.<run>.json.gz             (other tables)
+The first line of a data file is {"table": ..., "columns": [...]}, then
+one JSON list per row.
+
+Append only tables (status, log, ...) are exported by id up to the high
+water mark: the max id found when the dump started, after waiting
+settle_time seconds so rows with lower ids that were still being
+committed are included. The marks are kept in the manifest, so the next
+dump only exports new rows. If the max id is
+below the mark, the table was truncated and the ids start over: the
+table is dumped from the start again as a new "epoch" (files are named
+<table>.reset<epoch>.<first id>-<last id>.json.gz). Large id ranges
+are split in batches that are exported in parallel. Other tables are
+small and may change, they are exported completely in a consistent
+snapshot transaction each time.
+
+Files are written to temporary names and renamed, and the manifest is
+only updated when all files of a dump are done, so an interrupted dump
+is simply done again.
+
+restore() loads the tables in parallel with batched inserts: append
+files of the latest epoch (and since the latest full dump) are loaded
+once each with INSERT IGNORE, for the other tables only the latest
+snapshot is loaded with REPLACE.
+"""
+import base64
+import gzip
+import json
+import os
+import os.path
+import threading
+import time
+
+from CryoCore.Core import API
+
+MANIFEST = "manifest.json"
+
+# Tables where rows are only ever added
+APPEND_ONLY = ["status", "status2d", "log", "sample"]
+
+
+def encode_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {"$b": base64.b64encode(bytes(value)).decode("ascii")}
+    if isinstance(value, (int, float, str)) or value is None:
+        return value
+    return str(value)  # Decimal, dates
+
+
+def decode_value(value):
+    if isinstance(value, dict) and "$b" in value:
+        return base64.b64decode(value["$b"])
+    return value
+
+
+class DatabaseDumper:
+    """
+    Dump and restore the tables of an InternalDB.mysql database
+    """
+
+    def __init__(self, db, destination, num_workers=4, batch_size=1000000, insert_size=1000,
+                 append_only=None, stop_event=None, compresslevel=6, settle_time=2.0):
+        self.db = db
+        self.destination = destination
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.insert_size = insert_size
+        self.compresslevel = compresslevel
+        self.settle_time = settle_time
+        self.append_only = append_only if append_only is not None else APPEND_ONLY
+        self.stop_event = stop_event or API.api_stop_event
+        self.log = API.get_log("DatabaseDumper")
+
+    def get_manifest(self):
+        filename = os.path.join(self.destination, MANIFEST)
+        if not os.path.exists(filename):
+            return {"high_water": {}, "epoch": {}, "runs": []}
+        with open(filename, "r") as f:
+            manifest = json.loads(f.read())
+        manifest.setdefault("epoch", {})
+        return manifest
+
+    def _save_manifest(self, manifest):
+        filename = os.path.join(self.destination, MANIFEST)
+        with open(filename + ".tmp", "w") as f:
+            f.write(json.dumps(manifest, indent=1))
+        os.rename(filename + ".tmp", filename)
+
+    def _run_parallel(self, jobs, func):
+        """
+        Run func(job) for all jobs in worker threads, returns the results
+        in order. Raises an exception if any job failed.
+        """
+        pending = list(enumerate(jobs))
+        results = [None] * len(jobs)
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            while not self.stop_event.is_set():
+                with lock:
+                    if len(pending) == 0 or errors:
+                        return
+                    index, job = pending.pop(0)
+                try:
+                    results[index] = func(job)
+                except Exception as e:
+                    self.log.exception("Failed on %s" % str(job))
+                    errors.append(e)
+                    return
+
+        threads = []
+        for i in range(min(self.num_workers, len(jobs))):
+            t = threading.Thread(target=worker)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if errors:
+            raise Exception("Failed: %s" % errors[0])
+        if None in results and len(pending) > 0:
+            raise Exception("Stopped")
+        return results
+
+    def _get_tables(self):
+        return [row[0] for row in self.db._execute("SHOW TABLES").fetchall()]
+
+    def dump(self, tables=None, full=False):
+        """
+        Dump the given tables (default all). Unless full is True, append
+        only tables are only exported from where the last dump stopped.
+        Returns the number of rows written.
+        """
+        if not os.path.isdir(os.path.join(self.destination, "schema")):
+            os.makedirs(os.path.join(self.destination, "schema"))
+        manifest = self.get_manifest()
+        if full:
+            manifest["high_water"] = {}
+        if tables is None:
+            tables = self._get_tables()
+        run = len(manifest["runs"])
+
+        # Rows with lower ids may still be committed after we read the max
+        # id, so wait a bit before using it as the mark
+        marks = {}
+        t = time.time()
+        for table in tables:
+            if table in self.append_only:
+                marks[table] = self.db._execute("SELECT MAX(id) FROM `%s`" % table).fetchone()[0] or 0
+        if marks:
+            self.stop_event.wait(max(0, self.settle_time - (time.time() - t)))
+
+        jobs = []
+        high_water = {}
+        epochs = {}
+        for table in tables:
+            row = self.db._execute("SHOW CREATE TABLE `%s`" % table).fetchone()
+            with open(os.path.join(self.destination, "schema", table + ".sql"), "w") as f:
+                f.write(row[1])
+            if table in self.append_only:
+                first = manifest["high_water"].get(table, 0)
+                epoch = manifest["epoch"].get(table, 0)
+                last = marks[table]
+                if last < first:
+                    epoch += 1
+                    self.log.warning("Max id of %s (%d) is below the last dump (%d), it was truncated. "
+                                     "Dumping it from the start (epoch %d)" % (table, last, first, epoch))
+                    first = 0
+                    epochs[table] = epoch
+                high_water[table] = last
+                for start in range(first, last, self.batch_size):
+                    jobs.append((table, start, min(start + self.batch_size, last), epoch))
+            else:
+                jobs.append((table, None, run, None))
+
+        t = time.time()
+        results = self._run_parallel(jobs, self._dump_job)
+        files = [r[0] for r in results]
+        rows = sum([r[1] for r in results])
+        manifest["high_water"].update(high_water)
+        manifest["epoch"].update(epochs)
+        manifest["runs"].append({"time": time.time(), "full": full, "files": files})
+        self._save_manifest(manifest)
+        self.log.info("Dumped %d rows in %d files in %.1fs" % (rows, len(files), time.time() - t))
+        return rows
+
+    def _dump_job(self, job):
+        """
+        Export one table (or an id range of it) in its own consistent
+        snapshot
+        """
+        table, first, last, epoch = job
+        if first is None:
+            name = "%s.full.%d.json.gz" % (table, last)
+            SQL = "SELECT * FROM `%s`" % table
+            args = []
+        else:
+            name = "%s.%d-%d.json.gz" % (table, first + 1, last)
+            if epoch:
+                name = "%s.reset%d.%d-%d.json.gz" % (table, epoch, first + 1, last)
+            SQL = "SELECT * FROM `%s` WHERE id>%%s AND id<=%%s ORDER BY id" % table
+            args = [first, last]
+        filename = os.path.join(self.destination, name)
+        rows = 0
+        conn = self.db.db._get_connection()
+        try:
+            setup = conn.cursor()
+            setup.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            setup.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+            setup.close()
+            cursor = conn.cursor(buffered=False)
+            cursor.execute(SQL, tuple(args))
+            columns = [d[0] for d in cursor.description]
+            with gzip.open(filename + ".tmp", "wt", compresslevel=self.compresslevel) as f:
+                f.write(json.dumps({"table": table, "columns": columns}) + "\n")
+                while not self.stop_event.is_set():
+                    chunk = cursor.fetchmany(1000)
+                    if not chunk:
+                        break
+                    for row in chunk:
+                        f.write(json.dumps([encode_value(v) for v in row]) + "\n")
+                    rows += len(chunk)
+            cursor.close()
+            conn.rollback()
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        if self.stop_event.is_set():
+            raise Exception("Stopped")
+        os.rename(filename + ".tmp", filename)
+        info = {"table": table, "file": name, "append": first is not None}
+        if epoch:
+            info["epoch"] = epoch
+        return (info, rows)
+
+    def restore(self, tables=None):
+        """
+        Load a dump into the database, creating missing tables. Returns
+        the number of rows loaded.
+        """
+        manifest = self.get_manifest()
+        latest_full = {}
+        appends = {}  # file name -> info, a name can be in several runs
+        for run in manifest["runs"]:
+            if run["full"]:
+                # All rows of the tables in a full run are in it and later runs
+                dumped = set([f["table"] for f in run["files"]])
+                appends = dict([(n, f) for n, f in appends.items() if f["table"] not in dumped])
+            for f in run["files"]:
+                if tables and f["table"] not in tables:
+                    continue
+                if f["append"]:
+                    appends[f["file"]] = f
+                else:
+                    latest_full[f["table"]] = f
+        appends = list(appends.values())
+
+        # Ids of older epochs were reused after a truncate, they would collide
+        epoch = manifest["epoch"]
+        old = [f for f in appends if f.get("epoch", 0) < epoch.get(f["table"], 0)]
+        if old:
+            self.log.warning("Not restoring %d files dumped before %s were truncated" %
+                             (len(old), ", ".join(sorted(set([f["table"] for f in old])))))
+            appends = [f for f in appends if f not in old]
+
+        schema_dir = os.path.join(self.destination, "schema")
+        for filename in sorted(os.listdir(schema_dir)):
+            table = filename[:-4]
+            if tables and table not in tables:
+                continue
+            with open(os.path.join(schema_dir, filename), "r") as f:
+                SQL = f.read().replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1)
+            self.db._execute(SQL)
+
+        t = time.time()
+        jobs = list(latest_full.values()) + appends
+        rows = sum(self._run_parallel(jobs, self._restore_job))
+        self.log.info("Restored %d rows from %d files in %.1fs" % (rows, len(jobs), time.time() - t))
+        return rows
+
+    def _restore_job(self, info):
+        rows = 0
+        conn = self.db.db._get_connection()
+        try:
+            cursor = conn.cursor()
+            with gzip.open(os.path.join(self.destination, info["file"]), "rt") as f:
+                header = json.loads(f.readline())
+                if info["append"]:
+                    verb = "INSERT IGNORE"
+                else:
+                    verb = "REPLACE"
+                SQL = "%s INTO `%s` (%s) VALUES (%s)" % (verb, header["table"],
+                                                         ",".join(["`%s`" % c for c in header["columns"]]),
+                                                         ",".join(["%s"] * len(header["columns"])))
+                batch = []
+                for line in f:
+                    batch.append(tuple([decode_value(v) for v in json.loads(line)]))
+                    if len(batch) >= self.insert_size:
+                        cursor.executemany(SQL, batch)
+                        conn.commit()
+                        rows += len(batch)
+                        batch = []
+                        if self.stop_event.is_set():
+                            raise Exception("Stopped")
+                if batch:
+                    cursor.executemany(SQL, batch)
+                    conn.commit()
+                    rows += len(batch)
+            cursor.close()
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        return rows
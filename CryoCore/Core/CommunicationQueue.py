@@ -1,3 +1,6 @@
+import time
+import threading
+from collections import deque
 
 from . import Queue
 
@@ -12,23 +15,66 @@ Priorities = [PRIO_HIGH, PRIO_MED, PRIO_LOW, PRIO_BULKDATA]
 PriorityString = {PRIO_ANY: "any", PRIO_HIGH: "high", PRIO_MED: "medium",
                   PRIO_LOW: "low", PRIO_BULKDATA: "bulk data"}
 
+# Share of the bytes each priority gets when all have messages waiting
+DEFAULT_WEIGHTS = {PRIO_HIGH: 8, PRIO_MED: 4, PRIO_LOW: 2, PRIO_BULKDATA: 1}
+
+
+def _sizeof(message):
+    try:
+        return len(message)
+    except TypeError:
+        return 1
+
 
 class CommunicationQueue:
     """
     The communcation queue is a threadsafe, multi-priority queue to hold
     messages from one or more providers and send it to one receiver.
+
+    All priorities share one lock, and a receiver waiting for a message
+    of any priority sleeps on a single condition. Messages of any
+    priority are picked by deficit round robin on their size: per round
+    each priority may take weight * quantum bytes, so high priority
+    messages mostly go first without starving bulk data.
     """
 
-    def __init__(self, logger):
+    def __init__(self, logger, max_messages=0, max_bytes=0, weights=None, quantum=8192, sizeof=_sizeof):
         """
-        Logs will be sent to the given logger
+        Logs will be sent to the given logger. max_messages and max_bytes
+        limit each priority (0 is unlimited), sizeof(message) gives the
+        size of a message in bytes.
         """
         self.log = logger
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.weights = weights or DEFAULT_WEIGHTS
+        self.quantum = quantum
+        self.sizeof = sizeof
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._room = threading.Condition(self._lock)
 
-        # Thread safe queues
+        # Per priority: (post time, size, message)
         self.queue = {}
+        self._bytes = {}
+        self._deficit = {}
+        self._stats = {}
         for priority in Priorities:
-            self.queue[priority] = Queue.Queue()
+            self.queue[priority] = deque()
+            self._bytes[priority] = 0
+            self._deficit[priority] = 0
+            self._stats[priority] = {"posted": 0, "delivered": 0, "latency": 0.0, "max_latency": 0.0}
+        self._turn = 0
+        self._credited = False
+
+    def _is_full(self, priority, size):
+        if self.max_messages and len(self.queue[priority]) >= self.max_messages:
+            return True
+        # A message larger than max_bytes is let through when the queue is empty
+        if self.max_bytes and self._bytes[priority] and self._bytes[priority] + size > self.max_bytes:
+            return True
+        return False
 
     def postMessage(self, priority, message, timeout=None):
         """
@@ -39,33 +85,122 @@ class CommunicationQueue:
         """
         assert priority in Priorities
 
-        # This will block if the queue is full - should we rather use a timeout?
-        self.queue[priority].put(message, timeout=timeout)
+        size = self.sizeof(message)
+        with self._lock:
+            if timeout is not None:
+                end_by = time.time() + timeout
+            while self._is_full(priority, size):
+                if timeout is None:
+                    self._room.wait()
+                    continue
+                left = end_by - time.time()
+                if left <= 0:
+                    raise Queue.Full("Queue for %s priority is full" % PriorityString[priority])
+                self._room.wait(left)
+
+            self.queue[priority].append((time.time(), size, message))
+            self._bytes[priority] += size
+            self._stats[priority]["posted"] += 1
+            self._available.notify_all()
+
+    def _next_turn(self):
+        self._turn = (self._turn + 1) % len(Priorities)
+        self._credited = False
+
+    def _select(self):
+        """
+        Return the priority to take the next message from, by deficit
+        round robin (lock must be held, some priority must have messages)
+        """
+        while True:
+            priority = Priorities[self._turn]
+            q = self.queue[priority]
+            if not q:
+                self._deficit[priority] = 0
+                self._next_turn()
+                continue
+            if not self._credited:
+                self._deficit[priority] += self.weights[priority] * self.quantum
+                self._credited = True
+            size = q[0][1]
+            if size <= self._deficit[priority]:
+                self._deficit[priority] -= size
+                return priority
+            self._next_turn()
+
+    def _take(self, priority):
+        posted, size, message = self.queue[priority].popleft()
+        self._bytes[priority] -= size
+        if not self.queue[priority]:
+            # No saving up credit while idle
+            self._deficit[priority] = 0
+            if Priorities[self._turn] == priority:
+                self._next_turn()
+        latency = time.time() - posted
+        stats = self._stats[priority]
+        stats["delivered"] += 1
+        stats["latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+        self._room.notify_all()
+        return message
+
+    def _has_message(self, priority):
+        if priority == PRIO_ANY:
+            for p in Priorities:
+                if self.queue[p]:
+                    return True
+            return False
+        return len(self.queue[priority]) > 0
 
     def getMessage(self, priority=PRIO_ANY, timeout=None):
         """
         Return a message, possibly limited by prioirty.  If any
-        priority is accepted, the highest priority with messages left
-        will be returned.  Returns None if no message was present
-        within the given time.
+        priority is accepted, messages are picked by weighted round
+        robin (see the class documentation).  Returns None if no
+        message was present within the given time.
 
-        If timeout is None or priority is ANY, it returns immediately.
+        If timeout is None, it returns immediately.
         """
+        assert priority == PRIO_ANY or priority in Priorities
 
-        if priority == PRIO_ANY:
+        with self._lock:
+            if timeout:
+                end_by = time.time() + timeout
+            while not self._has_message(priority):
+                if not timeout:
+                    return None
+                left = end_by - time.time()
+                if left <= 0:
+                    return None
+                self._available.wait(left)
+
+            if priority == PRIO_ANY:
+                priority = self._select()
+            return self._take(priority)
+
+    def qsize(self, priority=PRIO_ANY):
+        """
+        Number of messages waiting
+        """
+        with self._lock:
+            if priority == PRIO_ANY:
+                return sum([len(q) for q in self.queue.values()])
+            return len(self.queue[priority])
+
+    def get_stats(self):
+        """
+        Return depth, bytes, message counts and latency (seconds from
+        post to get) per priority, keyed on the PriorityString
+        """
+        stats = {}
+        with self._lock:
             for priority in Priorities:
-                try:
-                    return self.queue[priority].get(block=False)
-                except:
-                    # No message
-                    self.log.exception("No message of priority %s" % priority)
-        else:
-            try:
-                if timeout:
-                    return self.queue[priority].get(timeout=timeout)
-                else:
-                    return self.queue[priority].get(block=False)
-            except:
-                self.log.debug("No message of level %s" % priority)
-
-        return None
+                s = self._stats[priority]
+                stats[PriorityString[priority]] = {
+                    "depth": len(self.queue[priority]),
+                    "bytes": self._bytes[priority],
+                    "posted": s["posted"],
+                    "delivered": s["delivered"],
+                    "avg_latency": s["latency"] / s["delivered"] if s["delivered"] else 0.0,
+                    "max_latency": s["max_latency"]}
+        return stats
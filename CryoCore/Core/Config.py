@@ -305,6 +305,8 @@ class NamedConfiguration:
         self.get_version_info_by_id = self._parent.get_version_info_by_id
         self.deserialize = self._parent.deserialize
         self.last_updated = self._parent.last_updated
+        self.config_validator = self._parent.config_validator
+        self.versions_validator = self._parent.versions_validator
         self.del_callback = self._parent.del_callback
         try:
             r = "root"
@@ -1811,6 +1813,29 @@ class Configuration(threading.Thread):
         row = c.fetchone()
         return row[0]
 
+    def config_validator(self, version=None):
+        """
+        Return a value that changes whenever serialize() of the version
+        may change: parameters are updated, added or deleted
+        """
+        if version:
+            version_id = self._get_version_id(version)
+        else:
+            version_id = self._get_version_id(self.version)
+        row = self._execute("SELECT COUNT(*), MAX(id), UNIX_TIMESTAMP(MAX(last_modified)) FROM config WHERE version=%s",
+                            [version_id]).fetchone()
+        return "%s:%s:%s" % (row[0], row[1], row[2])
+
+    def versions_validator(self):
+        """
+        Return a value that changes whenever list_versions() may change:
+        versions are added or deleted, or parameters of any version are
+        updated, added or deleted
+        """
+        versions = self._execute("SELECT COUNT(*), MAX(id) FROM config_version").fetchone()
+        params = self._execute("SELECT COUNT(*), UNIX_TIMESTAMP(MAX(last_modified)) FROM config").fetchone()
+        return "%s:%s:%s:%s" % (versions[0], versions[1], params[0], params[1])
+
     # ###############  Callback management ##################
     def _callback_thread_main(self):
         if DEBUG:
@@ -128,25 +128,29 @@ class AsyncDB(threading.Thread):
             del self.retval_map[handle]
         return r
 
-    def execute(self, task, insist_direct=False):
+    def execute(self, task, insist_direct=False, connection=None):
         if insist_direct:
-            conn = self._get_connection()
-            cursor = conn.cursor()
-            SQL, parameters, ignore_error = task
-            cursor.execute(SQL, tuple(parameters))
-            retval = {
-                "status": "ok",
-                "return": []
-            }
-            retval["rowcount"] = cursor.rowcount
-            retval["lastrowid"] = cursor.lastrowid
-            # if cursor.rowcount != 0 and SQL.upper().startswith("SELECT") or SQL.upper().startswith("SHOW"):
+            # Use the given connection if any, otherwise a new one for this statement
+            conn = connection or self._get_connection()
             try:
-                retval["return"] = cursor.fetchall()
-            except:
-                retval["return"] = []
-            cursor.close()
-            conn.close()
+                cursor = conn.cursor()
+                SQL, parameters, ignore_error = task
+                cursor.execute(SQL, tuple(parameters))
+                retval = {
+                    "status": "ok",
+                    "return": []
+                }
+                retval["rowcount"] = cursor.rowcount
+                retval["lastrowid"] = cursor.lastrowid
+                # if cursor.rowcount != 0 and SQL.upper().startswith("SELECT") or SQL.upper().startswith("SHOW"):
+                try:
+                    retval["return"] = cursor.fetchall()
+                except:
+                    retval["return"] = []
+                cursor.close()
+            finally:
+                if connection is None:
+                    conn.close()
             return retval, None
 
         with self._lock:  # We protect the shutdown phase - if we queue something as we shut down, we'll hang
@@ -343,8 +347,8 @@ class AsyncDB(threading.Thread):
                 res = []
                 if cursor.rowcount != 0 and SQL.upper().startswith("SELECT") or SQL.upper().startswith("SHOW"):
                     try:
-                        for row in cursor.fetchall():
-                            res.append(row)
+                        # fetchall already returns a list, don't copy it again
+                        res = cursor.fetchall()
                     except:
                         pass  # fetchall likely used with no result
                 retval["return"] = res
@@ -488,9 +492,12 @@ class mysql:
     def _execute(self, SQL, parameters=None,
                  temporary_connection=True,
                  ignore_error=False,
-                 insist_direct=False):
+                 insist_direct=False,
+                 connection=None):
         """
         NEVER use insist_direct if you don't know what you are doing
+        connection is a connection from _get_direct_connection() to use
+        with insist_direct, otherwise a new one is made for the statement
         """
         if parameters is None:
             parameters = []
@@ -512,7 +519,8 @@ class mysql:
                         return self.cursor
                     raise e
         if insist_direct:
-            retval = self.db.execute([SQL, parameters, ignore_error], insist_direct=insist_direct)
+            retval, _ = self.db.execute([SQL, parameters, ignore_error], insist_direct=insist_direct,
+                                        connection=connection)
         else:
             event, handle = self.db.execute([SQL, parameters, ignore_error])
             t = time.time()
@@ -528,3 +536,66 @@ class mysql:
         if not ignore_error and "error" in retval:
             raise Exception(retval["error"])
         return FakeCursor(retval)
+
+    def _get_direct_connection(self):
+        """
+        A new connection for several insist_direct statements, the
+        caller must close it
+        """
+        return self.db._get_connection()
+
+    def _iterate(self, SQL, parameters=None, chunk_size=1000):
+        """
+        Execute a SELECT and yield the rows one by one without reading the
+        whole result set into memory.  A separate connection with an
+        unbuffered cursor is used, and rows are fetched chunk_size at a time,
+        so memory use is bounded regardless of the size of the result.
+
+        This bypasses the async queue, so only use it for (long) reads.
+        If the generator is not exhausted, close() it to release the
+        connection.
+        """
+        if parameters is None:
+            parameters = []
+        conn = self.db._get_connection()
+        cursor = None
+        try:
+            cursor = conn.cursor(buffered=False)
+            cursor.execute(SQL, tuple(parameters))
+            while not self.stop_event.is_set():
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            try:
+                if cursor:
+                    cursor.close()
+            except:
+                pass  # Unread rows if we were stopped early, the connection goes anyway
+            try:
+                conn.close()
+            except:
+                pass
+
+    def _iterate_by_id(self, SQL, parameters=None, last_id=0, chunk_size=10000, id_index=0):
+        """
+        Yield rows using keyset pagination on an id column.  SQL must
+        filter on "id>%s" as its FIRST parameter and be ORDER BY id,
+        a LIMIT is added here.  Each chunk is a separate query, so this
+        works through the async queue too, and can be resumed later from
+        the last id seen.
+        """
+        if parameters is None:
+            parameters = []
+        while not self.stop_event.is_set():
+            args = [last_id]
+            args.extend(parameters)
+            cursor = self._execute(SQL + " LIMIT %d" % chunk_size, args)
+            rows = cursor.fetchall()
+            for row in rows:
+                last_id = row[id_index]
+                yield row
+            if len(rows) < chunk_size:
+                break
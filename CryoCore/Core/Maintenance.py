@@ -0,0 +1,170 @@
+"""
+Deleting large amounts of data without blocking the reporters.
+
+A single "DELETE FROM table" is one huge transaction that holds locks
+for as long as it runs and fills the undo log. TableCleaner instead:
+  - drops RANGE partitions that are completely older than the limit
+  - deletes the rest in bounded primary key ranges, pausing between
+    chunks so the database (and any replica) keeps up
+  - TRUNCATEs a table that is cleared completely if asked to (and no
+    foreign keys point to it). The AUTO_INCREMENT value is kept, ids
+    are never reused as readers, exports and the ground sync keep
+    track of the last id they have seen.
+
+Deletes are resumable - a new run starts at the smallest remaining key,
+so an interrupted clear can just be run again.
+
+  cleaner = TableCleaner(db)
+  cleaner.clear("log")                               # Everything
+  cleaner.clear("log", truncate=True)                # Everything, faster
+  cleaner.clear("status", "timestamp", time.time() - 86400 * 30)  # Old data
+"""
+import time
+
+from CryoCore.Core import API
+
+
+class TableCleaner:
+
+    def __init__(self, db, chunk_size=10000, duty_cycle=0.5, replica=None, max_lag=5.0,
+                 status=None, progress=None, stop_event=None):
+        """
+        db is an InternalDB.mysql instance. duty_cycle is the fraction
+        of the time spent deleting, the rest is pauses. If replica (a
+        database connection to a replica) is given, deleting waits while
+        it is more than max_lag seconds behind. progress(table, deleted,
+        fraction) is called after each chunk.
+        """
+        self.db = db
+        self.chunk_size = chunk_size
+        self.duty_cycle = min(1.0, max(0.01, duty_cycle))
+        self.replica = replica
+        self.max_lag = max_lag
+        self.status = status
+        self.progress = progress
+        self.stop_event = stop_event or API.api_stop_event
+
+    def clear(self, table, time_column=None, before=None, key="id", truncate=False):
+        """
+        Delete everything in table, or only rows with time_column < before.
+        If truncate is True, a table that is cleared completely is
+        truncated if possible. Returns the number of rows deleted (None if
+        truncated).
+        """
+        if before is None:
+            if truncate and self._can_truncate(table):
+                self.truncate(table, key)
+                self._report(table, None, 1.0)
+                return None
+            return self.delete_range(table, key)
+        self._drop_partitions(table, time_column, before)
+        return self.delete_range(table, key, "%s<%%s" % time_column, [before])
+
+    def truncate(self, table, key="id"):
+        """
+        Truncate the table, but keep counting ids from where it was
+        """
+        row = self.db._execute("SELECT MAX(%s) FROM %s" % (key, table)).fetchone()
+        next_id = (row[0] or 0) + 1
+        row = self.db._execute("SELECT AUTO_INCREMENT FROM INFORMATION_SCHEMA.TABLES WHERE "
+                               "TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s", [table]).fetchone()
+        if row and row[0]:
+            next_id = max(next_id, row[0])
+        self.db._execute("TRUNCATE TABLE %s" % table)
+        self.db._execute("ALTER TABLE %s AUTO_INCREMENT=%d" % (table, next_id))
+
+    def _can_truncate(self, table):
+        SQL = "SELECT COUNT(*) FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE WHERE "\
+              "REFERENCED_TABLE_SCHEMA=DATABASE() AND REFERENCED_TABLE_NAME=%s"
+        row = self.db._execute(SQL, [table]).fetchone()
+        return row is not None and row[0] == 0
+
+    def _drop_partitions(self, table, time_column, before):
+        """
+        Drop RANGE partitions on time_column that only hold rows older
+        than before. Returns the names of the dropped partitions.
+        """
+        SQL = "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM INFORMATION_SCHEMA.PARTITIONS WHERE "\
+              "TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND PARTITION_METHOD LIKE 'RANGE%%' AND "\
+              "REPLACE(PARTITION_EXPRESSION, '`', '')=%s"
+        dropped = []
+        for name, description in self.db._execute(SQL, [table, time_column]).fetchall():
+            try:
+                # "VALUES LESS THAN (description)"
+                if float(description) <= before:
+                    dropped.append(name)
+            except (TypeError, ValueError):
+                pass  # MAXVALUE
+        if dropped:
+            self.db._execute("ALTER TABLE %s DROP PARTITION %s" % (table, ",".join(dropped)))
+        return dropped
+
+    def replication_lag(self):
+        """
+        Seconds the replica is behind, 0 if unknown
+        """
+        if self.replica is None:
+            return 0
+        try:
+            cursor = self.replica._execute("SHOW REPLICA STATUS")
+        except Exception:
+            # Before MySQL 8.0.22
+            cursor = self.replica._execute("SHOW SLAVE STATUS")
+        row = cursor.fetchone()
+        if not row or not hasattr(cursor, "description") or not cursor.description:
+            return 0
+        names = [d[0] for d in cursor.description]
+        for name in ["Seconds_Behind_Source", "Seconds_Behind_Master"]:
+            if name in names:
+                return row[names.index(name)] or 0
+        return 0
+
+    def _pause(self, elapsed):
+        """
+        Sleep so that deleting takes duty_cycle of the time, then wait
+        for the replica to catch up
+        """
+        self.stop_event.wait(elapsed * (1.0 - self.duty_cycle) / self.duty_cycle)
+        while not self.stop_event.is_set() and self.replication_lag() > self.max_lag:
+            self.stop_event.wait(1.0)
+
+    def delete_range(self, table, key="id", where=None, params=None):
+        """
+        Delete rows (matching where) in chunks of chunk_size keys. Rows
+        added after we started are left alone. Returns the number of
+        rows deleted.
+        """
+        if params is None:
+            params = []
+        condition = ""
+        if where:
+            condition = " AND " + where
+        SQL = "SELECT MIN(%s), MAX(%s) FROM %s" % (key, key, table)
+        if where:
+            SQL += " WHERE " + where
+        row = self.db._execute(SQL, params).fetchone()
+        if not row or row[0] is None:
+            self._report(table, 0, 1.0)
+            return 0
+        first, last = row
+        deleted = 0
+        start = first
+        while start <= last and not self.stop_event.is_set():
+            end = min(start + self.chunk_size, last + 1)
+            args = [start, end]
+            args.extend(params)
+            t = time.time()
+            cursor = self.db._execute("DELETE FROM %s WHERE %s>=%%s AND %s<%%s%s" % (table, key, key, condition), args)
+            if cursor.rowcount:
+                deleted += cursor.rowcount
+            start = end
+            self._report(table, deleted, (start - first) / float(last + 1 - first))
+            self._pause(time.time() - t)
+        return deleted
+
+    def _report(self, table, deleted, fraction):
+        if self.status is not None:
+            self.status["%s.deleted" % table] = deleted if deleted is not None else 0
+            self.status["%s.progress" % table] = int(100 * fraction)
+        if self.progress:
+            self.progress(table, deleted, fraction)
@@ -13,6 +13,7 @@ import pyexiv2
 from PIL import Image
 
 from CryoCore.Core import API, Utils, InternalDB, Quaternion
+from CryoCore.Core.Pyramid import Pyramid
 
 
 def get_distance_x_y(source, destination):
@@ -88,6 +89,9 @@ class PictureSupplier(InternalDB.mysql):
     def __init__(self):
         InternalDB.mysql.__init__(self, "PictureSupplier")
         self._camera_cfg = API.get_config("Instruments.Camera")
+        pyramid_cfg = API.get_config("Instruments.Pyramid")
+        pyramid_cfg.set_default("directory", "/tmp/cryocore/pyramid")
+        self._pyramid = Pyramid(pyramid_cfg["directory"])
         global opengl
         if opengl:
             try:
@@ -368,10 +372,19 @@ class PictureSupplier(InternalDB.mysql):
             # Done
             return inf, result["img"]
 
-        i = Image.open(filename)
-        # i = i.transpose(Image.ROTATE_180)
+        # Use a precomputed level if there is one
+        pre = None
+        if scale < 1.0:
+            pre = self._pyramid.render(filename, scale, crop_box, use_thumbnail)
+        if pre:
+            inf, i = pre
+            scale = 1.0
+            crop_box = None
+        else:
+            i = Image.open(filename)
+            # i = i.transpose(Image.ROTATE_180)
+            inf = {"orig_size": (i.size[0], i.size[1])}
 
-        inf = {"orig_size": (i.size[0], i.size[1])}
         if scale != 1.0:
             if i.size[0] == 0 or i.size[1] == 0:
                 self.log.warning("Image '%s' has size 0, ignoring" % filename)
@@ -397,7 +410,7 @@ class PictureSupplier(InternalDB.mysql):
 
         # save it (to convert to JPEG)
         import io
-        f = io.StringIO()
+        f = io.BytesIO()
         i.save(f, format=filetype, quality=int(quality * 100), transparent=0)  # , optimize=True), progressive=True)
         inf["bb_size"] = (i.size[0], i.size[1])
 
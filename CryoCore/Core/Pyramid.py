@@ -0,0 +1,215 @@
+"""
+Precomputed image pyramids, so that scaled and cropped versions of
+samples can be served without decoding the full resolution image.
+
+For each image, a fixed set of downscaled levels is made, each cut into
+tiles:
+  <directory>/<hash of path>/<level>/<x>_<y>.png
+  <directory>/<hash of path>/manifest.json
+The manifest is written last, so a pyramid is only used when complete.
+
+PyramidBuilder is a thread that builds pyramids for new images in a
+process pool - SampleDB feeds it the images it inserts.
+Pyramid is used by PictureSupplier.resample to find the nearest level.
+"""
+import os
+import os.path
+import json
+import hashlib
+import shutil
+import threading
+import multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from PIL import Image
+
+from CryoCore.Core import API
+
+# Scales relative to the original image, largest first
+LEVELS = [0.5, 0.25, 0.125, 0.0625]
+TILE_SIZE = 512
+
+
+def _pyramid_dir(directory, filename):
+    return os.path.join(directory, hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest())
+
+
+def build_pyramid(filename, directory, levels=LEVELS, tile_size=TILE_SIZE):
+    """
+    Build the pyramid for one image, runs in a worker process
+    """
+    destination = _pyramid_dir(directory, filename)
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    os.makedirs(destination)
+    stat = os.stat(filename)
+    image = Image.open(filename)
+    image.load()
+    orig_size = image.size
+    manifest = {"source": os.path.abspath(filename),
+                "mtime": stat.st_mtime,
+                "orig_size": orig_size,
+                "tile_size": tile_size,
+                "levels": []}
+    for level, scale in enumerate(levels):
+        size = (max(1, int(orig_size[0] * scale)), max(1, int(orig_size[1] * scale)))
+        # Each level is made from the previous one, which is much cheaper
+        image = image.resize(size, Image.BILINEAR)
+        os.makedirs(os.path.join(destination, str(level)))
+        for y in range(0, size[1], tile_size):
+            for x in range(0, size[0], tile_size):
+                tile = image.crop((x, y, min(x + tile_size, size[0]), min(y + tile_size, size[1])))
+                tile.save(os.path.join(destination, str(level), "%d_%d.png" % (x, y)))
+        manifest["levels"].append({"scale": scale, "size": size})
+
+    tmp = os.path.join(destination, "manifest.json.tmp")
+    with open(tmp, "w") as f:
+        f.write(json.dumps(manifest))
+    os.rename(tmp, os.path.join(destination, "manifest.json"))
+    return filename
+
+
+class Pyramid:
+    """
+    Read access to the pyramids
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_manifest(self, filename):
+        """
+        Return the manifest of a complete and up to date pyramid or None
+        """
+        path = os.path.join(_pyramid_dir(self.directory, filename), "manifest.json")
+        try:
+            with open(path, "r") as f:
+                manifest = json.loads(f.read())
+            if os.stat(filename).st_mtime != manifest["mtime"]:
+                return None  # The image has been changed since
+        except (IOError, OSError, ValueError):
+            return None
+        return manifest
+
+    def render(self, filename, scale, crop_box=None, use_thumbnail=True):
+        """
+        Like the scaling and cropping in PictureSupplier.resample, but
+        from the nearest level that is at least as large as requested.
+        Returns (info, image) or None if there is no suitable level.
+        """
+        manifest = self.get_manifest(filename)
+        if not manifest:
+            return None
+        level = None
+        for i, l in enumerate(manifest["levels"]):
+            if l["scale"] >= scale:
+                level = i
+        if level is None:
+            return None
+
+        orig_w, orig_h = manifest["orig_size"]
+        box = (max(64, int(orig_w * scale)), max(64, int(orig_h * scale)))
+        if use_thumbnail:
+            # Keep the aspect ratio, never scale up
+            ratio = min(box[0] / float(orig_w), box[1] / float(orig_h), 1.0)
+            target = (max(1, int(orig_w * ratio)), max(1, int(orig_h * ratio)))
+        else:
+            target = box
+
+        if crop_box:
+            crop_box = (min(max(crop_box[0], 0), target[0]),
+                        min(max(crop_box[1], 0), target[1]),
+                        max(min(crop_box[2], target[0]), 0),
+                        max(min(crop_box[3], target[1]), 0))
+        else:
+            crop_box = (0, 0, target[0], target[1])
+        out_size = (max(0, crop_box[2] - crop_box[0]), max(0, crop_box[3] - crop_box[1]))
+
+        # Region of the level we need
+        level_w, level_h = manifest["levels"][level]["size"]
+        fx = level_w / float(target[0])
+        fy = level_h / float(target[1])
+        region = (int(crop_box[0] * fx), int(crop_box[1] * fy),
+                  min(level_w, int(round(crop_box[2] * fx))), min(level_h, int(round(crop_box[3] * fy))))
+        image = self._assemble(filename, level, manifest["tile_size"], region)
+        if image.size != out_size and out_size[0] > 0 and out_size[1] > 0:
+            image = image.resize(out_size, Image.BILINEAR)
+        return {"orig_size": (orig_w, orig_h), "new_size": image.size}, image
+
+    def _assemble(self, filename, level, tile_size, region):
+        """
+        Paste together the tiles covering region (left, top, right, bottom)
+        """
+        directory = os.path.join(_pyramid_dir(self.directory, filename), str(level))
+        image = None
+        for y in range((region[1] // tile_size) * tile_size, region[3], tile_size):
+            for x in range((region[0] // tile_size) * tile_size, region[2], tile_size):
+                tile = Image.open(os.path.join(directory, "%d_%d.png" % (x, y)))
+                if image is None:
+                    image = Image.new(tile.mode, (max(1, region[2] - region[0]), max(1, region[3] - region[1])))
+                image.paste(tile, (x - region[0], y - region[1]))
+        if image is None:
+            image = Image.new("RGB", (max(1, region[2] - region[0]), max(1, region[3] - region[1])))
+        return image
+
+
+class PyramidBuilder(threading.Thread):
+    """
+    Build pyramids for images given to add() using a pool of processes
+    """
+
+    def __init__(self, stop_event=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cfg = API.get_config("Instruments.Pyramid")
+        self.cfg.set_default("directory", "/tmp/cryocore/pyramid")
+        self.cfg.set_default("workers", 2)
+        self.cfg.set_default("max_pending", 1000)
+        self.log = API.get_log("Instruments.Pyramid")
+        self.status = API.get_status("Instruments.Pyramid")
+        if stop_event is None:
+            stop_event = API.api_stop_event
+        self._stop_event = stop_event
+        self._inqueue = queue.Queue(self.cfg["max_pending"])
+        self.status["built"] = 0
+        self.status["failed"] = 0
+
+    def add(self, filename):
+        """
+        Queue an image, images are dropped if we're too far behind
+        """
+        try:
+            self._inqueue.put_nowait(filename)
+        except queue.Full:
+            self.log.warning("Too many pending pyramids, not building for %s" % filename)
+
+    def _done(self, filename):
+        self.status["built"].inc()
+
+    def _failed(self, error):
+        self.log.error("Building pyramid failed: %s" % error)
+        self.status["failed"].inc()
+
+    def run(self):
+        pool = multiprocessing.Pool(self.cfg["workers"])
+        pending = []
+        try:
+            while not self._stop_event.is_set():
+                pending = [p for p in pending if not p.ready()]
+                self.status["pending"] = len(pending) + self._inqueue.qsize()
+                # Don't queue up more than the workers can chew on
+                if len(pending) >= 2 * self.cfg["workers"]:
+                    pending[0].wait(1.0)
+                    continue
+                try:
+                    filename = self._inqueue.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                pending.append(pool.apply_async(build_pyramid, (filename, self.cfg["directory"]),
+                                                callback=self._done, error_callback=self._failed))
+        finally:
+            pool.close()
+            pool.join()
@@ -1,5 +1,6 @@
-
-from threading import Condition
+import time
+from collections import deque
+from threading import Condition, Lock
 
 
 class Full(Exception):
@@ -24,71 +25,231 @@ class Queue:
     """
     The Python Queue does not allow me to peek into it, so here is one that
     does.  It is also threadsafe and can be used just like a python Queue
+
+    If a key function is given, items are also kept in a sub queue per
+    key, and get_on_content(key=...) takes the first item with that key
+    without looking at the others.
+
+    Items are kept in a deque as entries [seq, key, item, alive]. Items
+    taken out of the middle (by key or content) are only marked as dead,
+    and skipped when they reach the front. If dead entries outnumber the
+    live ones (an item at the front is never taken), they are compacted.
     """
 
-    def __init__(self, maxsize=0):
+    def __init__(self, maxsize=0, key=None):
 
-        self.items = []
+        self.items = deque()
         self.max_size = maxsize
-        self.lock = Condition()
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+        self.not_full = Condition(self.lock)
+        self.changed = Condition(self.lock)  # For get_on_content(func)
+        self._content_waiters = 0
+        self._key = key
+        self._keyed = {}  # key -> deque of entries
+        self._key_conditions = {}  # key -> [condition, waiters]
+        self._size = 0
+        self._dead = 0  # Dead entries still in self.items
+        self._seq = 0
+
+    def _deadline(self, timeout):
+        if timeout is None:
+            return None
+        return time.time() + timeout
+
+    def _wait(self, condition, deadline):
+        """
+        Wait on the condition, returns False if the deadline has passed
+        """
+        if deadline is None:
+            condition.wait()
+            return True
+        left = deadline - time.time()
+        if left <= 0:
+            return False
+        condition.wait(left)
+        return True
 
     def put(self, obj, block=True, timeout=None):
         with self.lock:
-            looped = False
-            while True:
-                if self.max_size and len(self.items) >= self.max_size:
-                    if not block or looped:
-                        raise Full()
-                    self.lock.wait(timeout)
-                    looped = True
-                    continue
-                self.items.append(obj)
-                self.lock.notify()
-                return
+            deadline = self._deadline(timeout)
+            while self.max_size and self._size >= self.max_size:
+                if not block or not self._wait(self.not_full, deadline):
+                    raise Full()
+            self._seq += 1
+            key = None
+            if self._key:
+                key = self._key(obj)
+            entry = [self._seq, key, obj, True]
+            self.items.append(entry)
+            self._size += 1
+            if self._key:
+                if key not in self._keyed:
+                    self._keyed[key] = deque()
+                self._keyed[key].append(entry)
+                if key in self._key_conditions:
+                    self._key_conditions[key][0].notify()
+            self.not_empty.notify()
+            if self._content_waiters:
+                self.changed.notify_all()
+
+    def put_nowait(self, obj):
+        return self.put(obj, block=False)
 
     def empty(self):
         with self.lock:
-            return len(self.items) == 0
+            return self._size == 0
+
+    def full(self):
+        with self.lock:
+            return self.max_size > 0 and self._size >= self.max_size
+
+    def qsize(self):
+        with self.lock:
+            return self._size
+
+    def __len__(self):
+        return self.qsize()
+
+    def _take(self, entry):
+        """
+        Remove the entry (lock must be held)
+        """
+        entry[3] = False
+        self._size -= 1
+        self._dead += 1
+        # Drop dead entries from the fronts
+        while self.items and not self.items[0][3]:
+            self.items.popleft()
+            self._dead -= 1
+        if self._key:
+            q = self._keyed.get(entry[1])
+            while q and not q[0][3]:
+                q.popleft()
+            if q is not None and len(q) == 0:
+                del self._keyed[entry[1]]
+        if self._dead > self._size + 64:
+            self._compact()
+        self.not_full.notify()
+        return entry[2]
+
+    def _compact(self):
+        """
+        Remove all dead entries (lock must be held). A dead entry in a
+        sub queue is always behind a live one in self.items too, so this
+        also bounds the sub queues.
+        """
+        self.items = deque([e for e in self.items if e[3]])
+        for key in self._keyed:
+            self._keyed[key] = deque([e for e in self._keyed[key] if e[3]])
+        self._dead = 0
 
     def get(self, block=True, timeout=None):
         """
         Get the object
         """
         with self.lock:
-            looped = False
-            while True:
-                if len(self.items) == 0:
-                    if not block or looped:
-                        raise Empty()
-                    self.lock.wait(timeout)
-                    looped = True
-                    continue
-                obj = self.items.pop(0)
-                self.lock.notify()
-                return obj
-
-    def get_on_content(self, block=True, timeout=None, func=None):
+            deadline = self._deadline(timeout)
+            while self._size == 0:
+                if not block or not self._wait(self.not_empty, deadline):
+                    raise Empty()
+            return self._take(self.items[0])
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def get_on_content(self, block=True, timeout=None, func=None, key=None):
         """
         The first object in the list that triggers 'func' to return
-        True will be removed and returned from the queue
+        True (or has the given key) will be removed and returned from
+        the queue
         """
+        if key is not None:
+            return self._get_key(key, block, timeout)
+
         if not func:
             return self.get(block, timeout)
 
         with self.lock:
-            looped = False
+            deadline = self._deadline(timeout)
+            checked = 0  # Items up to this seq did not match
             while True:
-                if len(self.items) == 0:
-                    if not block or looped:
-                        raise Empty()
-                    self.lock.wait(timeout)
-                    looped = True
-                    continue
-                for item in self.items:
-                    if func(item):
-                        self.items.remove(item)
-                        return item
+                # Only look at items that arrived since last time
+                new = []
+                for entry in reversed(self.items):
+                    if entry[0] <= checked:
+                        break
+                    new.append(entry)
+                for entry in reversed(new):
+                    if entry[3] and func(entry[2]):
+                        return self._take(entry)
+                checked = self._seq
                 if not block:
+                    if self._size == 0:
+                        raise Empty()
                     raise NoMatch()
+                self._content_waiters += 1
+                try:
+                    if not self._wait(self.changed, deadline):
+                        raise Empty()
+                finally:
+                    self._content_waiters -= 1
+
+    def _get_key(self, key, block, timeout):
+        if not self._key:
+            raise Exception("Queue has no key function")
+        with self.lock:
+            deadline = self._deadline(timeout)
+            while key not in self._keyed:
+                if not block:
+                    raise Empty()
+                if key not in self._key_conditions:
+                    self._key_conditions[key] = [Condition(self.lock), 0]
+                waiter = self._key_conditions[key]
+                waiter[1] += 1
+                try:
+                    ok = self._wait(waiter[0], deadline)
+                finally:
+                    waiter[1] -= 1
+                    if waiter[1] == 0:
+                        del self._key_conditions[key]
+                if not ok:
+                    raise Empty()
+            return self._take(self._keyed[key][0])
+
+
+def benchmark(num_items=200000, num_producers=2, num_consumers=2, maxsize=1000):
+    """
+    Compare throughput with queue.Queue, returns {name: items/second}
+    """
+    import queue
+    import threading
+
+    def run(q):
+        per_producer = num_items // num_producers
+        per_consumer = per_producer * num_producers // num_consumers
+
+        def produce():
+            for i in range(per_producer):
+                q.put(i)
+
+        def consume():
+            for i in range(per_consumer):
+                q.get()
+
+        threads = [threading.Thread(target=produce) for i in range(num_producers)]
+        threads += [threading.Thread(target=consume) for i in range(num_consumers)]
+        t = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return per_producer * num_producers / (time.time() - t)
+
+    return {"queue.Queue": run(queue.Queue(maxsize)),
+            "CryoCore Queue": run(Queue(maxsize))}
+
 
-                self.lock.wait(timeout)  # No match, wait for changes to the queue
+if __name__ == "__main__":
+    for name, rate in benchmark().items():
+        print("%15s: %9.0f items/s" % (name, rate))
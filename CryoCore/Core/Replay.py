@@ -0,0 +1,256 @@
+"""
+Replay of status and log rows following a clock (StatusListener.Clock,
+or a motion).
+
+A ReplayBuffer thread reads rows from the database ahead of the clock
+into a ring buffer, in id order and one bounded id range at a time. How
+far ahead it reads is scaled by the clock velocity, so fast playback
+reads further ahead. Readers take the rows that are due with get(), so
+following the clock doesn't cost any queries.
+
+If the clock jumps (backwards, or further than the prefetched data) the
+buffer is discarded and reading starts over from the new position. For
+status, a snapshot of the latest values at that time is loaded first.
+
+  replay = StatusReplay(clock, db, [("Instruments.GPS", "lat")])
+  replay.start()
+  ...
+  replay.advance()
+  value = replay.get_last_value("Instruments.GPS", "lat")
+"""
+import abc
+import time
+import threading
+from collections import deque
+
+from CryoCore.Core import API
+
+
+class ReplayBuffer(threading.Thread, metaclass=abc.ABCMeta):
+    """
+    Prefetch rows of table ahead of a clock, id_step ids at a time.
+    time_column is the time of the rows, seek_order how to find the
+    first row at a time (by the time column if it is indexed). Subclasses
+    provide:
+      _read(last_id, end_id)  the rows with last_id < id <= end_id as
+                              (ts, row) items
+      _on_seek(pos)           called when reading starts over at pos
+    """
+    table = None
+    time_column = None
+    seek_order = "id"
+
+    def __init__(self, clock, db, id_step=10000, lookahead=30.0, max_items=100000, stop_event=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.clock = clock
+        self.db = db
+        self.id_step = id_step
+        self.lookahead = lookahead
+        self.max_items = max_items
+        self.stop_event = stop_event or API.api_stop_event
+        self._lock = threading.Lock()
+        self._buffer = deque()
+        self._last_id = None
+        self._fetched_ts = None
+        self._pos = None
+        self._seek_to = None
+        self.seeks = 0
+
+    @abc.abstractmethod
+    def _read(self, last_id, end_id):
+        pass
+
+    def _max_id(self):
+        row = self.db._execute("SELECT MAX(id) FROM %s" % self.table).fetchone()
+        if row and row[0] is not None:
+            return row[0]
+        return 0
+
+    def _find_id(self, pos):
+        """
+        The id to read from (exclusive) for time pos
+        """
+        SQL = "SELECT id FROM %s WHERE %s>=%%s ORDER BY %s LIMIT 1" % (self.table, self.time_column, self.seek_order)
+        row = self.db._execute(SQL, [pos]).fetchone()
+        if row:
+            return row[0] - 1
+        return self._max_id()
+
+    def _fetch(self, last_id):
+        """
+        Read the next id range after last_id, returns (items, new_last_id, ts)
+        where ts is the time reached (None at the end)
+        """
+        max_id = self._max_id()
+        if last_id >= max_id:
+            return [], last_id, None
+        end_id = min(last_id + self.id_step, max_id)
+        items = self._read(last_id, end_id)
+        SQL = "SELECT %s FROM %s WHERE id<=%%s ORDER BY id DESC LIMIT 1" % (self.time_column, self.table)
+        row = self.db._execute(SQL, [end_id]).fetchone()
+        ts = row[0] if row else None
+        return items, end_id, ts
+
+    def _on_seek(self, pos):
+        pass
+
+    def _seek(self, pos, last_id=None):
+        """
+        Start over at pos, reading after last_id if given
+        """
+        if last_id is None:
+            last_id = self._find_id(pos)
+        with self._lock:
+            self._buffer.clear()
+            self._last_id = last_id
+            self._fetched_ts = pos
+            self._pos = pos
+            self.seeks += 1
+        self._on_seek(pos)
+
+    def seek(self, pos=None, last_id=None):
+        """
+        Request a restart at pos (default the clock position), e.g.
+        because what to replay changed. If last_id is given, reading
+        continues after it rather than from the first row at pos.
+        """
+        self._seek_to = (pos if pos is not None else self.clock.pos(), last_id)
+
+    def _needs_seek(self, pos, vel):
+        if self._seek_to is not None or self._last_id is None:
+            return True
+        if self._pos is not None and pos < self._pos - 1.0:
+            return True  # Backwards
+        # Further ahead than we could read in a second or two
+        if self._fetched_ts is not None and pos > self._fetched_ts + max(2.0, 2.0 * abs(vel)):
+            return True
+        return False
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                pos = self.clock.pos()
+                vel = self.clock.vel()
+                if self._needs_seek(pos, vel):
+                    last_id = None
+                    if self._seek_to is not None:
+                        pos, last_id = self._seek_to
+                        self._seek_to = None
+                    self._seek(pos, last_id)
+                ahead = self.lookahead * max(1.0, abs(vel))
+                if len(self._buffer) >= self.max_items or self._fetched_ts >= pos + ahead:
+                    time.sleep(0.1)
+                    continue
+                items, last_id, ts = self._fetch(self._last_id)
+                with self._lock:
+                    if self._seek_to is not None:
+                        continue  # Stale
+                    self._buffer.extend(items)
+                    self._last_id = last_id
+                    if ts is not None:
+                        self._fetched_ts = max(self._fetched_ts, ts)
+                if ts is None:
+                    # Caught up with the database, wait for more
+                    self._fetched_ts = max(self._fetched_ts, time.time())
+                    time.sleep(0.5)
+            except Exception:
+                API.get_log("Replay").exception("Replay failed, retrying")
+                time.sleep(1.0)
+
+    def get(self, pos=None):
+        """
+        Return the rows that are due at pos (default the clock position)
+        """
+        if pos is None:
+            pos = self.clock.pos()
+        ret = []
+        with self._lock:
+            while len(self._buffer) > 0 and self._buffer[0][0] <= pos:
+                ret.append(self._buffer.popleft()[1])
+            self._pos = pos
+        return ret
+
+
+class StatusReplay(ReplayBuffer):
+    """
+    Replay of monitored status parameters, last values are kept in
+    memory
+    """
+    table = "status"
+    time_column = "timestamp"
+    seek_order = "timestamp"
+
+    def __init__(self, clock, db, monitors, **kwargs):
+        ReplayBuffer.__init__(self, clock, db, **kwargs)
+        self.monitors = monitors
+        self._rev = {}
+        self.last_values = {}
+
+    def _max_id(self):
+        return self.db.get_max_id()
+
+    def _on_seek(self, pos):
+        monitors = self.monitors[:]
+        values = {}
+        if len(monitors) > 0:
+            self._rev = self.db._resolve_paramlist(monitors)
+            values = self.db.get_last_status_values(monitors, since=0, now=pos)
+        with self._lock:
+            self.last_values.clear()
+            for key, (ts, value) in values.items():
+                self.last_values[key] = {"channel": key[0], "name": key[1], "ts": ts, "value": value}
+
+    def _fetch(self, last_id):
+        if len(self._rev) == 0:
+            return [], last_id, None
+        return ReplayBuffer._fetch(self, last_id)
+
+    def _read(self, last_id, end_id):
+        args = [last_id, end_id]
+        args.extend(self._rev.keys())
+        SQL = "SELECT id, timestamp, paramid, value FROM status WHERE id>%s AND id<=%s AND paramid IN (" +\
+              ",".join(["%s"] * len(self._rev)) + ") ORDER BY id"
+        items = []
+        for id, ts, paramid, value in self.db._execute(SQL, args).fetchall():
+            items.append((ts, (self._rev[paramid], ts, value)))
+        return items
+
+    def advance(self, pos=None):
+        """
+        Apply the rows due at pos to last_values, returns the keys updated
+        """
+        updated = set()
+        rows = self.get(pos)
+        with self._lock:
+            for key, ts, value in rows:
+                if key in self.last_values and self.last_values[key]["ts"] > ts:
+                    continue  # Older than the snapshot
+                self.last_values[key] = {"channel": key[0], "name": key[1], "ts": ts, "value": value}
+                updated.add(key)
+        return updated
+
+    def get_last_value(self, chan, param):
+        return self.last_values.get((chan, param))
+
+
+class LogReplay(ReplayBuffer):
+    """
+    Replay of log rows. SQL selects the rows and must start with a
+    condition on "id>%s AND id<=%s", params are any further parameters.
+    time_index is the column of the log time in the rows.
+    """
+    table = "log"
+    time_column = "time"
+    seek_order = "id"  # log.time has no index
+
+    def __init__(self, clock, db, SQL, params=None, time_index=3, **kwargs):
+        ReplayBuffer.__init__(self, clock, db, **kwargs)
+        self.SQL = SQL
+        self.params = params or []
+        self.time_index = time_index
+
+    def _read(self, last_id, end_id):
+        args = [last_id, end_id]
+        args.extend(self.params)
+        return [(row[self.time_index], row) for row in self.db._execute(self.SQL, args).fetchall()]
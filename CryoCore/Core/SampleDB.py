@@ -2,6 +2,7 @@
 from threading import Thread
 from CryoCore.Core.InternalDB import mysql as DB
 from CryoCore.Core import API
+from CryoCore.Core.Pyramid import PyramidBuilder
 
 
 class SampleDB(DB, Thread):
@@ -12,6 +13,8 @@ class SampleDB(DB, Thread):
         self._stop_event = stop_event
         self.cfg = API.get_config("Instruments.SampleDB")
         self.log = API.get_log("Instruments.SampleDB")
+        self.cfg.set_default("build_pyramids", False)
+        self._pyramid = None
 
         if self.cfg["imu"] is None or self.cfg["imu"] == "auto":
             self._imu = self._detect_imu()
@@ -147,6 +150,9 @@ class SampleDB(DB, Thread):
                 SQL = "INSERT INTO sample (timestamp, instrument, path, lat, lon, alt) VALUES (%s, %s, %s, %s, %s, %s)"
             self._execute(SQL, values)
 
+        if self._pyramid:
+            self._pyramid.add(item["path"])
+
     def fill_in(self):
         """
         Execute on existing sample table, trying to fill in all values from the IMU
@@ -172,6 +178,9 @@ class SampleDB(DB, Thread):
 
     def run(self):
         print("Running")
+        if self.cfg["build_pyramids"]:
+            self._pyramid = PyramidBuilder(self._stop_event)
+            self._pyramid.start()
         while not self._stop_event.is_set():
             try:
                 item = self._inqueue.get(True, 1.0)
@@ -0,0 +1,238 @@
+"""
+Append-only, checksummed spool files for rows that could not be written
+to the database. Used by the status reporter and the log handler to
+keep memory bounded while the database is unreachable.
+
+Rows are JSON encoded, each record is stored as
+   <length (4 bytes)><crc32 (4 bytes)><payload>
+in segment files named <pid>-<sequence>.seg.  A torn write at the end of
+a segment (e.g. a crash while appending) fails the checksum and ends the
+segment.  Segments left behind by processes that are no longer running
+are replayed too. A segment is locked (<segment>.lock) while it is
+replayed, so two processes never replay the same one. If only the first
+rows of a segment could be stored, consumed() remembers how far we got
+(<segment>.pos) and the rest is read from there next time, in order.
+
+Usage:
+  spool = Spool("/tmp/cryocore/spool/status")
+  spool.append(row)
+  ...
+  for segment, rows in spool.read_segments():
+      n = insert(rows)
+      if n < len(rows):
+          spool.consumed(segment, n)
+          break
+      spool.remove(segment)
+"""
+import fcntl
+import os
+import os.path
+import struct
+import json
+import mmap
+import zlib
+import threading
+
+HEADER = struct.Struct("<II")
+
+
+class Spool:
+
+    def __init__(self, directory, segment_size=8 * 1048576, max_size=1024 * 1048576):
+        """
+        segment_size is the size of each segment file, max_size is the
+        total size of the spool. If the spool is full, the oldest segment
+        is dropped.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._seq = 0
+        self._fd = None
+        self._segment = None
+        self._size = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # Made by someone else
+        for segment in self._list_segments(True):
+            seq = int(os.path.basename(segment)[:-4].split("-")[1])
+            self._seq = max(self._seq, seq + 1)
+
+    def _list_segments(self, own_only=False):
+        """
+        Return our segments and those of stopped processes, oldest first
+        """
+        segments = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".seg"):
+                continue
+            try:
+                pid, seq = [int(x) for x in filename[:-4].split("-")]
+            except ValueError:
+                continue
+            if pid != self._pid:
+                if own_only or _is_running(pid):
+                    continue
+            path = os.path.join(self.directory, filename)
+            segments.append((os.path.getmtime(path), pid, seq, path))
+        segments.sort()
+        return [s[3] for s in segments]
+
+    def __len__(self):
+        """
+        Number of bytes spooled
+        """
+        total = 0
+        for segment in self._list_segments():
+            try:
+                total += os.path.getsize(segment)
+            except OSError:
+                pass
+        return total
+
+    def is_empty(self):
+        return len(self._list_segments()) == 0
+
+    def append(self, row):
+        payload = json.dumps(row).encode("utf-8")
+        record = HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        with self._lock:
+            if self._fd is None or self._size + len(record) > self.segment_size:
+                self._rotate()
+            os.write(self._fd, record)
+            self._size += len(record)
+
+    def _rotate(self):
+        self._close()
+        self._segment = os.path.join(self.directory, "%d-%d.seg" % (self._pid, self._seq))
+        self._seq += 1
+        self._fd = os.open(self._segment, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._size = 0
+
+        # Keep the total size bounded, dropping the oldest data
+        segments = self._list_segments()
+        total = 0
+        for segment in segments:
+            total += os.path.getsize(segment)
+        while total > self.max_size and len(segments) > 1:
+            segment = segments.pop(0)
+            total -= os.path.getsize(segment)
+            self.remove(segment)
+            self.dropped += 1
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._segment = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def read_segments(self):
+        """
+        Yield (segment, rows) for all completed segments, oldest first.
+        The segment currently written to is closed first so it is included.
+        Segments replayed by another process are skipped, and rows that
+        were already consumed are not returned again. Call remove(segment)
+        when the rows have been stored, or consumed(segment, n) if only
+        the first n were.
+        """
+        with self._lock:
+            # New rows go to a new segment, so the snapshot is not written to while we read it
+            self._close()
+            segments = self._list_segments()
+        for segment in segments:
+            lock = _lock(segment + ".lock")
+            if lock is None:
+                continue  # Someone else is replaying it
+            try:
+                if not os.path.exists(segment):
+                    # Replayed while we waited for the lock
+                    _remove(segment + ".lock")
+                    continue
+                yield segment, _read_segment(segment, self._get_offset(segment))
+            finally:
+                os.close(lock)
+
+    def _get_offset(self, segment):
+        try:
+            with open(segment + ".pos", "r") as f:
+                return int(f.read())
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def consumed(self, segment, num_rows):
+        """
+        The next num_rows rows of segment have been stored
+        """
+        offset = self._get_offset(segment) + num_rows
+        with open(segment + ".pos.tmp", "w") as f:
+            f.write(str(offset))
+        os.rename(segment + ".pos.tmp", segment + ".pos")
+
+    def remove(self, segment):
+        for filename in [segment, segment + ".pos", segment + ".lock"]:
+            _remove(filename)
+
+
+def _read_segment(filename, offset=0):
+    """
+    Return the rows of a segment, skipping the first offset rows
+    """
+    rows = []
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return rows
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            pos = 0
+            while pos + HEADER.size <= size:
+                length, crc = HEADER.unpack_from(m, pos)
+                payload = m[pos + HEADER.size:pos + HEADER.size + length]
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    break  # Torn or corrupt, the rest of the segment is lost
+                if offset > 0:
+                    offset -= 1
+                else:
+                    rows.append(json.loads(payload.decode("utf-8")))
+                pos += HEADER.size + length
+        finally:
+            m.close()
+    return rows
+
+
+def _lock(filename):
+    """
+    Take an exclusive lock on filename, returns the file descriptor or
+    None if someone else has it
+    """
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        os.close(fd)
+        return None
+    return fd
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == 1  # EPERM - it's running, just not ours
+    return True
@@ -0,0 +1,380 @@
+"""
+Export status data to compressed numpy files (.npz) for offline analysis.
+
+The layout is one directory per channel and one file per time partition
+and id batch:
+  <destination>/<channel>/<partition start>_<first id>-<last id>.npz
+Each file holds "<parameter>/ts" and "<parameter>/values" arrays.
+
+Exports are resumable - the highest id that is completely exported is
+kept in <destination>/export_state.json, and running the export again
+continues from there. Batch boundaries are multiples of the batch size,
+and files of batches past the high-water mark (written before a crash or
+a failed batch) are removed when resuming, so no rows are exported twice.
+
+Requires numpy
+"""
+import os
+import os.path
+import json
+import threading
+import time
+
+from CryoCore.Core import API, InternalDB
+from CryoCore.Core.Status import StatusDbReader
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+STATE_FILE = "export_state.json"
+
+
+def _safe_name(name):
+    """
+    Channels are used as directory names
+    """
+    return name.replace(os.sep, "_")
+
+
+def write_partition(destination, channel, partition, first_id, last_id, columns):
+    """
+    Write columns {name: (timestamps, values)} for one channel and partition.
+    The file is written to a temporary name and renamed, so readers never
+    see half written files.
+    """
+    directory = os.path.join(destination, _safe_name(channel))
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # Another worker made it
+    arrays = {}
+    for name, (ts, values) in columns.items():
+        if values.dtype == object:
+            values = values.astype(str)  # Avoid pickled arrays in the files
+        arrays[name + "/ts"] = ts
+        arrays[name + "/values"] = values
+    filename = os.path.join(directory, "%d_%d-%d.npz" % (partition, first_id, last_id))
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        numpy.savez_compressed(f, **arrays)
+    os.rename(tmp, filename)
+    return filename
+
+
+class StatusExporter(InternalDB.mysql):
+    """
+    Export the status table in parallel id batches
+    """
+
+    def __init__(self, destination, name="System.Status.MySQL", partition_size=3600,
+                 batch_size=100000, num_workers=4, channels=None):
+        if numpy is None:
+            raise Exception("Columnar export requires numpy")
+        cfg = API.get_config(name)
+        InternalDB.mysql.__init__(self, "StatusExporter", cfg, is_direct=False)
+        self.destination = destination
+        self.partition_size = partition_size
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.channels = channels
+        self._lock = threading.Lock()
+        self._params = {}
+        self._skipped = set()  # Parameters of other channels
+        self._done = {}
+        self.exported = 0
+
+    def _load_params(self):
+        cursor = self._execute("SELECT paramid, status_parameter.name, status_channel.name FROM "
+                               "status_parameter, status_channel WHERE "
+                               "status_parameter.chanid=status_channel.chanid")
+        for paramid, name, channel in cursor.fetchall():
+            if self.channels and channel not in self.channels:
+                self._skipped.add(paramid)
+                continue
+            self._params[paramid] = (channel, name)
+
+    def get_state(self):
+        filename = os.path.join(self.destination, STATE_FILE)
+        if not os.path.exists(filename):
+            return {"last_id": 0}
+        with open(filename, "r") as f:
+            return json.loads(f.read())
+
+    def _save_state(self, state):
+        filename = os.path.join(self.destination, STATE_FILE)
+        with open(filename + ".tmp", "w") as f:
+            f.write(json.dumps(state))
+        os.rename(filename + ".tmp", filename)
+
+    def export(self, stop_id=None):
+        """
+        Export everything newer than the saved high-water mark (up to
+        stop_id if given). Returns the number of rows exported.
+        """
+        if not os.path.isdir(self.destination):
+            os.makedirs(self.destination)
+        self._load_params()
+        state = self.get_state()
+        if stop_id is None:
+            row = self._execute("SELECT MAX(id) FROM status").fetchone()
+            if not row or row[0] is None:
+                return 0
+            stop_id = row[0]
+
+        # Anything past the mark is exported again
+        self._remove_after(state["last_id"])
+
+        batches = []
+        first = state["last_id"]
+        while first < stop_id:
+            last = min((first // self.batch_size + 1) * self.batch_size, stop_id)
+            batches.append((first, last))
+            first = last
+        if len(batches) == 0:
+            return 0
+
+        self._done = {}
+        self.exported = 0
+        pending = list(batches)
+        errors = []
+
+        def worker():
+            while not API.api_stop_event.is_set():
+                with self._lock:
+                    if len(pending) == 0:
+                        return
+                    batch = pending.pop(0)
+                try:
+                    num = self._export_batch(batch[0], batch[1])
+                except Exception as e:
+                    self.log.exception("Exporting ids %s-%s" % batch)
+                    errors.append(e)
+                    return
+                with self._lock:
+                    self.exported += num
+                    self._done[batch[0]] = batch[1]
+                    # The high-water mark only moves past contiguous completed batches
+                    last_id = state["last_id"]
+                    while last_id in self._done:
+                        last_id = self._done.pop(last_id)
+                    if last_id != state["last_id"]:
+                        state["last_id"] = last_id
+                        state["partition_size"] = self.partition_size
+                        state["updated"] = time.time()
+                        self._save_state(state)
+
+        threads = []
+        for i in range(0, min(self.num_workers, len(batches))):
+            t = threading.Thread(target=worker)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise Exception("Export failed, resume from id %s: %s" % (state["last_id"], errors[0]))
+        return self.exported
+
+    def _remove_after(self, last_id):
+        """
+        Remove files of batches after last_id
+        """
+        for channel in os.listdir(self.destination):
+            directory = os.path.join(self.destination, channel)
+            if not os.path.isdir(directory):
+                continue
+            for filename in os.listdir(directory):
+                if filename.endswith(".tmp"):
+                    os.remove(os.path.join(directory, filename))
+                    continue
+                if not filename.endswith(".npz"):
+                    continue
+                try:
+                    first_id = int(filename[:-4].split("_")[-1].split("-")[0])
+                except ValueError:
+                    continue
+                if first_id >= last_id:
+                    self.log.debug("Removing %s, past the exported ids" % filename)
+                    os.remove(os.path.join(directory, filename))
+
+    def _export_batch(self, first_id, last_id):
+        """
+        Export ids first_id < id <= last_id
+        """
+        SQL = "SELECT paramid, timestamp, value FROM status WHERE id>%s AND id<=%s ORDER BY id"
+        builders = {}
+        num = 0
+        for paramid, ts, value in self._iterate(SQL, [first_id, last_id]):
+            if paramid not in self._params:
+                if paramid in self._skipped:
+                    continue
+                # Added after we started
+                with self._lock:
+                    self._load_params()
+                if paramid in self._skipped:
+                    continue
+                if paramid not in self._params:
+                    raise Exception("Unknown status parameter %s in ids %s-%s" % (paramid, first_id, last_id))
+            channel, name = self._params[paramid]
+            partition = int(ts // self.partition_size) * self.partition_size
+            if (channel, partition) not in builders:
+                builders[(channel, partition)] = StatusDbReader.ColumnBuilder()
+            builders[(channel, partition)].add(name, ts, value)
+            num += 1
+
+        for (channel, partition), builder in builders.items():
+            write_partition(self.destination, channel, partition, first_id, last_id, builder.get_columns())
+        return num
+
+
+class OfflineStatusReader:
+    """
+    Read back exported status files. Provides the read functions of
+    StatusDbReader, but parameters are identified by (channel, name) as
+    there are no parameter ids without the database.
+    """
+
+    def __init__(self, source):
+        if numpy is None:
+            raise Exception("Offline status reading requires numpy")
+        self.source = source
+        self._cache = {}
+        self.partition_size = None
+        state_file = os.path.join(source, STATE_FILE)
+        if os.path.exists(state_file):
+            with open(state_file, "r") as f:
+                self.partition_size = json.loads(f.read()).get("partition_size")
+
+    def get_channels(self):
+        return sorted([d for d in os.listdir(self.source) if os.path.isdir(os.path.join(self.source, d))])
+
+    def _files(self, channel):
+        directory = os.path.join(self.source, _safe_name(channel))
+        if not os.path.isdir(directory):
+            return []
+        files = []
+        for filename in os.listdir(directory):
+            if not filename.endswith(".npz"):
+                continue
+            partition, ids = filename[:-4].split("_", 1)
+            files.append((int(partition), int(ids.split("-")[0]), os.path.join(directory, filename)))
+        files.sort()
+        return files
+
+    def _load_channel(self, channel, start_time=None, end_time=None):
+        """
+        Return {name: (timestamps, values)} for a channel, sorted on time
+        """
+        chunks = {}
+        for partition, first_id, filename in self._files(channel):
+            if start_time is not None and self.partition_size and partition + self.partition_size < start_time:
+                continue
+            if end_time is not None and partition > end_time:
+                continue
+            with numpy.load(filename) as data:
+                for key in data.files:
+                    name, what = key.rsplit("/", 1)
+                    if name not in chunks:
+                        chunks[name] = {"ts": [], "values": []}
+                    chunks[name][what].append(data[key])
+        columns = {}
+        for name, c in chunks.items():
+            ts = numpy.concatenate(c["ts"])
+            values = numpy.concatenate(c["values"])
+            order = numpy.argsort(ts, kind="mergesort")
+            ts = ts[order]
+            values = values[order]
+            if start_time is not None or end_time is not None:
+                mask = numpy.ones(len(ts), dtype=bool)
+                if start_time is not None:
+                    mask &= ts > start_time
+                if end_time is not None:
+                    mask &= ts < end_time
+                ts = ts[mask]
+                values = values[mask]
+            columns[name] = (ts, values)
+        return columns
+
+    def _get_channel(self, channel):
+        if channel not in self._cache:
+            self._cache[channel] = self._load_channel(channel)
+        return self._cache[channel]
+
+    def get_parameters(self, channel):
+        return sorted(self._get_channel(channel).keys())
+
+    def get_channels_and_parameters(self):
+        retval = {}
+        for channel in self.get_channels():
+            retval[channel] = {}
+            for name in self.get_parameters(channel):
+                retval[channel][name] = (channel, name)
+        return retval
+
+    def get_columns(self, paramlist, start_time=None, end_time=None):
+        """
+        Returns {(channel, name): (timestamps, values)}
+        """
+        retval = {}
+        channels = {}
+        for channel, name in paramlist:
+            if channel not in channels:
+                channels[channel] = self._load_channel(channel, start_time, end_time)
+            if name in channels[channel]:
+                retval[(channel, name)] = channels[channel][name]
+        return retval
+
+    def get_last_status_value(self, channel, name):
+        columns = self._get_channel(channel)
+        if name not in columns or len(columns[name][0]) == 0:
+            return (None, None)
+        ts, values = columns[name]
+        return (ts[-1], values[-1])
+
+    def get_last_status_values(self, paramlist, since=-60, now=None):
+        """
+        Like StatusDbReader.get_last_status_values, but a negative since
+        is relative to now if given, or the end of the data
+        """
+        if len(paramlist) == 0:
+            raise Exception("Need parameter list")
+        if since < 0:
+            if now:
+                since = now + since
+            else:
+                end = self.get_max_timestamp()
+                if end is None:
+                    return {}  # Nothing exported
+                since = end + since
+        ret = {}
+        for channel, name in paramlist:
+            columns = self._get_channel(channel)
+            if name not in columns:
+                continue
+            ts, values = columns[name]
+            if now:
+                i = numpy.searchsorted(ts, now, side="left")
+            else:
+                i = len(ts)
+            if i > 0 and ts[i - 1] > since:
+                ret[(channel, name)] = (ts[i - 1], values[i - 1])
+        return ret
+
+    def get_min_timestamp(self):
+        m = None
+        for channel in self.get_channels():
+            for ts, values in self._get_channel(channel).values():
+                if len(ts) and (m is None or ts[0] < m):
+                    m = ts[0]
+        return m
+
+    def get_max_timestamp(self):
+        m = None
+        for channel in self.get_channels():
+            for ts, values in self._get_channel(channel).values():
+                if len(ts) and (m is None or ts[-1] > m):
+                    m = ts[-1]
+        return m
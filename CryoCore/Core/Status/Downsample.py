@@ -0,0 +1,87 @@
+"""
+Reduce time series to a point budget for plotting.
+
+  lttb    Largest-Triangle-Three-Buckets, keeps the visual shape
+  minmax  The minimum and maximum of each bucket, keeps all spikes
+
+Both take numpy arrays of timestamps and values (sorted on time) and
+return the reduced arrays. Series that already fit are returned as is.
+
+Requires numpy
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+METHODS = ["lttb", "minmax"]
+
+
+def downsample(ts, values, points, method="lttb"):
+    if method not in METHODS:
+        raise Exception("Unknown downsampling method '%s'" % method)
+    if points is None or len(ts) <= points:
+        return ts, values
+    if values.dtype == object:
+        # Not numbers, just pick evenly spaced samples
+        index = numpy.linspace(0, len(ts) - 1, points).astype(numpy.int64)
+        return ts[index], values[index]
+    if method == "minmax":
+        return minmax(ts, values, points)
+    return lttb(ts, values, points)
+
+
+def lttb(ts, values, points):
+    """
+    Largest-Triangle-Three-Buckets (Steinarsson, 2013). The first and last
+    points are kept, and one point is chosen from each bucket in between:
+    the one making the largest triangle with the previously chosen point
+    and the average of the next bucket.
+    """
+    n = len(ts)
+    if points >= n or points < 3:
+        return ts, values
+    edges = numpy.floor(numpy.linspace(1, n - 1, points - 1)).astype(numpy.int64)
+    selected = numpy.empty(points, dtype=numpy.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(0, points - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        avg_t = ts[next_start:next_end].mean()
+        avg_v = values[next_start:next_end].mean()
+        bucket_t = ts[start:end]
+        bucket_v = values[start:end]
+        # Twice the triangle area, the factor doesn't matter
+        area = numpy.abs((ts[a] - avg_t) * (bucket_v - values[a]) -
+                         (ts[a] - bucket_t) * (avg_v - values[a]))
+        a = start + int(numpy.argmax(area))
+        selected[i + 1] = a
+    return ts[selected], values[selected]
+
+
+def minmax(ts, values, points):
+    """
+    Split the series in points/2 buckets and keep the min and max of each,
+    in time order
+    """
+    n = len(ts)
+    buckets = max(1, points // 2)
+    if n <= points:
+        return ts, values
+    edges = numpy.floor(numpy.linspace(0, n, buckets + 1)).astype(numpy.int64)
+    selected = []
+    for i in range(0, buckets):
+        bucket = values[edges[i]:edges[i + 1]]
+        lo = edges[i] + int(numpy.argmin(bucket))
+        hi = edges[i] + int(numpy.argmax(bucket))
+        if lo == hi:
+            selected.append(lo)
+        else:
+            selected.extend(sorted((lo, hi)))
+    selected = numpy.array(selected, dtype=numpy.int64)
+    return ts[selected], values[selected]
@@ -1,7 +1,10 @@
 import time
+import os.path
 
 from CryoCore.Core import API, InternalDB
+from CryoCore.Core.Spool import Spool
 from CryoCore.Core.Status import Status
+from CryoCore.Core.Status.StatusDbReader import IdCache
 import threading
 import sys
 if sys.version_info.major == 3:
@@ -25,29 +28,70 @@ class MySQLStatusReporter(Status.OnChangeStatusReporter, InternalDB.mysql, threa
         InternalDB.mysql.__init__(self, "MySQLStatusReporter", self.cfg)
         self.cfg.set_default("isconfigured", False)
         self.cfg.set_default("autoclean", True)
-        self._channels = {}
+        self.cfg.set_default("spool.directory", "/tmp/cryocore/spool")
+        self.cfg.set_default("spool.max_queue", 10000)
+        self.cfg.set_default("spool.max_latency", 5.0)
+        # Channel ids are shared with the status readers of this process
+        self._channels = IdCache.channels
         self._parameters = {}
+        self._parameters2d = {}
         self.tasks = queue.Queue()
 
         self._addLock = threading.Lock()
         self._addList = []
         self._addTimer = None
 
+        # If the database is slow or gone, updates are spooled to disk and replayed later
+        self._spool = Spool(os.path.join(self.cfg["spool.directory"], "status"))
+        # Protects the decision to spool or not, so no update is written past spooled ones
+        self._spool_lock = threading.RLock()
+        self._spooling = not self._spool.is_empty()
+        self._last_replay = 0
+
         self.start()
 
     def run(self):
         if API.api_auto_init:
             self._prepare_db()
+        try:
+            self._preload_ids()
+        except Exception:
+            self.log.exception("Could not preload status ids, resolving when needed")
 
         # Thread entry point
         stop_time = None
         last_clean = 0
         while True:  # Must loop - we only exit when idle, to ensure that we flush all items
+            if self._spooling and time.time() - self._last_replay > 5.0:
+                # Also when busy, we might never be idle
+                self._last_replay = time.time()
+                self._replay()
             try:
-                (event, ts, value) = self.tasks.get(block=True, timeout=API.queue_timeout)
-                # Should insert something
-                # self._execute(sql, args)
-                self._async_report(event, ts, value)
+                tasks = [self.tasks.get(block=True, timeout=API.queue_timeout)]
+                try:
+                    while len(tasks) < 1000:
+                        tasks.append(self.tasks.get_nowait())
+                except queue.Empty:
+                    pass
+
+                if not self._spooling:
+                    # Register all new parameters of this batch in one go
+                    new_names = set()
+                    for (event, ts, value) in tasks:
+                        if not event._db_param_id and not event.type.startswith("2d"):
+                            new_names.add((event.status_holder.get_name(), event.get_name()))
+                    if new_names:
+                        try:
+                            self._register(list(new_names))
+                        except Exception:
+                            self.log.exception("Failed to register status parameters")
+
+                for (event, ts, value) in tasks:
+                    # Should insert something
+                    # self._execute(sql, args)
+                    if not event.type.startswith("2d") and self._spool_event(event, ts, value):
+                        continue  # Don't wait for the database to resolve ids
+                    self._async_report(event, ts, value)
             except queue.Empty:
                 if API.api_stop_event.is_set():
                     if stop_time is None:
@@ -123,62 +167,125 @@ class MySQLStatusReporter(Status.OnChangeStatusReporter, InternalDB.mysql, threa
         self._init_sqls(statements)
         self.cfg["isprepared"] = True
 
+    def _preload_ids(self):
+        """
+        Load all known channel and parameter ids in one go
+        """
+        channels = {}
+        for chanid, name in self._execute("SELECT chanid, name FROM status_channel").fetchall():
+            self._channels[name] = chanid
+            channels[chanid] = name
+        for paramid, name, chanid in self._execute("SELECT paramid, name, chanid FROM status_parameter").fetchall():
+            self._parameters[(chanid, name)] = paramid
+            if chanid in channels:
+                IdCache.parameters[(channels[chanid], name)] = paramid
+        for paramid, name, chanid in self._execute("SELECT paramid, name, chanid FROM status_parameter2d").fetchall():
+            self._parameters2d[(chanid, name)] = paramid
+
+    def _register_channels(self, channels, connection=None):
+        """
+        Ensure that all channels have ids - missing ones are added
+        with a single insert and a single lookup. If a direct connection
+        is given, it is used instead of the queue
+        """
+        direct = connection is not None
+        missing = list(set([c for c in channels if c not in self._channels]))
+        if not missing:
+            return
+        if DEBUG:
+            self.log.debug("New channels %s" % missing)
+        self._execute("INSERT INTO status_channel(name) VALUES " + ",".join(["(%s)"] * len(missing)) +
+                      " ON DUPLICATE KEY UPDATE chanid=chanid", missing,
+                      insist_direct=direct, connection=connection)
+        cursor = self._execute("SELECT chanid, name FROM status_channel WHERE name IN (" +
+                               ",".join(["%s"] * len(missing)) + ")", missing,
+                               insist_direct=direct, connection=connection)
+        # Names are compared case insensitive by the database
+        found = {}
+        for chanid, name in cursor.fetchall():
+            found[name.lower()] = chanid
+        for name in missing:
+            self._channels[name] = found[name.lower()]
+
+    def _register(self, names, connection=None):
+        """
+        Ensure that all (channel, name) 1D parameters have ids. Missing
+        ones are added in bulk with INSERT ... ON DUPLICATE KEY and looked
+        up with a single query (per 500 parameters)
+        """
+        direct = connection is not None
+        self._register_channels([c for c, n in names], connection)
+        missing = []
+        for channel, name in set(names):
+            chanid = self._channels[channel]
+            if (chanid, name) in self._parameters:
+                IdCache.parameters[(channel, name)] = self._parameters[(chanid, name)]
+            else:
+                missing.append((channel, chanid, name))
+
+        for i in range(0, len(missing), 500):
+            batch = missing[i:i + 500]
+            if DEBUG:
+                self.log.debug("New status parameters %s" % [b[2] for b in batch])
+            args = []
+            for channel, chanid, name in batch:
+                args.extend([name, chanid])
+            self._execute("INSERT INTO status_parameter(name, chanid) VALUES " + ",".join(["(%s, %s)"] * len(batch)) +
+                          " ON DUPLICATE KEY UPDATE paramid=paramid", args,
+                          insist_direct=direct, connection=connection)
+            cursor = self._execute("SELECT paramid, name, chanid FROM status_parameter WHERE (name, chanid) IN (" +
+                                   ",".join(["(%s, %s)"] * len(batch)) + ")", args,
+                                   insist_direct=direct, connection=connection)
+            found = {}
+            for paramid, name, chanid in cursor.fetchall():
+                found[(chanid, name.lower())] = paramid
+            for channel, chanid, name in batch:
+                self._parameters[(chanid, name)] = found[(chanid, name.lower())]
+                IdCache.parameters[(channel, name)] = self._parameters[(chanid, name)]
+
     def _update_event_ids(self, event, is2D=False):
         """
         Update DB ID's for this event
         """
-        if not event._db_channel_id:
-            holder_name = event.status_holder.get_name()
-            if holder_name not in list(self._channels.keys()):
-                SQL = "SELECT chanid FROM status_channel WHERE name=%s"
-                cursor = self._execute(SQL, [holder_name])
-                row = cursor.fetchone()
-                if not row:
-                    # Must insert
-                    if DEBUG:
-                        self.log.debug("New channel '%s'" % holder_name)
-                    self._execute("INSERT INTO status_channel(name) VALUES (%s)",
-                                  [holder_name])
-
-                    return self._update_event_ids(event, is2D)  # Slightly dangerous, but should be OK as exceptions will break it
-                self._channels[holder_name] = row[0]
+        holder_name = event.status_holder.get_name()
+        param_name = event.get_name()
+        assert param_name
+        if not is2D:
+            if not event._db_channel_id or not event._db_param_id:
+                self._register([(holder_name, param_name)])
+                event._db_channel_id = self._channels[holder_name]
+                event._db_param_id = self._parameters[(event._db_channel_id, param_name)]
+            return
 
+        if not event._db_channel_id:
+            self._register_channels([holder_name])
             event._db_channel_id = self._channels[holder_name]
 
         if not event._db_param_id:
-            param_name = event.get_name()
-            if not (event._db_channel_id, param_name) in self._parameters:
-                if is2D:
-                    SQL = "SELECT paramid FROM status_parameter2d WHERE name=%s AND chanid=%s"
-                else:
-                    SQL = "SELECT paramid FROM status_parameter WHERE name=%s AND chanid=%s"
-                assert event.get_name()
-                assert event._db_channel_id
+            if not (event._db_channel_id, param_name) in self._parameters2d:
+                SQL = "SELECT paramid FROM status_parameter2d WHERE name=%s AND chanid=%s"
                 cursor = self._execute(SQL, [param_name, event._db_channel_id])
                 row = cursor.fetchone()
                 if not row:
                     # Must insert
                     if DEBUG:
                         self.log.debug("New status parameter '%s'" % param_name)
-                    if is2D:
-                        self._execute("INSERT INTO status_parameter2d(name, chanid, sizex, sizey) VALUES (%s, %s, %s, %s)",
-                                      [param_name, event._db_channel_id, event.size[0], event.size[1]])
-                    else:
-                        self._execute("INSERT INTO status_parameter(name, chanid) VALUES (%s, %s)",
-                                      [param_name, event._db_channel_id])
-                    return self._update_event_ids(event)  # Slightly dangerous, but should be OK as exceptions will break it
+                    self._execute("INSERT INTO status_parameter2d(name, chanid, sizex, sizey) VALUES (%s, %s, %s, %s)",
+                                  [param_name, event._db_channel_id, event.size[0], event.size[1]])
+                    return self._update_event_ids(event, is2D)  # Slightly dangerous, but should be OK as exceptions will break it
                 else:
                     event._db_param_id = row[0]
-                # If this is a 2d parameter, also update the size in case it changed
-                if is2D:
-                    self.log.debug("Updating status2d parameter %s with size %s" % (event._db_param_id, str(event.size)))
-                    self._execute("UPDATE status_parameter2d SET sizex=%s, sizey=%s WHERE paramid=%s", [event.size[0], event.size[1], event._db_param_id])
+                # This is a 2d parameter, also update the size in case it changed
+                self.log.debug("Updating status2d parameter %s with size %s" % (event._db_param_id, str(event.size)))
+                self._execute("UPDATE status_parameter2d SET sizex=%s, sizey=%s WHERE paramid=%s", [event.size[0], event.size[1], event._db_param_id])
 
-                    # Delete this parameter if it's already a one dimensional one
-                    self._execute("DELETE FROM status_parameter WHERE chanid=%s AND name=%s", [event._db_channel_id, param_name])
+                # Delete this parameter if it's already a one dimensional one
+                self._execute("DELETE FROM status_parameter WHERE chanid=%s AND name=%s", [event._db_channel_id, param_name])
+                self._parameters.pop((event._db_channel_id, param_name), None)
+                IdCache.parameters.pop((holder_name, param_name), None)
 
-                self._parameters[(event._db_channel_id, param_name)] = row[0]
-            event._db_param_id = self._parameters[(event._db_channel_id, param_name)]
+                self._parameters2d[(event._db_channel_id, param_name)] = row[0]
+            event._db_param_id = self._parameters2d[(event._db_channel_id, param_name)]
 
     def report(self, event):
         """
@@ -186,9 +293,78 @@ class MySQLStatusReporter(Status.OnChangeStatusReporter, InternalDB.mysql, threa
         """
         if (event.type.startswith("2d")):
             self.tasks.put((event, event.get_timestamp(), event.get_last_update()))
+        elif self.tasks.qsize() > self.cfg["spool.max_queue"]:
+            # We're falling behind, keep memory bounded and never block the caller
+            with self._spool_lock:
+                self._spooling = True
+                self._spool_event(event, event.get_timestamp(), str(event.get_value()))
         else:
             self.tasks.put((event, event.get_timestamp(), str(event.get_value())))
 
+    def _get_aux(self, event):
+        aux = event.aux
+        if not aux:
+            aux = self.cfg["aux"]
+        if aux == "none":
+            aux = None
+        return aux
+
+    def _spool_row(self, row):
+        """
+        Spool the row if we are spooling, returns False if not
+        """
+        with self._spool_lock:
+            if not self._spooling:
+                return False
+            self._spool.append(row)
+            return True
+
+    def _spool_event(self, event, ts, value):
+        """
+        Spool by name, ids are resolved when replaying. Returns False if
+        we are not spooling (anymore)
+        """
+        return self._spool_row(["name", event.status_holder.get_name(), event.get_name(),
+                                ts, value, event.get_expire_time(), self._get_aux(event)])
+
+    def _replay(self):
+        """
+        Bulk load spooled updates. Stops at the first failure and keeps
+        spooling, the rest of the segment is retried later. One direct
+        connection is used for the whole pass.
+        """
+        connection = None
+        try:
+            connection = self._get_direct_connection()
+            for segment, rows in self._spool.read_segments():
+                self._register([(row[1], row[2]) for row in rows if row[0] == "name"], connection)
+                entries = []
+                for row in rows:
+                    if row[0] == "name":
+                        channel, name, ts, value, expires, aux = row[1:]
+                        chanid = self._channels[channel]
+                        entries.append([ts, self._parameters[(chanid, name)], chanid, value, expires, aux])
+                    else:
+                        entries.append(row[1:])
+                inserted = self._insert(entries, connection)
+                if inserted < len(entries):
+                    # Continue from here next time
+                    self._spool.consumed(segment, inserted)
+                    return
+                self._spool.remove(segment)
+            with self._spool_lock:
+                if self._spool.is_empty():
+                    self._spooling = False
+                    self.log.info("Spooled status updates replayed, writing to database again")
+        except Exception as e:
+            self.log.warning("Database still not available, keeping status updates spooled: %s" % e)
+        finally:
+            if connection:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
     def _async_report2d(self, event, ts, value):
         try:
             if not event._db_param_id or not event._db_channel_id:
@@ -248,13 +424,8 @@ class MySQLStatusReporter(Status.OnChangeStatusReporter, InternalDB.mysql, threa
             self.log.exception("Could not resolve event ids for event")
             return
 
-        aux = event.aux
-        if not aux:
-            aux = self.cfg["aux"]
-        if aux == "none":
-            aux = None
         ts = event.get_timestamp()
-        params = [ts, event._db_param_id, event._db_channel_id, value, event.get_expire_time(), aux]
+        params = [ts, event._db_param_id, event._db_channel_id, value, event.get_expire_time(), self._get_aux(event)]
         with self._addLock:
             self._addList.append(params)
             # Set a timer for commit - if multiple ones have been added, they will be added together
@@ -262,18 +433,36 @@ class MySQLStatusReporter(Status.OnChangeStatusReporter, InternalDB.mysql, threa
                 self._addTimer = threading.Timer(0.5, self.commit_jobs)
                 self._addTimer.start()
 
-        try:
-            if 0:
-                if aux and aux != "none":
-                    SQL = "INSERT INTO status(timestamp, paramid, chanid, value, expires, aux) "\
-                        "VALUES (%s, %s, %s, %s, %s, %s)"
-                    params.append(aux)
-                else:
-                    SQL = "INSERT INTO status(timestamp, paramid, chanid, value, expires) "\
-                        "VALUES (%s, %s, %s, %s, %s)"
-                self._execute(SQL, params)
-        except Exception:
-            self.log.exception("Updating status information %s.%s" % (event.status_holder.get_name(), event.get_name()))
+    def _insert(self, entries, connection=None):
+        """
+        Insert rows of [timestamp, paramid, chanid, value, expires, aux]
+        in batches. Replay passes a direct connection - we want an error
+        rather than waiting in the queue if the database is unreachable.
+        Returns the number of entries inserted, which is less than all
+        of them if there was an error. Through the queue we also stop at
+        the first batch that timed out (it is still queued and will be
+        written, so it is counted as inserted) or when spool.max_latency
+        has passed, so a hanging database doesn't block the callers.
+        """
+        t = time.time()
+        for i in range(0, len(entries), 150):
+            batch = entries[i:i + 150]
+            SQL = "INSERT INTO status(timestamp, paramid, chanid, value, expires, aux) VALUES "
+            SQL += ",".join(["(%s, %s, %s, %s, %s, %s)"] * len(batch))
+            args = []
+            for entry in batch:
+                args.extend(entry)
+            try:
+                self._execute(SQL, args, insist_direct=connection is not None, connection=connection)
+            except InternalDB.TooSlowException as e:
+                self.log.warning("Slow status updates: %s" % e)
+                return i + len(batch)
+            except Exception as e:
+                self.log.warning("Failed to write status updates: %s" % e)
+                return i
+            if connection is None and time.time() - t > self.cfg["spool.max_latency"]:
+                return i + len(batch)
+        return len(entries)
 
     def commit_jobs(self):
         """
@@ -285,19 +474,25 @@ class MySQLStatusReporter(Status.OnChangeStatusReporter, InternalDB.mysql, threa
                 # print("*** WARNING: commit_jobs called but no queued jobs")
                 return
 
-            SQL = "INSERT INTO status(timestamp, paramid, chanid, value, expires, aux) VALUES "
-            args = []
-            for entry in self._addList:
-                SQL += "(%s, %s, %s, %s, %s, %s),"
-                args.extend(entry)
-
-                if len(args) > 1000:
-                    self._execute(SQL[:-1], args)
-                    SQL = "INSERT INTO status(timestamp, paramid, chanid, value, expires, aux) VALUES "
-                    args = []
-            if len(args) > 0:
-                self._execute(SQL[:-1], args)
+            entries = self._addList
             self._addList = []
+            with self._spool_lock:
+                if self._spooling:
+                    # Keep the order, don't write past spooled updates
+                    for entry in entries:
+                        self._spool.append(["id"] + entry)
+                    return
+
+            t = time.time()
+            inserted = self._insert(entries)
+            if inserted < len(entries) or time.time() - t > self.cfg["spool.max_latency"]:
+                self.log.warning("Slow or unavailable database (%.1fs), spooling status updates for a while" %
+                                 (time.time() - t))
+                with self._spool_lock:
+                    self._last_replay = time.time()
+                    self._spooling = True
+                    for entry in entries[inserted:]:
+                        self._spool.append(["id"] + entry)
 
 if __name__ == "__main__":
     import sys
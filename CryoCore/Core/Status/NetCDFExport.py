@@ -105,11 +105,14 @@ class NetCDFExport(PostgresStatusReporter):
             if self._select_name:
                 SQL += " name='%s'" % self._select_name
 
-        cursor = self._get_db().cursor()
+        # Named (server side) cursor, rows are transferred itersize at the
+        # time rather than the whole table at once
+        cursor = self._get_db().cursor(name="netcdf_export_samples")
+        cursor.itersize = 10000
         cursor.execute(SQL)
         i = 0
         should_exit = False
-        for (id, timestamp, channel, name, value) in cursor.fetchall():
+        for (id, timestamp, channel, name, value) in cursor:
             self._timestamp[i] = timestamp
 
             illegal_chars = {" ": "_",
@@ -0,0 +1,71 @@
+"""
+Framing of the remote status protocol (RemoteStatusReporter and
+RemoteStatusHolder).
+
+Every message is a frame: a 4 byte big endian length followed by that
+many bytes of UTF-8 encoded JSON. Frames never depend on how the stream
+is split into reads, the receiver keeps incomplete frames in a
+FrameDecoder until the rest arrives.
+
+Requests from the client:
+  {"cmd": "SUBSCRIBE", "param": "holder.name" or "all",
+   "type": "once" | "onchange" | "periodic", "interval": seconds}
+  {"cmd": "UNSUBSCRIBE", "param": "holder.name" or "all"}
+  {"cmd": "LIST", "id": request id}
+
+Messages from the server:
+  {"updates": [["holder.name", timestamp, value], ...]}
+  {"list": ["holder.name", ...], "id": request id}
+"""
+import json
+import struct
+
+HEADER = struct.Struct("!I")
+
+# Refuse frames larger than this, the stream is garbage if we get one
+MAX_FRAME_SIZE = 16 * 1048576
+
+
+def encode(message):
+    """
+    Return message (JSON serializable, anything else is sent as a
+    string) as a frame
+    """
+    payload = json.dumps(message, default=str).encode("utf-8")
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Reassemble frames from a stream of bytes
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add received data, returns the messages completed by it
+        """
+        self._buffer.extend(data)
+        messages = []
+        pos = 0
+        while len(self._buffer) - pos >= HEADER.size:
+            (length, ) = HEADER.unpack_from(self._buffer, pos)
+            if length > self.max_frame_size:
+                raise Exception("Bad frame, %d bytes is too large" % length)
+            if len(self._buffer) - pos - HEADER.size < length:
+                break
+            start = pos + HEADER.size
+            messages.append(json.loads(self._buffer[start:start + length].decode("utf-8")))
+            pos = start + length
+        if pos:
+            del self._buffer[:pos]
+        return messages
+
+    def pending(self):
+        """
+        Number of bytes waiting for the rest of a frame
+        """
+        return len(self._buffer)
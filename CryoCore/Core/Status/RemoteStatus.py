@@ -5,31 +5,79 @@ will only transfer data when needed.
 
 It supports a very similar interface as the normal status object.
 
+All RemoteStatusHolders for the same address share one connection
+(see get_connection). A single thread waits for data with a selector
+and decodes frames as they arrive (see RemoteProtocol), partial frames
+are kept until the rest is received. Updates are handed to the holders
+that subscribed to them, and the reporter only sees one subscription
+per parameter. The reporter unsubscribes per element name ("all" drops
+everything), so an element is only unsubscribed when no remaining
+subscription covers it. Subscriptions are sent again if the connection
+is re-established. The connection stops when its last holder stops.
+
 """
 
+import selectors
+import socket
 import threading as threading
+import time
 
-from CryoCore.Core import Status
+from CryoCore.Core import API, Status
+from CryoCore.Core.Status import RemoteProtocol
 
-import time
-import socket
+_connections = {}
+_connections_lock = threading.Lock()
 
 
-class Connector:
+def get_connection(address, holder):
     """
-    The connector creates a connection to a remote
-    status object. It will automatically connect and
-    reconnect, but will throw exceptions if reconnection is not
-    possible
+    Return the (shared) connection to the remote status reporter at
+    address (host, port) for holder, which must call remove_holder()
+    when done with it
     """
-    def __init__(self, addr, default_timeout=2.0,
-                 max_reconnects=10):
+    address = (address[0], int(address[1]))
+    with _connections_lock:
+        if address not in _connections or _connections[address].stop_event.is_set():
+            _connections[address] = RemoteConnection(address)
+        _connections[address]._holders.add(holder)
+        return _connections[address]
+
+
+class RemoteConnection(threading.Thread):
+    """
+    A connection to a remote status reporter, multiplexing the
+    subscriptions of any number of holders. It connects and reconnects
+    automatically.
+    """
+
+    def __init__(self, addr, default_timeout=2.0, reconnect_interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
         self.addr = addr
         self.default_timeout = default_timeout
+        self.reconnect_interval = reconnect_interval
+        self.stop_event = threading.Event()
+        self.log = API.get_log("RemoteStatus")
+
+        self.socket = None
         self.connected = False
+        self._decoder = None
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.RLock()
+        self._send_lock = threading.Lock()
+        # (param, type, interval) -> set of holders
+        self._subscriptions = {}
+        # param -> set of holders waiting for a "once" update
+        self._once = {}
+        # LIST request id -> [event, reply]
+        self._requests = {}
+        self._next_id = 0
+        # Holders using this connection (see get_connection)
+        self._holders = set()
+        # Names of elements we have received updates for
+        self._names = set()
 
-        self.max_reconnects = max_reconnects
-        self._reconnects = 0
+        self.start()
 
     def _connect(self):
         for res in socket.getaddrinfo(self.addr[0],
@@ -37,77 +85,208 @@ class Connector:
                                       socket.AF_UNSPEC,
                                       socket.SOCK_STREAM):
             af, socktype, proto, canonname, sa = res
-            self.socket = socket.socket(af, socktype, proto)
-            self.socket.settimeout(self.default_timeout)
-            # self.socket.setblocking(False)
+            s = socket.socket(af, socktype, proto)
+            s.settimeout(self.default_timeout)
             try:
-                self.socket.connect(sa)
-                print("Connected to remote status at", self.addr)
-                self.connected = True
-                return self.socket
+                s.connect(sa)
             except:
-                pass
+                s.close()
+                continue
+            self.log.info("Connected to remote status at %s" % str(self.addr))
+            with self._lock:
+                self.socket = s
+                self._decoder = RemoteProtocol.FrameDecoder()
+                self._selector.register(s, selectors.EVENT_READ)
+                self.connected = True
+                # Subscribe again (or for the first time)
+                for (param, type, interval) in list(self._subscriptions.keys()):
+                    self._send({"cmd": "SUBSCRIBE", "param": param, "type": type, "interval": interval})
+                for param in list(self._once.keys()):
+                    self._send({"cmd": "SUBSCRIBE", "param": param, "type": "once"})
+            return
 
         raise Exception("Could not connect to %s" % str(self.addr))
 
-    def recv(self, bytes, timeout=None):
-        error = None
-        for i in range(0, self.max_reconnects):
+    def close(self):
+        with self._lock:
+            if self.socket is None:
+                return
+            self.connected = False
             try:
-                if not self.connected:
-                    last_op = "connecting"
-                    self._connect()
-                if timeout:
-                    self.socket.settimeout(timeout)
-                else:
-                    self.socket.settimeout(self.default_timeout)
+                self._selector.unregister(self.socket)
+            except:
+                pass
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+                self.socket.close()
+            except:
+                pass
+            self.socket = None
 
-                last_op = "receiving"
-                return self.socket.recv(bytes)
-            except socket.timeout as e:
-                return ""
-            except Exception as e:
-                error = str(e)
-                # Lost connection, try to reconnect
-                print("Lost connection %s, retrying (%s)" % (last_op, str(e)))
-                self.close()
+    def stop(self):
+        self.stop_event.set()
 
-        raise Exception("Network connectivity issues receiving from %s: %s" %
-                        (self.addr, error))
+    def _send(self, message):
+        """
+        Send a message if connected, anything that matters is sent again
+        when connecting
+        """
+        if not self.connected:
+            return
+        try:
+            with self._send_lock:
+                self.socket.sendall(RemoteProtocol.encode(message))
+        except Exception as e:
+            self.log.warning("Lost connection to %s sending (%s)" % (str(self.addr), e))
+            self.close()
 
-    def send(self, buffer, timeout=None):
-        error = None
-        for i in range(0, self.max_reconnects):
-            try:
-                if not self.connected:
-                    last_op = "connecting"
-                    self._connect()
+    def subscribe(self, holder, param, type="onchange", interval=""):
+        """
+        Subscribe holder to updates of param.
+        type can be "once", "onchange" or "periodic".
+        "periodic" also needs an interval
+        """
+        with self._lock:
+            if type == "once":
+                self._once.setdefault(param, set()).add(holder)
+                self._send({"cmd": "SUBSCRIBE", "param": param, "type": type})
+                return
+            key = (param, type, interval)
+            if key not in self._subscriptions:
+                self._subscriptions[key] = set()
+                self._send({"cmd": "SUBSCRIBE", "param": param, "type": type, "interval": interval})
+            elif holder not in self._subscriptions[key]:
+                # Already subscribed by others, just get the current value
+                self._send({"cmd": "SUBSCRIBE", "param": param, "type": "once"})
+            self._subscriptions[key].add(holder)
+
+    def _covered(self, name):
+        """
+        True if a subscription still covers the element name
+        """
+        for key in self._subscriptions:
+            if key[0] == name or key[0].lower() == "all":
+                return True
+        return False
 
-                if timeout:
-                    self.socket.settimeout(timeout)
+    def unsubscribe(self, holder, param=None):
+        """
+        Stop sending updates of param (default all parameters) to holder.
+        The remote is told about the elements no subscription covers
+        anymore.
+        """
+        with self._lock:
+            removed = []
+            for key in list(self._subscriptions.keys()):
+                if param is not None and key[0] != param:
+                    continue
+                self._subscriptions[key].discard(holder)
+                if len(self._subscriptions[key]) == 0:
+                    del self._subscriptions[key]
+                    removed.append(key[0])
+            for p in list(self._once.keys()):
+                if param is None or p == param:
+                    self._once[p].discard(holder)
+                    if len(self._once[p]) == 0:
+                        del self._once[p]
+
+            if not removed:
+                return
+            if len(self._subscriptions) == 0:
+                self._send({"cmd": "UNSUBSCRIBE", "param": "all"})
+                return
+            names = set()
+            for p in removed:
+                if p.lower() == "all":
+                    names.update(self._names)
                 else:
-                    self.socket.settimeout(self.default_timeout)
+                    names.add(p)
+            for name in names:
+                if not self._covered(name):
+                    self._send({"cmd": "UNSUBSCRIBE", "param": name})
 
-                last_op = "sending"
-                return self.socket.send(buffer)
-            except Exception as e:
-                error = str(e)
-                # Lost connection, try to reconnect
-                print("Lost connection %s, retrying (%s)" % (last_op, str(e)))
-                self.close()
-        raise Exception("Network connectivity issues sending to %s: %s" %
-                        (self.addr, error))
+    def remove_holder(self, holder):
+        """
+        The holder is done, stop the connection if it was the last one
+        """
+        self.unsubscribe(holder)
+        with _connections_lock:
+            self._holders.discard(holder)
+            if len(self._holders) == 0:
+                self.stop()
 
-    def close(self):
+    def list(self, timeout=10.0):
+        """
+        Return the names of all status elements of the remote
+        """
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            request = [threading.Event(), None]
+            self._requests[request_id] = request
         try:
-            self.connected = False
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
-        except:
-            pass
+            end_by = time.time() + timeout
+            while not self.stop_event.is_set() and time.time() < end_by:
+                if not self.connected:
+                    time.sleep(0.1)
+                    continue
+                self._send({"cmd": "LIST", "id": request_id})
+                if request[0].wait(max(0, min(timeout, end_by - time.time()))):
+                    return request[1]
+            raise Exception("No list of status elements from %s" % str(self.addr))
+        finally:
+            with self._lock:
+                del self._requests[request_id]
 
+    def _dispatch(self, message):
+        """
+        Hand a received message to whoever wants it
+        """
+        if "list" in message:
+            with self._lock:
+                if message.get("id") in self._requests:
+                    request = self._requests[message["id"]]
+                    request[1] = message["list"]
+                    request[0].set()
+            return
+
+        for name, ts, value in message.get("updates", []):
+            with self._lock:
+                self._names.add(name)
+                holders = set(self._once.pop(name, []))
+                for (param, type, interval), subscribers in self._subscriptions.items():
+                    if param == name or param.lower() == "all":
+                        holders.update(subscribers)
+            for holder in holders:
+                holder._deliver(name, ts, value)
+
+    def run(self):
+        while not self.stop_event.is_set() and not API.api_stop_event.is_set():
+            if not self.connected:
+                try:
+                    self._connect()
+                except Exception as e:
+                    self.log.debug("Connecting to %s failed (%s), retrying" % (str(self.addr), e))
+                    self.stop_event.wait(self.reconnect_interval)
+                    continue
+
+            try:
+                for key, mask in self._selector.select(0.5):
+                    data = self.socket.recv(65536)
+                    if not data:
+                        raise Exception("Connection closed by remote")
+                    for message in self._decoder.feed(data):
+                        self._dispatch(message)
+            except Exception as e:
+                if not self.stop_event.is_set():
+                    self.log.warning("Lost connection to %s (%s), reconnecting" % (str(self.addr), e))
+                self.close()
+        self.stop_event.set()  # Also when the API stopped, nobody waits for us anymore
+        self.close()
+        self._selector.close()
 
-class RemoteStatusHolder(Status.StatusHolder, threading.Thread):
+
+class RemoteStatusHolder(Status.StatusHolder):
 
     def __init__(self, name, address, stop_event=None):
         """
@@ -116,23 +295,52 @@ class RemoteStatusHolder(Status.StatusHolder, threading.Thread):
         but rather request the remote status of a module from
         the status service which will instantiate this object.
         """
-        threading.Thread.__init__(self)
         if not stop_event:
-            self.stop_event = threading.Event()
-        else:
-            self.stop_event = stop_event
-        Status.StatusHolder.__init__(self, name, self.stop_event)
-
-        self.conn = Connector(address)
-        # Lock access to the connector
-        self.conn_lock = threading.Lock()
+            stop_event = threading.Event()
+        Status.StatusHolder.__init__(self, name, stop_event)
 
-        self.start()
+        # Notified whenever an element is updated or added
+        self._arrival = threading.Condition()
+        self.conn = get_connection(address, self)
 
     def stop(self):
+        self.conn.remove_holder(self)
         self.stop_event.set()
+        Status.StatusHolder.stop(self)
+
+    def _deliver(self, name, timestamp, value):
+        """
+        An update was received (called by the connection)
+        """
+        elem = Status.RemoteStatusElement(name, self, timestamp=timestamp,
+                                          initial_value=value)
+        with self._arrival:
+            with self._status_lock:
+                self._add_element(elem)
+            self._arrival.notify_all()
+
+    def _wait_for(self, key, timeout=None):
+        """
+        Block until the status element is available or until timeout
+        seconds have expired. If None, block until stopped
+        """
+        if timeout:
+            end_by = time.time() + timeout
+        with self._arrival:
+            while key not in self.elements:
+                if self.stop_event.is_set():
+                    raise Status.NoSuchElementException("Stopped waiting for status element %s" % key)
+                if self.conn.stop_event.is_set():
+                    raise Status.NoSuchElementException("Connection stopped waiting for status element %s" % key)
+                wait = 1.0  # Look at the stop event now and then
+                if timeout:
+                    wait = min(wait, end_by - time.time())
+                    if wait <= 0:
+                        raise Status.NoSuchElementException("Status element %s not available" % key)
+                self._arrival.wait(wait)
+            return self.elements[key]
 
-    def get_or_create_status_element(self, key):
+    def get_or_create_status_element(self, key, expire_time=None):
         """
         Overload the get function to get a remote status element.
         This function is not recommended used over shaky networks.
@@ -144,12 +352,7 @@ class RemoteStatusHolder(Status.StatusHolder, threading.Thread):
         does!
         """
         self._subscribe(key)
-
-        # Block until the status element is available
-        while key not in self.elements and not self.stop_event.is_set():
-            time.sleep(0.1)
-
-        return self.elements[key]
+        return self._wait_for(key)
 
     def _subscribe(self, _key, _type="onchange", interval=""):
         """
@@ -157,16 +360,14 @@ class RemoteStatusHolder(Status.StatusHolder, threading.Thread):
         type can be "once", "onchange" or "periodic".
         "periodic" also needs an interval
         """
-        msg = ["SUBSCRIBE", _key, _type, str(interval)]
-        self.conn.send("|".join(msg) + "\n")
+        self.conn.subscribe(self, _key, _type, interval)
 
     def _unsubscribe(self, element):
         """
         Stop subscribing to updates.  Typically called by
         RemoteElement.__del__
         """
-        msg = ["UNSUBSCRIBE", key]
-        self.conn.send("|".join(msg) + "\n")
+        self.conn.unsubscribe(self, element.get_name())
 
     def get_remote(self, key, type="onchange", interval="", timeout=None):
         """
@@ -178,17 +379,8 @@ class RemoteStatusHolder(Status.StatusHolder, threading.Thread):
         Blocks until the status element is available or until timeout
         seconds have expired. If None, block for ever
         """
-        if timeout:
-            end_by = time.time() + timeout
-
         self._subscribe(key, type, interval)
-
-        while key not in self.elements and not self.stop_event.is_set():
-            if timeout and time.time() > end_by:
-                raise NoSuchElementException("Status element %s not available" % key)
-            time.sleep(0.1)
-
-        return self.elements[key]
+        return self._wait_for(key, timeout)
 
     def list_status_elements(self):
         """
@@ -196,54 +388,4 @@ class RemoteStatusHolder(Status.StatusHolder, threading.Thread):
         not particularly efficient, so it should be used as seldom
         as possible.
         """
-        elements = []
-        self.conn_lock.acquire()
-        try:
-            self.conn.send("LIST\n")
-            buf = ""
-            while not self.stop_event.is_set():
-                buf += self.conn.recv(1024)
-                if not buf:
-                    break
-                lines = buf.split("\n")
-                for line in lines:
-                    if not line.strip():
-                        # Empty line - we're done
-                        continue
-                    elem = self.deserialize(line)
-                    if elem:
-                        elements.append(elem.get_name())
-
-                buf = ""
-                if len(lines) > 0 and len(lines[-1]) > 0:
-                    if lines[-1][-1] != "\n":  # Incomplete last line
-                        buf = lines[-1]
-        finally:
-            self.conn_lock.release()
-        return elements
-
-    def stop(self):
-        self.stop_event.set()
-
-    def run(self):
-
-        while not self.stop_event.is_set():
-
-            self.conn_lock.acquire()
-            try:
-                buf = self.conn.recv(10240, timeout=0.5)
-                if not buf:
-                    continue
-
-                for line in buf.split("\n"):
-                    if not line.strip():
-                        continue
-                    elem = self.deserialize(line)
-                    self._add_element(elem)
-            # except:
-            #    self.log.exception("Ignoring exception in main-loop")
-
-            finally:
-                self.conn_lock.release()
-                time.sleep(0.1)  # Let someone else get the lock
-        self.conn.close()
+        return self.conn.list()
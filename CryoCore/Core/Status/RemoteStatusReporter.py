@@ -1,52 +1,73 @@
-import time
-import socket
-import select
+"""
+Serve status elements to RemoteStatusHolders over TCP.
+
+The server runs an asyncio event loop in its own thread. Messages are
+length prefixed frames (see RemoteProtocol). Status callbacks never
+touch the network: an update is put in the client's outbound queue,
+which keeps only the latest value of each element, and a writer task
+per client sends everything queued in one batch. A client that does
+not keep up (the queue or the socket buffer grows too large, or a
+write doesn't complete within send_timeout) is disconnected, so a slow
+subscriber never holds back status reporting.
+"""
+import asyncio
 import random
+import socket
 import threading as threading
+from collections import OrderedDict
 
-import queue
-
-from CryoCore.Core import API,Status
+from CryoCore.Core import API, Status
 from CryoCore.Core.Status import *
+from CryoCore.Core.Status import RemoteProtocol
 
-# Index
-TIME = 0
-PARAM = 1
-SOCKET = 2
-TYPE = 3
-INTERVAL = 4
-
-def by_due_time(a, b):
-    """
-    Sort a list of requests by time, soonest first
-    """
-    return a[TIME] <= b[TIME]
 
 class NetworkException(Exception):
     pass
 
+
 class NoSuchHolderException(Exception):
     pass
 
+
+class _Client:
+    """
+    A connected client and its outbound queue
+    """
+
+    def __init__(self, addr, writer):
+        self.addr = addr
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()  # full name -> [name, ts, value]
+        self.messages = []  # Other messages, e.g. LIST replies
+        self.wakeup = asyncio.Event()
+        self.signalled = False
+        self.closed = False
+        self.onchange = {}  # full name -> element
+        self.periodic = {}  # full name -> task
+
+
 class RemoteStatusReporter(Status.OnChangeStatusReporter, threading.Thread):
 
-    PROTOCOL = socket.AF_UNSPEC # AF_INET for IPv4 only, AF_UNSPEC for any
-    
+    PROTOCOL = socket.AF_UNSPEC  # AF_INET for IPv4 only, AF_UNSPEC for any
+
     def __init__(self, name, stop_event=None):
         threading.Thread.__init__(self)
-        
+
         Status.OnChangeStatusReporter.__init__(self, name)
-        
+
         self.name = name
-        
-        #self.cfg = API.get_config(self.name)
 
         self.cfg = API.get_config("System.Status.RemoteStatusReporter")
         self.cfg.require(["port"])
+        self.cfg.set_default("max_queue", 10000)
+        self.cfg.set_default("max_buffer", 4194304)
+        self.cfg.set_default("send_timeout", 5.0)
+        self.cfg.set_default("batch_delay", 0.01)
+        self.cfg.set_default("batch_size", 1000)
 
         self.log = API.get_log(self.name)
-        #self.status = API.get_status(self.name)
-        
+
         self.port = None
 
         if not stop_event:
@@ -54,16 +75,15 @@ class RemoteStatusReporter(Status.OnChangeStatusReporter, threading.Thread):
         else:
             self.stop_event = stop_event
         self.lock = threading.Lock()
-        
-        self._addresses = {}
-        self._requests = []
-        
+
+        self.loop = None
+        self.clients = []
+
         self._setup_network()
 
         self._register()
-        
-        self.start()
 
+        self.start()
 
     def _register(self):
         """
@@ -76,16 +96,16 @@ class RemoteStatusReporter(Status.OnChangeStatusReporter, threading.Thread):
         Unregister with on-board status service
         """
         pass
-        
+
     def _setup_network(self):
         """
         Create a TCP socket that accepts a connection.
-        
-        If the config parameter 'port' is "auto", it will find one, otherwise it will 
+
+        If the config parameter 'port' is "auto", it will find one, otherwise it will
         try to use the provided port
 
         """
-        
+
         max_retries = 100
         while True:
             max_retries -= 1
@@ -98,109 +118,136 @@ class RemoteStatusReporter(Status.OnChangeStatusReporter, threading.Thread):
                     self.port = random.randint(1500, 65000)
                 else:
                     self.port = int(self.cfg["port"])
-                    
-                for res in socket.getaddrinfo(None, 
-                                              self.port, 
-                                              socket.AF_UNSPEC,
+
+                for res in socket.getaddrinfo(None,
+                                              self.port,
+                                              self.PROTOCOL,
                                               socket.SOCK_STREAM, 0,
                                               socket.AI_PASSIVE):
-                    
+
                     af, socktype, proto, canonname, sa = res
-                    self.log.info("Remote status reporter listening on %s"% str(sa))
+                    self.log.info("Remote status reporter listening on %s" % str(sa))
                     self.socket = socket.socket(af, socktype, proto)
+                    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                     self.socket.bind(sa)
-                    self.socket.listen(1)
+                    self.socket.listen(16)
+                    self.socket.setblocking(False)
                     return
             except:
                 if not self.cfg["port"] == "auto":
                     self.port = None
                     raise Exception("Could not set up network!")
-                    
 
     def get_port(self):
         return self.port
-    
+
     def stop(self):
         self.stop_event.set()
 
     def run(self):
         """
-        Thread entrypoint - Accept connections from multiple
-        remote status wrappers.  Will accept both SUBCRIBE and
-        UNSUBSCRIBE messages from remote nodes and push status
-        updates accordingly.
+        Thread entrypoint - serve clients until stopped
+        """
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._serve())
+        except:
+            self.log.exception("Remote status server failed")
+        finally:
+            self.loop.close()
+        self._unregister()
 
-        message is SUBSCRIBE|PARAM|TYPE|INTERVAL or UNSUBSCRIBE|PARAM
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle_client, sock=self.socket)
+        try:
+            while not self.stop_event.is_set():
+                await asyncio.sleep(0.5)
+        finally:
+            server.close()
+            for client in self.clients[:]:
+                self._lost_connection(client)
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await server.wait_closed()
+
+    async def _handle_client(self, reader, writer):
+        """
+        Read and handle the requests of one client
+        """
+        addr = writer.get_extra_info("peername")
+        self.log.info("Accepted connection from %s" % str(addr))
+        client = _Client(addr, writer)
+        with self.lock:
+            self.clients.append(client)
+        sender = asyncio.ensure_future(self._sender(client))
+        decoder = RemoteProtocol.FrameDecoder()
+        try:
+            while not client.closed:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    try:
+                        self._handle_request(client, message)
+                    except NoSuchHolderException as e:
+                        self.log.error("Ignoring request: %s" % e)
+                    except:
+                        self.log.exception("Processing request from %s" % str(addr))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except:
+            self.log.exception("Bad data from %s, disconnecting" % str(addr))
+        finally:
+            self._lost_connection(client)
+            sender.cancel()
 
-        The PARAM must be in holder.name format
-        
+    async def _sender(self, client):
         """
+        Send whatever is queued for the client, in batches
+        """
+        try:
+            while not client.closed:
+                await client.wakeup.wait()
+                client.wakeup.clear()
+                # Let more updates pile up and go in the same write
+                await asyncio.sleep(self.cfg["batch_delay"])
+                with client.lock:
+                    updates = list(client.pending.values())
+                    client.pending.clear()
+                    messages = client.messages
+                    client.messages = []
+                    client.signalled = False
+
+                batch_size = self.cfg["batch_size"]
+                frames = [RemoteProtocol.encode(m) for m in messages]
+                for i in range(0, len(updates), batch_size):
+                    frames.append(RemoteProtocol.encode({"updates": updates[i:i + batch_size]}))
+                if not frames or client.closed:
+                    continue
+                client.writer.write(b"".join(frames))
+                if client.writer.transport.get_write_buffer_size() > self.cfg["max_buffer"]:
+                    self._drop(client, "send buffer full")
+                    return
+                try:
+                    await asyncio.wait_for(client.writer.drain(), self.cfg["send_timeout"])
+                except asyncio.TimeoutError:
+                    self._drop(client, "send timed out")
+                    return
+        except asyncio.CancelledError:
+            pass
+        except ConnectionError:
+            self._lost_connection(client)
+        except:
+            self.log.exception("Sending to %s" % str(client.addr))
+            self._lost_connection(client)
 
-        self.clients = []
-        while not self.stop_event.is_set():
+    async def _periodic(self, client, element, interval):
+        while not client.closed:
+            self._send_update(element, client)
+            await asyncio.sleep(interval)
 
-            try:
-                # Check for new incoming connections
-                (r,w,e) = select.select([self.socket] + self.clients,
-                                        [], [], 0.5)
-                
-                if len(r) > 0:
-                    # We got something!
-                    for source in r:
-                        if source == self.socket:
-                            # Accept new connection
-                            (new_conn, addr) = self.socket.accept()
-                            self.log.info("Accepted connection from %s"% \
-                                          str(addr))
-                            self._addresses[new_conn] = addr
-                            #new_conn.setblocking(False)
-                            self.clients.append(new_conn)
-                            
-                        else:
-                            # Remote status request
-                            try:
-                                self._parse_request(source)
-                            except NetworkException:
-                                self._lost_connection(source)
-                                continue
-                            
-                # Done listening - should I send any changes to anyone?
-                now = time.time()
-                updates = []
-                self.lock.acquire()
-                try:
-                    if len(self._requests) == 0:
-                        continue
-
-                    # Sort the requests by due time - soonest first
-                    self._requests.sort()
-
-                    while float(self._requests[0][TIME]) <= now:
-                        req =  self._requests.pop(0)
-                        #if req[TYPE] == "periodic": # All are periodic...
-                        # Update the req and add it back - the
-                        # list will be sorted by time after this loop
-                        new_time = float(req[TIME]) + float(req[INTERVAL])
-                        self._requests.append((new_time, ) + req[1:])
-                        
-                        holder, name = self._split_param(req[PARAM])
-                        elem = self.status_holders[holder][name]
-                        if not elem:
-                            self.log.error("Unknown parameter should be reported: %s"%param)
-                            continue
-                        updates.append((elem, req[SOCKET]))
-                finally:
-                    self.lock.release()
-
-                # Perform the actual reporting
-                for (elem, socket) in updates:
-                    self._send_update(elem, socket)
-                    
-            except:
-                self.log.exception("Error status reporting")
-                        
-        self._unregister()
-        
     def _split_param(self, param):
         """
         Split the param into holder,name.  Require the holder
@@ -212,159 +259,145 @@ class RemoteStatusReporter(Status.OnChangeStatusReporter, threading.Thread):
         while True:
             pos = param.find(".", idx)
             if pos == -1:
-                raise NoSuchHolderException("Unknown holder for %s"% param)
-            
+                raise NoSuchHolderException("Unknown holder for %s" % param)
+
             if param[:pos] in list(self.status_holders.keys()):
-                return (param[:pos], param[pos+1:])
+                return (param[:pos], param[pos + 1:])
 
             # This was not a holder, try next "."
             idx = pos + 1
-            
-        raise NoSuchHolderException("Unknown holder for %s"% param)
-    
 
-    def _parse_request(self, socket):
+    def _get_elements(self, param):
+        """
+        Return [(full name, element)] for param ("holder.name" or "all")
         """
-        Data is available from a client - read and parse the
-        request and set up any requests to be handled
+        if param.lower() == "all":
+            elements = []
+            for holder in list(self.status_holders.values()):
+                for name in holder.list_status_elements():
+                    elements.append((holder.get_name() + "." + name, holder[name]))
+            return elements
+
+        holder, name = self._split_param(param)
+        if not self.status_holders[holder].has_key(name):
+            raise NoSuchHolderException("Unknown parameter '%s'" % param)
+        return [(param, self.status_holders[holder][name])]
+
+    def _handle_request(self, client, request):
+        """
+        Handle a request, runs in the event loop.
 
-        Format is PARAM|TYPE|ARGUMENT\n where ARGUMENT
-        can be blankm but there must be two pipes pr line.
         Type must be one of 'periodic', "once", or "onchange"
-
         """
+        cmd = request.get("cmd")
+        if cmd == "SUBSCRIBE":
+            type = request.get("type", "onchange")
+            if type not in ["once", "onchange", "periodic"]:
+                self.log.error("Bad request type '%s', expected one of 'once', 'onchange' or 'periodic'" % type)
+                return
+            for full_name, elem in self._get_elements(request["param"]):
+                if type == "onchange" and full_name not in client.onchange:
+                    try:
+                        elem.add_callback(self._send_update, client)
+                    except Exception:
+                        pass  # Already registered
+                    client.onchange[full_name] = elem
+                elif type == "periodic" and full_name not in client.periodic:
+                    interval = float(request.get("interval") or 1.0)
+                    client.periodic[full_name] = asyncio.ensure_future(self._periodic(client, elem, interval))
+                    continue  # Sent by the periodic task
+                self._send_update(elem, client)
+            self.log.debug("Got subscribe '%s' on %s" % (type, request["param"]))
+
+        elif cmd == "UNSUBSCRIBE":
+            self.log.debug("Got unsubscribe %s" % request["param"])
+            param = request["param"]
+            for full_name in list(client.onchange.keys()) + list(client.periodic.keys()):
+                if param.lower() == "all" or full_name == param:
+                    self._unsubscribe(client, full_name)
+
+        elif cmd == "LIST":
+            self.log.debug("Got LIST request")
+            names = [full_name for full_name, elem in self._get_elements("all")]
+            self._queue_message(client, {"list": names, "id": request.get("id")})
 
-        # Assume we get less than 10k of requests
-        try:
-            data = socket.recv(10240)
-        except Exception as e:
-            raise NetworkException(e)
-
-        if not data:
-            return
-
-        try:
-            for line in data.split("\n"):
-                if not line.strip(): # Skip any blank lines
-                    continue
-                
-                try:
-                    command = line.split("|")
-                except:
-                    self.log.error("Bad request: '%s'"%line)
-                    continue
+        else:
+            self.log.error("Bad request '%s'" % str(request))
 
-                if command[0] == "SUBSCRIBE":
-                    
-                    (cmd, param, type, arg) = command
-                    if param.lower() == "all":
-                        for holder in list(self.status_holders.keys()):
-                            for name in list(self.status_holders[holder].keys()):
-                                if type == "onchange":
-                                    self.status_holders[holder][name].add_callback(self._send_update, socket)
-                                    self._send(self.status_holders[holder][name], socket)
-                                elif type == "periodic":
-                                    req = (time.time(), holder + "." + name, socket, type, arg)
-                        continue
-
-                    holder,name = self._split_param(param)
-                    
-                    elem = self.status_holders[holder][name]
-                    if not elem:
-                        self.log.error("Ignoring request for unknown parameter '%s'"%param)
-                        continue
-
-                    if type == "once":
-                        self._send_update(elem, socket)
-                    elif type == "onchange":
-                        # TODO: Do this asynchronously? Is a nonblocking socket
-                        elem.add_callback(self._send_update, socket)
-                        self._send_update(elem, socket)
-                    elif type == "periodic":
-                        self.lock.acquire()
-                        try:
-                            req = (time.time(), param, socket, type, arg)
-                            # Will be sorted before reporting
-                            self._requests.append(req)
-                        finally:
-                            self.lock.release()
-                    else:
-                        self.log.error("Bad request type '%s', expected one of 'once', 'onchange' or 'periodic'"%type)
-                        continue
-                    
-                    self.log.debug("Got subscribe '%s' on %s"% (type, param))
-                    
-                elif command[0] == "UNSUBSCRIBE":
-
-                    (cmd, param) = command
-                    holder, name = self._split_param(param)
-                    elem = self.status_holders[holder][name]
-                    if not elem:
-                        self.log.error("Ignoring unsubscribe for unknown parameter '%s'"%param)
-                        continue
-
-                    self.log.debug("Got unsubscribe %s"% param)
-
-                    # Remove periodics
-                    self.lock.acquire()
-                    try:
-                        for req in self._requests:
-                            if req[PARAM] == param:
-                                self._requests.remove(req)
-                    finally:
-                        self.lock.release()
+    def _unsubscribe(self, client, full_name):
+        if full_name in client.periodic:
+            client.periodic.pop(full_name).cancel()
+        if full_name in client.onchange:
+            try:
+                client.onchange.pop(full_name).remove_callback(self._send_update, client)
+            except Exception:
+                pass
 
-                    # Remove callbacks
-                    try:
-                        elem.del_callback(self._send_update(socket))
-                    except:
-                        pass
-                elif command[0] == "LIST":
-                    self.log.debug("Got LIST request")
-                    for holder in list(self.status_holders.values()):
-                        for name in holder.list_status_elements():
-                            elem = holder[name]
-                            self._send_update(elem, socket)
-                    self.log.debug("LIST request OK")
-                        
-        except:
-            self.log.exception("Processing request from " + str(self._addresses[socket]))
+    def _drop(self, client, reason):
+        self.log.warning("Dropping slow client %s: %s" % (str(client.addr), reason))
+        self._lost_connection(client)
 
-    def _lost_connection(self, socket):
+    def _lost_connection(self, client):
         """
         Perform tasks to clean up after a node dissapeared
         """
-        # Remove periodics
-        self.lock.acquire()
+        if client.closed:
+            return
+        client.closed = True
+        for full_name in list(client.onchange.keys()) + list(client.periodic.keys()):
+            self._unsubscribe(client, full_name)
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        client.wakeup.set()
         try:
-            for req in self._requests:
-                if req[SOCKET] == socket:
-                    self._requests.remove(req)
-
-            if socket in self.clients:
-                self.clients.remove(socket)
-        finally:
-            self.lock.release()
-            
+            client.writer.close()
+        except:
+            pass
 
-    def _send_update(self, element, socket):
+    def _wakeup(self, client):
         """
-        Send the element on the given socket
+        Make the sender of the client run (any thread)
         """
-        # Serialize the element thingy
-        try:
-            socket.send(element.serialize() + "\n")
-        except:
-            self._lost_connection(socket)
-            self.log.exception("Sending update on '%s to %s"% \
-                               (element.get_name(),
-                                self._addresses[socket]))
+        if client.signalled:
+            return
+        client.signalled = True
+        self.loop.call_soon_threadsafe(client.wakeup.set)
+
+    def _queue_message(self, client, message):
+        with client.lock:
+            client.messages.append(message)
+            self._wakeup(client)
 
+    def _send_update(self, element, client):
+        """
+        Queue the element for sending to the client. Called from status
+        callbacks in any thread, never blocks. Only the latest value of
+        each element is kept.
+        """
+        if client.closed:
+            return
+        full_name = element.status_holder.get_name() + "." + element.get_name()
+        value = element.get_value()
+        if value.__class__ not in [int, float, bool, str] and value is not None:
+            value = str(value)
+        with client.lock:
+            if full_name in client.pending:
+                client.pending[full_name] = [full_name, element.get_timestamp(), value]
+                return
+            if len(client.pending) >= self.cfg["max_queue"]:
+                overflow = True
+            else:
+                overflow = False
+                client.pending[full_name] = [full_name, element.get_timestamp(), value]
+                self._wakeup(client)
+        if overflow:
+            self.loop.call_soon_threadsafe(self._drop, client, "queue full")
 
     def report(self, event):
         """
         Callback function to when an element has been updated
         """
 
-        # Silently ignore all these
+        # Silently ignore all these, updates are sent by per-client callbacks
         pass
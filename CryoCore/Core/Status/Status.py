@@ -1,3 +1,4 @@
+import os
 import threading
 import time
 
@@ -13,6 +14,10 @@ else:
 status_holders = {}
 status_lock = threading.Lock()
 
+# Shared DB reader for resuming values, created when first needed (per process)
+_status_reader = None
+_status_reader_lock = threading.Lock()
+
 
 # ===============================================================
 def get_status_holder(name, stop_event=None):
@@ -36,6 +41,15 @@ def get_status_holder(name, stop_event=None):
         return status_holders[name]
 
 
+def _get_status_reader():
+    global _status_reader
+    with _status_reader_lock:
+        if _status_reader is None or _status_reader[0] != os.getpid():
+            from CryoCore.Core.Status import StatusDbReader
+            _status_reader = (os.getpid(), StatusDbReader.StatusDbReader())
+        return _status_reader[1]
+
+
 class StatusException(Exception):
     pass
 
@@ -95,6 +109,7 @@ class StatusHolder(threading.Thread):
         self.elements = {}
         self.reporters = {}
         self.resumeValues = False
+        self._resume_values = None  # Last values of the whole channel, fetched once
 
         self._status_lock = threading.RLock()
 
@@ -318,9 +333,7 @@ class StatusHolder(threading.Thread):
         """
         assert name
         if self.resumeValues or fetch:
-            from CryoCore.Core.Status import StatusDbReader
-            db = StatusDbReader.StatusDbReader()
-            ts, value = db.get_last_status_value(self.name, name)
+            ts, value = self._get_resume_value(name, fetch)
             if ts and value:
                 if value.isdigit():
                     initial_value = int(value)
@@ -338,6 +351,22 @@ class StatusHolder(threading.Thread):
             self._add_element(new_element)
         return new_element
 
+    def _get_resume_value(self, name, fetch=False):
+        """
+        Return the last (timestamp, value) of an element from the database.
+        The values of the whole channel are fetched with one query the
+        first time, and later elements are served from that. If fetch is
+        true the current value is always read, the snapshot may be old.
+        """
+        if fetch:
+            return _get_status_reader().get_last_status_value(self.name, name)
+        with self._status_lock:
+            if self._resume_values is None:
+                self._resume_values = _get_status_reader().get_last_channel_values(self.name)
+            if name in self._resume_values:
+                return self._resume_values[name]
+        return (None, None)
+
     def add_status_element(self, element):
         """
         Add the L{StatusElement<StatusElement>} I {status_element} object. This status element can be
@@ -1,13 +1,87 @@
 import time
 from CryoCore.Core import API, InternalDB
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Columnar results not available
+
+
+class ColumnBuilder:
+    """
+    Build per-parameter columns (numpy arrays of timestamps and values)
+    from rows of (paramid, timestamp, value). Rows are converted every
+    chunk_size rows, so the intermediate python lists stay small.
+    Values are float64 if they all parse as numbers, otherwise object arrays.
+    """
+
+    def __init__(self, chunk_size=10000):
+        if numpy is None:
+            raise Exception("Columnar results require numpy")
+        self.chunk_size = chunk_size
+        self._pending = {}
+        self._num_pending = 0
+        self._chunks = {}
+
+    def add_rows(self, rows):
+        for paramid, ts, value in rows:
+            self.add(paramid, ts, value)
+
+    def add(self, paramid, ts, value):
+        if paramid not in self._pending:
+            self._pending[paramid] = ([], [])
+        self._pending[paramid][0].append(ts)
+        self._pending[paramid][1].append(value)
+        self._num_pending += 1
+        if self._num_pending >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        for paramid, (timestamps, values) in self._pending.items():
+            if paramid not in self._chunks:
+                self._chunks[paramid] = ([], [])
+            self._chunks[paramid][0].append(numpy.array(timestamps, dtype=numpy.float64))
+            self._chunks[paramid][1].append(_to_value_array(values))
+        self._pending = {}
+        self._num_pending = 0
+
+    def get_columns(self):
+        """
+        Return a map paramid -> (timestamps, values)
+        """
+        self._flush()
+        columns = {}
+        for paramid, (ts_chunks, value_chunks) in self._chunks.items():
+            if len(ts_chunks) == 1:
+                columns[paramid] = (ts_chunks[0], value_chunks[0])
+            else:
+                columns[paramid] = (numpy.concatenate(ts_chunks), numpy.concatenate(value_chunks))
+        return columns
+
+
+def _to_value_array(values):
+    try:
+        return numpy.array(values, dtype=numpy.float64)
+    except (ValueError, TypeError):
+        return numpy.array(values, dtype=object)
+
+
+class IdCache:
+    """
+    Process wide cache of status ids, shared by all readers and the
+    MySQL status reporter. Ids never change once created, so entries
+    are never invalidated.
+    """
+    channels = {}    # channel name -> chanid
+    parameters = {}  # (channel name, parameter name) -> paramid
+
 
 class StatusDbReader(InternalDB.mysql):
 
     def __init__(self, name="System.Status.MySQL"):
         cfg = API.get_config(name)
         InternalDB.mysql.__init__(self, name, cfg, is_direct=False)
-        self._id_cache = {}
+        self._id_cache = IdCache.parameters
 
     def _cache_lookup(self, chan, param):
         if (chan, param) not in self._id_cache:
@@ -19,11 +93,15 @@ class StatusDbReader(InternalDB.mysql):
         """
         Return the parameter ID of the given channel, name
         """
+        if channel in IdCache.channels:
+            return IdCache.channels[channel]
         SQL = "SELECT chanid FROM status_channel WHERE name=%s"
-        cursor = self._execute(SQL, (channel))
-        if cursor.rowcount == 0:
+        cursor = self._execute(SQL, [channel])
+        row = cursor.fetchone()
+        if row is None:
             raise Exception("Missing channel %s" % (channel))
-        return cursor.fetchone()[0]
+        IdCache.channels[channel] = row[0]
+        return row[0]
 
     def get_param_id(self, channel, name):
         """
@@ -38,51 +116,115 @@ class StatusDbReader(InternalDB.mysql):
             raise Exception("Missing parameter '%s' in channel '%s'" % (name, channel))
         return row[0]
 
+    def _resolve_paramlist(self, paramlist):
+        if len(paramlist) == 0:
+            raise Exception("Need parameter list")
+        rev = {}
+        for channel, name in paramlist:
+            rev[self._cache_lookup(channel, name)] = (channel, name)
+        return rev
+
     def get_last_status_values(self, paramlist, since=-60, now=None):
         """
         Paramlist must be (channel, name), since must be a value.
-        This method will fetch all updates for the given list since
-        the since time, so it might take more resources than you expect.
+        Only the last update of each parameter since the since time is
+        fetched (the latest row per parameter is found by the database).
         If since is a negative number, it will be regarded as now-time.
         since=-60 means the last 60 seconds.
         if now is given, that will be used as the max time, and a negative
         since will be in relation to the 'now' value
         Returns a map (channel, param) -> (timestamp, value)
         """
-        if len(paramlist) == 0:
-            raise Exception("Need parameter list")
-        rev = {}
-        params = []
-        for channel, name in paramlist:
-            paramid = self._cache_lookup(channel, name)
-            params.append(paramid)
-            rev[paramid] = (channel, name)
+        rev = self._resolve_paramlist(paramlist)
         if since < 0:
             if now:
                 since = now + since
             else:
                 since = time.time() + since
-        args = []
+        args = list(rev.keys())
+        args.append(since)
         if now:
-            extra = "timestamp<%s AND"
+            extra = " AND timestamp<%s"
             args.append(now)
         else:
             extra = ""
 
-        SQL = "SELECT paramid, timestamp, value FROM status WHERE " + extra + " timestamp>%s AND ("
-        args.append(since)
-        for p in params:
-            SQL += "paramid=%s OR "
-            args.append(p)
-
-        SQL = SQL[:-3] + ") ORDER BY timestamp"
+        SQL = "SELECT status.paramid, status.timestamp, status.value FROM status JOIN "\
+              "(SELECT MAX(id) AS id FROM status WHERE paramid IN (" + ",".join(["%s"] * len(rev)) + ") "\
+              "AND timestamp>%s" + extra + " GROUP BY paramid) AS last ON status.id=last.id"
         cursor = self._execute(SQL, args)
         ret = {}
         for paramid, timestamp, value in cursor.fetchall():
-            # This will overwrite the value, so only the last will be returned
             ret[rev[paramid]] = (timestamp, value)
         return ret
 
+    def get_last_status_values_since_id(self, paramlist, last_id):
+        """
+        Incremental version of get_last_status_values, returns the last
+        update of each parameter that has been added after last_id, so a
+        poll only costs the number of new rows.
+        Returns (max_id, {(channel, param) -> (timestamp, value)}). Rows
+        with lower ids than max_id may still be uncommitted, so don't pass
+        max_id as last_id on the next call before it has settled.
+        """
+        rev = self._resolve_paramlist(paramlist)
+        args = [last_id]
+        args.extend(list(rev.keys()))
+        SQL = "SELECT status.id, status.paramid, status.timestamp, status.value FROM status JOIN "\
+              "(SELECT MAX(id) AS id FROM status WHERE id>%s AND paramid IN (" + ",".join(["%s"] * len(rev)) + ") "\
+              "GROUP BY paramid) AS last ON status.id=last.id"
+        cursor = self._execute(SQL, args)
+        ret = {}
+        for id, paramid, timestamp, value in cursor.fetchall():
+            last_id = max(last_id, id)
+            ret[rev[paramid]] = (timestamp, value)
+        return last_id, ret
+
+    def get_max_id(self):
+        """
+        Return the id of the last status update
+        """
+        row = self._execute("SELECT MAX(id) FROM status").fetchone()
+        if row and row[0] is not None:
+            return row[0]
+        return 0
+
+    def get_columns(self, paramlist, start_time=None, end_time=None, since=0, chunk_size=10000):
+        """
+        Columnar version of a data query. paramlist is a list of
+        (channel, name) or parameter ids. Rows are streamed from the
+        database and converted chunk by chunk.
+        Returns (max_id, {param: (timestamps, values)}) where timestamps and
+        values are numpy arrays, param is as given in paramlist.
+        """
+        if len(paramlist) == 0:
+            raise Exception("Need parameter list")
+        rev = {}
+        for param in paramlist:
+            if isinstance(param, tuple):
+                rev[self._cache_lookup(param[0], param[1])] = param
+            else:
+                rev[int(param)] = param
+
+        SQL = "SELECT id, paramid, timestamp, value FROM status WHERE id>%s"
+        args = [since]
+        if start_time is not None:
+            SQL += " AND timestamp>%s"
+            args.append(start_time)
+        if end_time is not None:
+            SQL += " AND timestamp<%s"
+            args.append(end_time)
+        SQL += " AND paramid IN (" + ",".join(["%s"] * len(rev)) + ") ORDER BY paramid, timestamp"
+        args.extend(list(rev.keys()))
+
+        builder = ColumnBuilder(chunk_size)
+        max_id = since
+        for id, paramid, ts, value in self._iterate(SQL, args, chunk_size):
+            if id > max_id:
+                max_id = id
+            builder.add(rev[paramid], ts, value)
+        return max_id, builder.get_columns()
+
     def get_last_status_value(self, channel, name):
         """
         Return the last (timestamp, value) of the given parameter
@@ -102,6 +244,27 @@ class StatusDbReader(InternalDB.mysql):
             return (None, None)
         return (row[0], row[1])
 
+    def get_last_channel_values(self, channel):
+        """
+        Return the last (timestamp, value) of all parameters of a channel
+        using a single query, as a map name -> (timestamp, value). The
+        last id is looked up per parameter, which uses stat_paramid.
+        """
+        try:
+            chanid = self.get_channel_id(channel)
+        except Exception:
+            return {}
+        SQL = "SELECT status_parameter.paramid, status_parameter.name, status.timestamp, status.value "\
+              "FROM status_parameter JOIN status ON status.id=("\
+              "SELECT MAX(q.id) FROM status AS q WHERE q.paramid=status_parameter.paramid) "\
+              "WHERE status_parameter.chanid=%s"
+        cursor = self._execute(SQL, [chanid])
+        ret = {}
+        for paramid, name, ts, value in cursor.fetchall():
+            self._id_cache[(channel, name)] = paramid
+            ret[name] = (ts, value)
+        return ret
+
     def get_updates(self, paramlist, since=0):
         """
         Get the values for all parameters in the list since a given time. If since is 0, only the last value is given
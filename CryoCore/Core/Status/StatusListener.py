@@ -6,6 +6,7 @@ import threading
 from CryoCore import API
 from CryoCore.Core import CCshm
 from CryoCore.Core.Status.StatusDbReader import StatusDbReader
+from CryoCore.Core.Replay import StatusReplay
 
 
 class Clock():
@@ -33,43 +34,91 @@ def get_status_listener(clock=None):
 
 
 class StatusListenerDB(threading.Thread):
-    def __init__(self, clock=None):
+    def __init__(self, clock=None, settle_time=2.0):
         threading.Thread.__init__(self)
+        self.settle_time = settle_time
+        self._seen = []  # [(time, max id)]
         self._channels = {}
         self._monitors = []  # List of paramids to monitor
         self._last_values = {}
         self.clock = clock
+        self._live = clock is None
         if not clock:
             self.clock = Clock()
         self._db = StatusDbReader()
+        self._replay = None
+        if not self._live:
+            self._replay = StatusReplay(self.clock, self._db, self._monitors)
+            self._last_values = self._replay.last_values
+            self._replay.start()
         self.start()
 
     def add_monitors(self, items):
         for channel, name in items:
             self._monitors.append((channel, name))
+        if self._replay:
+            self._replay.seek()  # Load the new ones too
 
     def run(self):
         # Periodically fetch values so we don't block on reads
-        last_run = -60
-        # If the clock jumps, we need to clear stuff and restart it a bit
-        last_pos = self.clock.pos()
+        if self._live:
+            return self._run_live()
+
+        # Rows are prefetched ahead of the clock, and applied as it passes them
+        while not API.api_stop_event.is_set():
+            self._replay.advance()
+            time.sleep(0.1)
+
+    def _get_settled(self, max_id, last_id):
+        """
+        Return the max id as it was at least settle_time seconds ago, or
+        last_id if none is that old. Lower ids are all committed by now,
+        rows above it can still show up out of order.
+        """
+        now = time.time()
+        self._seen.append((now, max_id))
+        while len(self._seen) > 1 and now - self._seen[1][0] >= self.settle_time:
+            self._seen.pop(0)
+        if now - self._seen[0][0] >= self.settle_time:
+            return max(last_id, self._seen[0][1])
+        return last_id
+
+    def _run_live(self):
+        """
+        Real time - only ask for rows newer than the last one we've seen.
+        The cursor trails settle_time behind, so rows that commit after
+        rows with higher ids are still picked up.
+        """
+        last_id = None
+        initialized = []
         while not API.api_stop_event.is_set():
-            now = self.clock.pos()
-            if abs(now - last_pos) > 2:
-                # RESET
-                print("Skip detected")
-                last_run = -60
-            if len(self._monitors) > 0:
-                updates = self._db.get_last_status_values(self._monitors, since=last_run, now=now)
-                for update in updates:
-                    self._last_values[update] = {
-                        "channel": update[0],
-                        "name": update[1],
-                        "ts": updates[update][0],
-                        "value": updates[update][1]
-                    }
+            monitors = self._monitors[:]
+            if len(monitors) > 0:
+                max_id = self._db.get_max_id()
+                if last_id is None:
+                    last_id = max_id
+                elif max_id < last_id:
+                    # The table was truncated, the ids start over
+                    last_id = 0
+                    self._seen = []
+                # New monitors start with the last minute, then go incremental
+                new = [m for m in monitors if m not in initialized]
+                if new:
+                    self._update(self._db.get_last_status_values(new, since=-60))
+                    initialized.extend(new)
+                updates = self._db.get_last_status_values_since_id(monitors, last_id)[1]
+                self._update(updates)
+                last_id = self._get_settled(max_id, last_id)
             time.sleep(0.5)
-            last_run = now
+
+    def _update(self, updates):
+        for update in updates:
+            self._last_values[update] = {
+                "channel": update[0],
+                "name": update[1],
+                "ts": updates[update][0],
+                "value": updates[update][1]
+            }
 
     def get_last_value(self, chan, param):
         if (chan, param) in self._last_values:
@@ -96,6 +145,9 @@ class StatusListener():
         self._param_ids = []
         self._last_values = {}
         self._monitor_all = monitor_all
+        self._callbacks = []
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
         """
         Amount of time to sleep between calls to get_many(). The default
         is to return data at 100 Hz (if available), but for many uses a
@@ -123,6 +175,14 @@ class StatusListener():
                 self._channels[chan] = []
             self._channels[chan].append(name)
 
+    def add_callback(self, callback):
+        """
+        callback(updates) is called from the listener thread with a list
+        of the updated items (dicts with channel, name, ts, value) for
+        every batch read from the bus
+        """
+        self._callbacks.append(callback)
+
     def add_monitors_by_id(self, items):
         """
         Items should be a list of parameter ids
@@ -147,6 +207,8 @@ class StatusListener():
                 data = status_bus.get_many()
                 if data:
                     notify_condition = False
+                    updated = []
+                    dirty = set()
                     for item in data:
                         try:
                             d = json.loads(item.decode("utf-8"))
@@ -155,13 +217,22 @@ class StatusListener():
                                (d["channel"] in self._channels and
                                 d["name"] in self._channels[d["channel"]]):
                                     self._last_values[(d["channel"], d["name"])] = d
+                                    dirty.add((d["channel"], d["name"]))
+                                    updated.append(d)
                                     notify_condition = True
                         except:
                             print("Failed to parse or print data: %s" % (data))
                             traceback.print_exc()
                     if notify_condition:
+                        with self._dirty_lock:
+                            self._dirty.update(dirty)
                         with self.condition_lock:
                             self.condition_lock.notifyAll()
+                        for callback in self._callbacks:
+                            try:
+                                callback(updated)
+                            except:
+                                traceback.print_exc()
 
                     # Sleep to avoid lock thrashing, and buffer up more data before
                     # we do anything (is this necessary?)
@@ -198,6 +269,16 @@ class StatusListener():
             return ret
         return self._last_values
 
+    def get_dirty(self):
+        """
+        Return the set of (channel, name) keys that have been updated since
+        the last call, and start over
+        """
+        with self._dirty_lock:
+            dirty = self._dirty
+            self._dirty = set()
+        return dirty
+
     def wait(self, timeout=1.0):
         """
         Wait for any updates or at most timeout seconds
@@ -0,0 +1,320 @@
+"""
+Export status parameters as a wide CSV table, one column per parameter
+and one row per point in time.
+
+Each parameter is read as its own stream, sorted on time, and the
+streams are merged with a heap, so rows come out in timestamp order
+without holding the data in memory. Rows are either:
+  - the samples as they are, samples closer than "window" seconds are
+    regarded as simultaneous and put in the same row, or
+  - resampled to a fixed rate, using the last value before each point
+    in time ("ffill") or linear interpolation ("interpolate"). Each
+    stream is resampled on its own and the columns zipped together.
+
+A time range can be split into chunks that are exported in parallel to
+temporary files and concatenated in order afterwards.
+
+Usage:
+  exporter = TimeSeriesExporter(["Instruments.GPS:lat", "Instruments.GPS:lon"])
+  exporter.export("gps.csv", start, end, rate=10)
+"""
+import csv
+import heapq
+import os
+import shutil
+import threading
+import time
+
+from CryoCore.Core import API, InternalDB
+
+METHODS = ["ffill", "interpolate"]
+
+# Write buffer for the CSV files
+BUFFER_SIZE = 1048576
+
+# Samples kept back per stream to sort out of order timestamps
+REORDER_SIZE = 100
+
+
+def merge_streams(streams):
+    """
+    Merge iterators of (timestamp, value), each sorted on time, into one
+    iterator of (timestamp, index, value) where index identifies the
+    stream
+    """
+    def tag(index, stream):
+        for ts, value in stream:
+            yield (ts, index, value)
+    return heapq.merge(*[tag(i, s) for i, s in enumerate(streams)])
+
+
+def sample_rows(merged, num_columns, start=None, end=None, window=0.01, fill=False):
+    """
+    Group merged samples into rows [ts, value, value, ...]. A new row is
+    started when a sample is more than window seconds after the previous
+    one. With fill, the last value of every column is repeated, otherwise
+    columns without a sample in the row are None. Samples before start
+    are only used for filling, nothing at or after end is returned.
+    """
+    values = [None] * num_columns
+    row_ts = None
+    last_ts = None
+    for ts, index, value in merged:
+        if end is not None and ts >= end:
+            break
+        if start is not None and ts < start:
+            values[index] = value
+            continue
+        if last_ts is not None and ts - last_ts > window:
+            yield [row_ts] + values
+            if not fill:
+                values = [None] * num_columns
+            row_ts = None
+        if row_ts is None:
+            row_ts = ts
+        last_ts = ts
+        values[index] = value
+    if row_ts is not None:
+        yield [row_ts] + values
+
+
+def _interpolate(before, after, ts):
+    """
+    Interpolate between samples (ts, value), the previous value is used
+    for anything that isn't a number (values are stored as text)
+    """
+    if before is None:
+        return None
+    if after is None or after[0] == before[0]:
+        return before[1]
+    try:
+        a = float(before[1])
+        b = float(after[1])
+    except (TypeError, ValueError):
+        return before[1]
+    return a + (b - a) * (ts - before[0]) / (after[0] - before[0])
+
+
+def resample(stream, start, end, rate, method="ffill"):
+    """
+    Values of one stream of (timestamp, value) at a fixed rate (points
+    per second) from start up to (but not including) end. The last sample
+    before start and the first one after end should be included in the
+    stream so the edges can be filled.
+    """
+    step = 1.0 / rate
+    before = None
+    after = None
+    stream = iter(stream)
+    n = 0
+    while True:
+        ts = start + n * step
+        if ts >= end:
+            break
+        # Move forward until "after" is the first sample beyond ts
+        while after is None or after[0] <= ts:
+            if after is not None:
+                before = after
+            try:
+                after = next(stream)
+            except StopIteration:
+                if after is not None and after[0] <= ts:
+                    before = after
+                after = (float("inf"), None)
+                break
+        if method == "interpolate" and after[1] is not None:
+            yield _interpolate(before, after, ts)
+        else:
+            yield before[1] if before else None
+        n += 1
+
+
+def resample_rows(streams, start, end, rate, method="ffill"):
+    """
+    Rows [ts, value, ...] at a fixed rate, each stream is resampled on
+    its own (see resample)
+    """
+    if method not in METHODS:
+        raise Exception("Unknown resampling method '%s'" % method)
+    columns = [resample(s, start, end, rate, method) for s in streams]
+    step = 1.0 / rate
+    n = 0
+    for values in zip(*columns) if columns else []:
+        yield [start + n * step] + list(values)
+        n += 1
+
+
+def split_range(start, end, chunks, rate=None):
+    """
+    Split [start, end) into chunks, aligned to the resampling grid if a
+    rate is given. Returns a list of (start, end).
+    """
+    size = (end - start) / float(chunks)
+    if rate:
+        # Whole number of resampling steps per chunk
+        steps = max(1, int(size * rate))
+        size = steps / float(rate)
+    ranges = []
+    i = 0
+    while start + i * size < end:
+        ranges.append((start + i * size, min(start + (i + 1) * size, end)))
+        i += 1
+    return ranges
+
+
+class TimeSeriesExporter(InternalDB.mysql):
+    """
+    Export parameters ("channel:name") from the status database
+    """
+
+    def __init__(self, parameters, name="System.Status.MySQL", chunk_size=10000):
+        cfg = API.get_config(name)
+        InternalDB.mysql.__init__(self, "TimeSeriesExporter", cfg, is_direct=False)
+        self.log = API.get_log("TimeSeriesExporter")
+        self.parameters = parameters
+        self.chunk_size = chunk_size
+        self._ids = self._resolve(parameters)
+
+    def _resolve(self, parameters):
+        """
+        Find (chanid, paramid) for each parameter, None for unknowns
+        """
+        SQL = "SELECT status_channel.name, status_parameter.name, status_parameter.chanid, paramid " +\
+              "FROM status_parameter, status_channel WHERE status_parameter.chanid=status_channel.chanid"
+        known = {}
+        for channel, name, chanid, paramid in self._execute(SQL).fetchall():
+            known["%s:%s" % (channel, name)] = (chanid, paramid)
+        ids = []
+        for p in parameters:
+            if p not in known:
+                self.log.warning("Unknown (or 2D) parameter '%s', column will be empty" % p)
+            ids.append(known.get(p))
+        return ids
+
+    def _stream(self, ids, start, end, edges=False):
+        """
+        Yield (timestamp, value) for one parameter with start <= timestamp < end,
+        sorted on time. With edges, the last sample before start and the
+        first one at or after end are included too.
+        """
+        if ids is None:
+            return
+        chanid, paramid = ids
+        if edges and start is not None:
+            cursor = self._execute("SELECT timestamp, value FROM status WHERE chanid=%s AND paramid=%s "
+                                   "AND timestamp<%s ORDER BY timestamp DESC LIMIT 1", [chanid, paramid, start])
+            row = cursor.fetchone()
+            if row:
+                yield (row[0], row[1])
+        SQL = "SELECT id, timestamp, value FROM status WHERE id>%s AND chanid=%s AND paramid=%s"
+        args = [chanid, paramid]
+        if start is not None:
+            SQL += " AND timestamp>=%s"
+            args.append(start)
+        if end is not None:
+            SQL += " AND timestamp<%s"
+            args.append(end)
+        SQL += " ORDER BY id"
+        # Ids are in insert order, a small heap puts samples that were
+        # reported late back in time order
+        reorder = []
+        for id, ts, value in self._iterate_by_id(SQL, args, 0, self.chunk_size):
+            heapq.heappush(reorder, (ts, id, value))
+            if len(reorder) > REORDER_SIZE:
+                ts, id, value = heapq.heappop(reorder)
+                yield (ts, value)
+        while reorder:
+            ts, id, value = heapq.heappop(reorder)
+            yield (ts, value)
+        if edges and end is not None:
+            cursor = self._execute("SELECT timestamp, value FROM status WHERE chanid=%s AND paramid=%s "
+                                   "AND timestamp>=%s ORDER BY timestamp LIMIT 1", [chanid, paramid, end])
+            row = cursor.fetchone()
+            if row:
+                yield (row[0], row[1])
+
+    def rows(self, start=None, end=None, rate=None, method="ffill", fill=False, window=0.01):
+        """
+        Yield the rows [ts, value, ...] for start <= ts < end
+        """
+        edges = bool(rate) or fill
+        streams = [self._stream(ids, start, end, edges) for ids in self._ids]
+        if rate:
+            if start is None or end is None:
+                raise Exception("Resampling needs both a start and an end time")
+            return resample_rows(streams, start, end, rate, method)
+        return sample_rows(merge_streams(streams), len(streams), start, end, window, fill)
+
+    def write(self, f, rows, header=True):
+        writer = csv.writer(f)
+        if header:
+            writer.writerow(["Time"] + list(self.parameters))
+        num = 0
+        for row in rows:
+            writer.writerow(row)
+            num += 1
+        return num
+
+    def export(self, filename, start=None, end=None, rate=None, method="ffill", fill=False,
+               window=0.01, chunks=1, num_workers=4):
+        """
+        Export to filename, returns the number of rows written. With
+        chunks > 1 the time range is split and the chunks exported in
+        parallel. Rows closer than window seconds to a chunk edge may
+        be split in two if not resampling.
+        """
+        if chunks <= 1 or start is None or end is None:
+            with open(filename, "w", buffering=BUFFER_SIZE, newline="") as f:
+                return self.write(f, self.rows(start, end, rate, method, fill, window))
+
+        ranges = split_range(start, end, chunks, rate)
+        parts = ["%s.%d.part" % (filename, i) for i in range(len(ranges))]
+        pending = list(range(len(ranges)))
+        counts = {}
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            while not API.api_stop_event.is_set():
+                with lock:
+                    if len(pending) == 0 or errors:
+                        return
+                    i = pending.pop(0)
+                try:
+                    s, e = ranges[i]
+                    with open(parts[i], "w", buffering=BUFFER_SIZE, newline="") as f:
+                        num = self.write(f, self.rows(s, e, rate, method, fill, window), header=False)
+                except Exception as e:
+                    self.log.exception("Exporting %s-%s" % ranges[i])
+                    errors.append(e)
+                    return
+                with lock:
+                    counts[i] = num
+
+        t0 = time.time()
+        threads = []
+        for i in range(min(num_workers, len(ranges))):
+            t = threading.Thread(target=worker)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        try:
+            if errors:
+                raise Exception("Export failed: %s" % errors[0])
+            if len(counts) != len(ranges):
+                raise Exception("Export stopped")
+            with open(filename, "w", buffering=BUFFER_SIZE, newline="") as f:
+                csv.writer(f).writerow(["Time"] + list(self.parameters))
+                for part in parts:
+                    with open(part, "r", newline="") as p:
+                        shutil.copyfileobj(p, f, BUFFER_SIZE)
+        finally:
+            for part in parts:
+                try:
+                    os.remove(part)
+                except OSError:
+                    pass
+        self.log.info("Exported %d rows to %s in %.1fs" % (sum(counts.values()), filename, time.time() - t0))
+        return sum(counts.values())
@@ -14,7 +14,9 @@ else:
     from Queue import Empty
 
 from CryoCore.Core import CCshm
+from CryoCore.Core.Spool import Spool
 import json
+import time
 
 # dbg_flag = threading.Event()
 
@@ -93,6 +95,18 @@ class DbHandler(logging.Handler, InternalDB.mysql):
         except:
             pass
 
+        # Log messages are spooled to disk while the database is unavailable
+        # Spool also if the queue grows too long or inserts get too slow
+        self.cfg.set_default("spool.directory", "/tmp/cryocore/spool")
+        self.cfg.set_default("spool.max_queue", 10000)
+        self.cfg.set_default("spool.max_latency", 5.0)
+        self._spool = Spool(os.path.join(self.cfg["spool.directory"], "log"))
+        # Protects the decision to spool or not, so no message is written past spooled ones
+        self._spool_lock = threading.RLock()
+        self._spooling = not self._spool.is_empty()
+        self._last_replay = 0
+        self._pid = os.getpid()
+
         self.tasks = queue.Queue()
         # We use two internal events to control the handler.
         # The stop_event is set in the handler's close() func,
@@ -138,6 +152,9 @@ class DbHandler(logging.Handler, InternalDB.mysql):
         # Thread entry point
         while not self.stop_event.is_set():
             self.get_log_entry_and_insert(taskqueue, True, API.queue_timeout)
+            if self._spooling and time.time() - self._last_replay > 5.0:
+                self._last_replay = time.time()
+                self._replay()
         # Insert any remaining items until self.tasks is empty
         while not self.stop_event.is_set() and self.get_log_entry_and_insert(taskqueue, False, None):
             pass
@@ -145,15 +162,11 @@ class DbHandler(logging.Handler, InternalDB.mysql):
 
     def get_log_entry_and_insert(self, taskqueue, should_block, desired_timeout):
 
-
-        SQL = "INSERT INTO log (logger, level, module, line, func, time, msecs, message) VALUES "
-        params = []
+        entries = []
         while not API.api_stop_event.is_set():
             try:
-                args = taskqueue.get(should_block, desired_timeout)
-                SQL += "(%s, %s, %s, %s, %s, %s, %s, %s),"
-                params.extend(args)
-                if len(params) > 1000:
+                entries.append(taskqueue.get(should_block, desired_timeout))
+                if len(entries) > 125:
                     break  # Enough already
             except Empty:
                 break
@@ -163,26 +176,84 @@ class DbHandler(logging.Handler, InternalDB.mysql):
                 return False
             except Exception as e:
                 #print("Error getting async log messages:", e)
-                import time
                 time.sleep(0.1)
                 return False
 
-        if len(params) == 0:
+        if len(entries) == 0:
             # Nothing yet
             return False
 
+        with self._spool_lock:
+            if self._spooling:
+                # Keep draining the queue to disk, memory must not grow while the DB is gone
+                for entry in entries:
+                    self._spool.append(entry)
+                return True
+
         # Should insert something
+        t = time.time()
         try:
-            SQL = SQL[:-1]
-            self._execute(SQL, params, insist_direct=True)  # , log_errors=False)
+            self._insert(entries)
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print("Async exception on log posting", e)
+            print("Async exception on log posting, spooling to disk", e)
+            with self._spool_lock:
+                self._spooling = True
+                for entry in entries:
+                    self._spool.append(entry)
             return False
 
+        if time.time() - t > self.cfg["spool.max_latency"]:
+            print("Slow database (%.1fs), spooling log messages for a while" % (time.time() - t))
+            with self._spool_lock:
+                self._last_replay = time.time()
+                self._spooling = True
         return True
 
+    def _insert(self, entries, connection=None):
+        SQL = "INSERT INTO log (logger, level, module, line, func, time, msecs, message) VALUES "
+        SQL += ",".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(entries))
+        params = []
+        for entry in entries:
+            params.extend(entry)
+        self._execute(SQL, params, insist_direct=True, connection=connection)  # , log_errors=False)
+
+    def _replay(self):
+        """
+        Bulk insert spooled log messages, oldest first, on one connection
+        """
+        connection = None
+        try:
+            connection = self._get_direct_connection()
+            for segment, rows in self._spool.read_segments():
+                for i in range(0, len(rows), 125):
+                    try:
+                        self._insert(rows[i:i + 125], connection)
+                    except:
+                        # Continue from here next time
+                        self._spool.consumed(segment, i)
+                        return
+                self._spool.remove(segment)
+            with self._spool_lock:
+                if self._spool.is_empty():
+                    self._spooling = False
+        except Exception as e:
+            print("Exception replaying spooled log messages", e)
+        finally:
+            if connection:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+    def _falling_behind(self):
+        """
+        True if more than spool.max_queue messages are waiting
+        """
+        try:
+            return self.tasks.qsize() > self.cfg["spool.max_queue"]
+        except NotImplementedError:
+            return False  # Not available on all platforms
+
     def close(self):
         """
         Close the C{logging.Handler} object. It closes both the C{sqlite3.Connection} L{con<DbHandler.con>} and the C{sqlite3.Cursor} L{cur<DbHandler.cur>} variables, and calls the base class close func.
@@ -259,7 +330,13 @@ class DbHandler(logging.Handler, InternalDB.mysql):
                 message = (str(record.getMessage()) + program_stack_string.replace("'", "\""))
                 toRecord.append(message[:self.MAX_LEN])
 
-            self.tasks.put(toRecord)
+            if os.getpid() == self._pid and self._falling_behind():
+                # Keep memory bounded, the spool is replayed by the log thread
+                with self._spool_lock:
+                    self._spooling = True
+                    self._spool.append(toRecord)
+            else:
+                self.tasks.put(toRecord)
 
             if self.log_bus:
                 names = ["logger", "level", "module", "line", "func", "time", "msecs", "message"]
@@ -1,382 +1,431 @@
 #!/usr/bin/env python
-from CryoCore.Core.loggingService import getLoggingService
-from CryoCore.Core import API
-
-try:
-    import psycopg2 as postgre
-except:
-    getLoggingService("Importing").critical("WARNING: postgres bindings not installed")
-
-from CryoCore.Core.common import Singleton
-from CryoCore.Core.dbHandler import DbHandler
-import logging
+"""
+Replication of status and log from the onboard database to the ground.
+
+The onboard side (SyncDB, one per link) reads new rows by primary key
+range and ships them as compressed batches over TCP to a GroundReceiver,
+which applies each batch and its high water mark in one transaction,
+and then acknowledges it. After a lost connection the onboard side
+simply continues from the marks the ground reports when it reconnects.
+
+Rows already on the ground are never overwritten. A batch of the
+backlog must start at the ground's mark, and the onboard side stops
+syncing a table whose max id is below the mark: the onboard ids were
+reset (the table was truncated) and would collide with the history.
+The operator must then rebase the table on the ground (--rebase), which
+moves the rows synchronized so far to <table>_<time> and starts over.
+
+Ids are allocated when rows are inserted but only become visible when
+they are committed, so a row with a lower id may show up after a
+higher one. The backlog is therefore only sent up to the max id seen
+settle_time seconds ago.
+
+Each link is shaped with a TokenBucket to its configured rate. Selected
+parameters ("priority", the old sync_status_var list) are sent first:
+their latest values go out before every batch of the backlog. A link
+with priority_only set (the "slow" link) only sends those, and the
+channel and parameter names they refer to.
+
+Protocol, every frame is a 4 byte length and zlib compressed JSON:
+  onboard -> ground  {"schema": {table: CREATE TABLE statement}}
+  ground -> onboard  {"marks": {table: last id}}
+  onboard -> ground  {"batch": n, "table": table, "key": key column,
+                      "columns": [...], "rows": [...],
+                      "first": mark, "last": new mark}
+  ground -> onboard  {"ack": n}
+The batch holds the rows first < key <= last. "first" and "last" are
+None for batches of priority values, they don't move the mark.
+
+  python -m CryoCore.Core.sync_ground_db --ground     (on the ground)
+  python -m CryoCore.Core.sync_ground_db fast slow    (onboard)
+  python -m CryoCore.Core.sync_ground_db --ground --rebase status_channel status_parameter status
+"""
+import json
+import socket
+import struct
 import threading as threading
-import _thread
-
-
-class SyncDB(Singleton):
-    # Units: second
-    period = 60 * 5
-
-    ignoreSubsequent = True
-
-    onboard_con = None
-    onboard_aux_con = None
-    ground_con = None
-
-    def __init__(self, stop_event=None):
-        self.log = API.get_log("SyncDB")
-        self.cfg = API.get_config("System.Status")
+import time
+import zlib
+from argparse import ArgumentParser
+
+from CryoCore.Core import API, InternalDB
+from CryoCore.Core.Backup import encode_value, decode_value
+from CryoCore.Core.TokenBucket import TokenBucket
+
+# (table, primary key) in the order they are synchronized
+TABLES = [("status_channel", "chanid"),
+          ("status_parameter", "paramid"),
+          ("status", "id"),
+          ("log", "id")]
+
+# Small tables that are needed to make sense of priority values
+DIMENSIONS = ["status_channel", "status_parameter"]
+
+HEADER = struct.Struct("!I")
+
+
+def pack(message, level=6):
+    payload = zlib.compress(json.dumps(message).encode("utf-8"), level)
+    return HEADER.pack(len(payload)) + payload
+
+
+def read_message(sock):
+    """
+    Read one frame from a blocking socket
+    """
+    def read(size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise Exception("Connection closed")
+            data += chunk
+        return data
+    (length, ) = HEADER.unpack(read(HEADER.size))
+    return json.loads(zlib.decompress(read(length)).decode("utf-8"))
+
+
+class SyncDB(threading.Thread):
+    """
+    Ship status and log to the ground over one link
+    """
+
+    def __init__(self, link="fast", stop_event=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.link = link
+        self.log = API.get_log("SyncDB.%s" % link)
+        self.status = API.get_status("SyncDB.%s" % link)
+        self.cfg = API.get_config("System.SyncGround")
+        self.cfg.set_default("%s.host" % link, "localhost")
+        self.cfg.set_default("%s.port" % link, 7780)
+        # Bytes per second
+        self.cfg.set_default("%s.rate" % link, 1000000 if link == "fast" else 2000)
+        self.cfg.set_default("%s.priority_only" % link, link != "fast")
+        self.cfg.set_default("batch_size", 2000)
+        self.cfg.set_default("window", 4)
+        self.cfg.set_default("run_interval", 5.0)
+        self.cfg.set_default("ack_timeout", 120.0)
+        self.cfg.set_default("settle_time", 2.0)
+        self.cfg.set_default("priority", [])
 
         if stop_event:
             self.stop_event = stop_event
         else:
-            self.stop_event = threading.Event()
-
-        self._connections = {}
-        self._lock = threading.Lock()
-
-        # Must connect to the local database
-        self._db_conn = postgre.connect(host=self.cfg["GrounDB.db_name"],
-                                        database=self.cfg["GrounDB.db_name"],
-                                        port=self.cfg["GrounDB.db_name"],
-                                        user=self.cfg["GroundDB.db_user"],
-                                        password=self.cfg["GroundDB.db_password"])
-        self._prepare_ground_db()
-
-        self._is_onboard_prepared = False
-        self._connector = threading.Thread(target=self._run_connector)
-        self._connector.start()
-
-    def _run_connector(self):
+            self.stop_event = API.api_stop_event
+
+        self.db = InternalDB.mysql("SyncDB", API.get_config("System.Status.MySQL"), is_direct=True)
+        rate = float(self.cfg["%s.rate" % link])
+        self.bucket = TokenBucket(max(rate, 1024), rate)
+
+        self.sock = None
+        self._marks = {}
+        self._priority_marks = {}
+        self._columns = {}
+        self._in_flight = []
+        self._batch = 0
+        self._seen = {}  # table -> [(time, max id)]
+        self._reset = set()  # Tables with onboard ids below the ground mark
+
+    def _connect(self):
+        addr = (self.cfg["%s.host" % self.link], int(self.cfg["%s.port" % self.link]))
+        self.sock = socket.create_connection(addr, timeout=float(self.cfg["ack_timeout"]))
+        self._in_flight = []
+        schema = {}
+        for table, key in TABLES:
+            schema[table] = self.db._execute("SHOW CREATE TABLE `%s`" % table).fetchone()[1]
+        self._send({"schema": schema})
+        self._marks = read_message(self.sock)["marks"]
+        for table in self._reset:
+            self.status["%s.rebase_needed" % table] = False
+        self._reset = set()
+        self.log.info("Connected to ground over %s link, marks: %s" % (self.link, self._marks))
+
+    def _close(self):
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+        self.sock = None
+
+    def _send(self, message):
+        frame = pack(message)
+        # Can't take more than the bucket holds at once
+        for i in range(0, len(frame), int(self.bucket.capacity)):
+            self.bucket.consume(min(int(self.bucket.capacity), len(frame) - i), block=True)
+        self.sock.sendall(frame)
+        self.status["bytes_sent"].inc(len(frame))
+
+    def _wait_ack(self):
+        message = read_message(self.sock)
+        if message.get("ack") != self._in_flight[0][0]:
+            raise Exception("Unexpected acknowledgement %s" % message)
+        batch, table, last = self._in_flight.pop(0)
+        if last is not None:
+            self.status["%s.acked" % table] = last
+
+    def _send_batch(self, table, key, rows, first, last):
+        self._batch += 1
+        self._send({"batch": self._batch, "table": table, "key": key, "columns": self._get_columns(table),
+                    "rows": [[encode_value(v) for v in row] for row in rows], "first": first, "last": last})
+        self._in_flight.append((self._batch, table, last))
+        while len(self._in_flight) >= int(self.cfg["window"]):
+            self._wait_ack()
+
+    def _get_columns(self, table):
+        if table not in self._columns:
+            SQL = "SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA=DATABASE() "\
+                  "AND TABLE_NAME=%s ORDER BY ORDINAL_POSITION"
+            self._columns[table] = [row[0] for row in self.db._execute(SQL, [table]).fetchall()]
+        return self._columns[table]
+
+    def _select(self, table):
+        return "SELECT %s FROM `%s`" % (",".join(["`%s`" % c for c in self._get_columns(table)]), table)
+
+    def _get_priority_ids(self):
         """
-        Entrypoint for the connector thread, which will loop and try to
-        keep connections up.  Only connections that are up are put
-        in the self._connections, and if one channel is down, it will
-        try to get it back up.
+        Return the paramids of the priority parameters ("channel:name")
         """
-        last_run = 0
-        while not self.stop_event.is_set():
-            for conn in ["fast", "slow"]:
-                if conn not in list(self._connections.keys())[:]:
-                    # Try to connect!
-                    try:
-                        addr = (self.cfg["SyncStatus.%s_host" % conn],
-                                self.cfg["SyncStatus.%s_port" % conn])
-
-                        if addr[0] or addr[1] is None:
-                            self.log.error("Missing config for connection %s" % conn)
-                            continue
-
-                        c = postgre.connect(host=addr[0],
-                                            database=self.cfg["Postgres.db_name"],
-                                            port=addr[1],
-                                            user=self.cfg["Postgres.db_user"],
-                                            password=self.cfg["Postgres.db_password"])
-                        with self.lock:
-                            self.log.info("Adding connection over %s link" % conn)
-                            self._connections[conn] = c
-
-                    except:
-                        self.log.debug("Could not connect to database using %s connection" % conn)
-
-            # Wait a bit until we try again
-            interval = float(self.cfg["run_interval"])
-            while not self.stop_event.is_set():
-                now = time.time()
-                if now - last_run >= interval:
-                    break
-                time.sleep(min(1, last_run + interval - now))
-            last_run = time.time()
-
-    def _prepare_ground_db(self):
+        if not self.cfg["priority"]:
+            return []
+        SQL = "SELECT status_channel.name, status_parameter.name, paramid FROM status_parameter, status_channel "\
+              "WHERE status_parameter.chanid=status_channel.chanid"
+        wanted = set(self.cfg["priority"])
+        return [row[2] for row in self.db._execute(SQL).fetchall() if "%s:%s" % (row[0], row[1]) in wanted]
+
+    def send_priority(self):
         """
-        Prepare the ground database if it isn't already present
+        Send the latest values of the priority parameters that changed
+        since they were last sent
         """
-        # Check whether the ground database, the one to be populated, has been well built
-        ground_cursor = self._db_conn.cursor()
-
-        ground_cursor.execute("select table_name from information_schema.tables")
-        self._db_conn.commit()
-
-        existing_tables = []
-
-        for row in ground_cursor.fetchall():
-            existing_tables.append(row[0])
-
-        if "status" not in existing_tables:
-            ground_cursor.execute("CREATE TABLE status ( " +
-                                "id SERIAL PRIMARY KEY, " +
-                                "timestamp FLOAT, " +
-                                "inserted TIMESTAMP, " +
-                                "onboard_id INTEGER, " +
-                                "channel VARCHAR(256), " +
-                                "name VARCHAR(128), " +
-                                "value VARCHAR(128))")
-            ground_cursor.execute("CREATE INDEX stat_name ON status(name)")
-            ground_cursor.execute("CREATE INDEX stat_channel ON status(channel)")
-            ground_cursor.execute("CREATE INDEX stat_time ON status(timestamp)")
-            self._db_conn.commit()
-
-        ground_cursor.close()
-
-    def _lost_connection(self, connection_name):
+        if "status" in self._reset:
+            return 0
+        paramids = self._get_priority_ids()
+        if not paramids:
+            return 0
+        since = min([self._priority_marks.get(p, self._marks.get("status", 0)) for p in paramids])
+        SQL = "SELECT paramid, MAX(id) FROM status WHERE id>%s AND paramid IN (" +\
+              ",".join(["%s"] * len(paramids)) + ") GROUP BY paramid"
+        ids = []
+        for paramid, last_id in self.db._execute(SQL, [since] + paramids).fetchall():
+            if last_id > max(self._priority_marks.get(paramid, 0), self._marks.get("status", 0)):
+                ids.append(last_id)
+        if not ids:
+            return 0
+        SQL = self._select("status") + " WHERE id IN (" + ",".join(["%s"] * len(ids)) + ")"
+        rows = self.db._execute(SQL, ids).fetchall()
+        self._send_batch("status", "id", rows, None, None)
+        index = self._get_columns("status").index("paramid")
+        for row in rows:
+            self._priority_marks[row[index]] = max(row[0], self._priority_marks.get(row[index], 0))
+        return len(rows)
+
+    def _get_settled(self, table, max_id):
         """
-        Lost a connection
+        Return the max id of table as it was at least settle_time seconds
+        ago, lower ids are all committed by now
         """
-        self.log.warning("Lost connection to remote database over %s connection" % connection_name)
-        with self.lock:
-            del self._connections[connection_name]
-
-    def _prepare_onboard(self):
+        now = time.time()
+        seen = self._seen.setdefault(table, [])
+        seen.append((now, max_id))
+        settle_time = float(self.cfg["settle_time"])
+        while len(seen) > 1 and now - seen[1][0] >= settle_time:
+            seen.pop(0)
+        if now - seen[0][0] >= settle_time:
+            return seen[0][1]
+        return self._marks.get(table, 0)
+
+    def send_backlog(self, table, key):
         """
-        Prepare the onboard database if it does not already exist
+        Send everything new in table, returns the number of rows sent
         """
-        for conn in ["fast", "slow"]:
-            if conn in self._connections:
-                try:
-                    onboard_cursor = self._connections[conn].cursor()
-                    onboard_cursor.execute("select table_name from information_schema.tables where table_name = 'sync_status_var'")
-
-                    if len(onboard_cursor.fetchall()) == 0:
-                        onboard_cursor.execute("CREATE TABLE sync_status_var (" +
-                                                   "channel VARCHAR(128), " +
-                                                   "name VARCHAR(128), " +
-                                                   "PRIMARY KEY (channel, name))")
-                        self._connections[conn].commit()
-                    else:
-                        onboard_cursor.execute("delete from sync_status_var")
-                        self._connections[conn].commit()
-
-                    # TODO: It would be good if there is a list of variables to be watched on the configuration file, so it might be load into this table here
-                    # Let's save the prepared sql sentence
-                    onboard_cursor.execute("select name from pg_prepared_statements where name = 'last_values'")
-
-                    if len(onboard_cursor.fetchall()) == 0:
-                        onboard_cursor.execute("prepare last_values as " +
-                                                "select distinct on (channel, name) " +
-                                                "status.id, status.name as name, timestamp, value, " +
-                                                "status.channel as channel from status " +
-                                                "inner join sync_status_var on " +
-                                                "status.name = sync_status_var.name and " +
-                                                "status.channel = sync_status_var.channel " +
-                                                "order by channel, name, timestamp desc, id desc")
-
-                    self._connections[conn].commit()
-
-                    onboard_cursor.execute("select name from pg_prepared_statements where name = 'IMU_Lon_and_Lat'")
-                    if len(onboard_cursor.fetchall()) == 0:
-                        onboard_cursor.execute("prepare IMU_Lon_and_Lat as " +
-                                                   "select distinct on (name) " +
-                                                   "id, name, timestamp, value " +
-                                                   "from status where " +
-                                                   "channel = 'IMU' and " +
-                                                   "name = 'position.lon' or name = 'position.lat' " +
-                                                   "order by name, timestamp desc, id desc")
-                    self._connections[conn].commit()
-                except:
-                    self._lost_connection(conn)
-
-        # We update the list of available variables
-        self.resetVariableList()
-
-        return True
-
-    def resetVariableList(self):
-        ground_cursor = self._db_conn.cursor()
-
-        if self.createVariableList():
-            # The table exists, we will reset it and will fill it again
-            ground_cursor.execute("delete from status_var")
-
-        # This table lets us know which web browser session is watching which variable
-        ground_cursor.execute("select table_name from information_schema.tables where table_name = 'session_status_var'")
-
-        if len(ground_cursor.fetchall()) == 0:
-            ground_cursor.execute("CREATE TABLE session_status_var (" +
-                                    "status_var_id INTEGER REFERENCES status_var (id) ON DELETE CASCADE, " +
-                                    "session_id INTEGER, " +
-                                    "PRIMARY KEY (status_var_id, session_id))")
+        sent = 0
+        max_id = self.db._execute("SELECT MAX(`%s`) FROM `%s`" % (key, table)).fetchone()[0] or 0
+        if max_id < self._marks.get(table, 0):
+            if table not in self._reset:
+                self._reset.add(table)
+                self.log.error("Onboard %s only has ids up to %d, but the ground has up to %d. The ids were "
+                               "reset, not syncing %s until it is rebased on the ground (--rebase)" %
+                               (table, max_id, self._marks[table], table))
+                self.status["%s.rebase_needed" % table] = True
+            return 0
+        max_id = self._get_settled(table, max_id)
+        batch_size = int(self.cfg["batch_size"])
+        while self._marks.get(table, 0) < max_id and not self.stop_event.is_set():
+            self.send_priority()
+            first = self._marks.get(table, 0)
+            last = min(first + batch_size, max_id)
+            SQL = self._select(table) + " WHERE `%s`>%%s AND `%s`<=%%s ORDER BY `%s`" % (key, key, key)
+            rows = self.db._execute(SQL, [first, last]).fetchall()
+            self._send_batch(table, key, rows, first, last)
+            self._marks[table] = last
+            sent += len(rows)
+            self.status["%s.sent" % table] = last
+        return sent
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                if self.sock is None:
+                    self._connect()
+                self.send_priority()
+                for table, key in TABLES:
+                    if self.cfg["%s.priority_only" % self.link] and table not in DIMENSIONS:
+                        continue
+                    self.send_backlog(table, key)
+                while self._in_flight:
+                    self._wait_ack()
+            except Exception as e:
+                self.log.warning("Sync over %s link failed (%s), retrying" % (self.link, e))
+                self._close()
+            self.stop_event.wait(float(self.cfg["run_interval"]))
+        self._close()
+
+
+class GroundReceiver(threading.Thread):
+    """
+    Apply batches from any number of onboard links to the ground database
+    """
+
+    def __init__(self, port=7780, stop_event=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.log = API.get_log("GroundReceiver")
+        self.port = port
+        if stop_event:
+            self.stop_event = stop_event
         else:
-            # If the table already exists, due to we will populate again the status_var table, and the indexes will change as well, we have to delete all these elements
-            ground_cursor.execute("delete from session_status_var")
-
-            self.db_conn_con.commit()
-
-        # Populate the recently created table
-        self.updateVariableList()
-
-        onboard_cursor.close()
-
-    def createVariableList(self):
-        if not self.ground_con:
-            return False
-
-        ground_cursor = self.ground_con.cursor()
-
-        # We create a table with a list of available variables
-        ground_cursor.execute("select table_name from information_schema.tables where table_name = 'status_var'")
-        if len(ground_cursor.fetchall()) == 0:
-            ground_cursor.execute("CREATE TABLE status_var ( " +
-                                "id SERIAL PRIMARY KEY, " +
-                                "channel VARCHAR(128), " +
-                                "name VARCHAR(128), " +
-                                "UNIQUE (channel, name))")
-            self.ground_con.commit()
-
-        return True
-
-    def updateVariableList(self):
-        if not (self.onboard_con and self.ground_con):
-            return False
-
-        ground_cursor = self.ground_con.cursor()
-        onboard_cursor = self.onboard_con.cursor()
-
-        if self.createVariableList():
-            onboard_cursor.execute("select distinct on (channel, name) channel, name from status")
-            for row in onboard_cursor.fetchall():
-                try:
-                    ground_cursor.execute("select * from status_var where channel = '%s' and name = '%s'" % tuple(row))
-                    if len(ground_cursor.fetchall()) == 0:
-                        ground_cursor.execute("insert into status_var(channel, name) values ('%s', '%s')" % tuple(row))
-                except:
-                    self.logs.exception("Problem inserting the status variable %s" % str(row))
-                    print("We got a problem inserting into status_var: %s" % str(row))
-            self.ground_con.commit()
-
-    def addVariable(self, channel, name):
-        with self.lock:
-            if "fast" not in self._connections:
-                # If we dont have the main connection, there is no reason for adding new variables
-                return
-            c = self._connections["fast"]
-            onboard_cursor = c.cursor()
-
-        try:
-            onboard_cursor.execute("select * from sync_status_var where channel = '%(channel)s' and name = '%(name)s'" % vars())
-            c.commit()
-            found = (len(onboard_cursor.fetchall()) > 0)
-            onboard_cursor.execute("select count(*) from status where channel = '%(channel)s' and name = '%(name)s'" % vars())
-
-            exist = (int(onboard_cursor.fetchone()[0]) > 0)
-
-            if exist and not found:
-                onboard_cursor.execute("insert into sync_status_var(channel, name) values ('%(channel)s', '%(name)s')" % vars())
-                c.commit()
-
-            onboard_cursor.close()
-        except Exception as e:
-            print(str(e) + "\n" + str(Exception))
-            self.logs.exception("the variable " + channel + "." + name + " couldn't be added to the watching list")
+            self.stop_event = API.api_stop_event
+        self.db = InternalDB.mysql("GroundReceiver", API.get_config("System.SyncGround.GroundDB"), is_direct=True)
+        self.db._execute("CREATE TABLE IF NOT EXISTS sync_state (tbl VARCHAR(128) PRIMARY KEY, last_id BIGINT)")
+        self._lock = threading.Lock()
 
-    def delVariable(self, channel, name):
-        with self.lock:
-            if "fast" not in self._connections:
-                # If we dont have the main connection, there is no reason for adding new variables
-                return
-            c = self._connections["fast"]
-            onboard_cursor = c.cursor()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("", port))
+        self.socket.listen(4)
+        self.socket.settimeout(1.0)
 
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                conn, addr = self.socket.accept()
+            except socket.timeout:
+                continue
+            self.log.info("Onboard connected from %s" % str(addr))
+            t = threading.Thread(target=self._serve, args=(conn, addr))
+            t.daemon = True
+            t.start()
+        self.socket.close()
+
+    def get_marks(self):
+        marks = {}
+        for table, last_id in self.db._execute("SELECT tbl, last_id FROM sync_state").fetchall():
+            marks[table] = last_id
+        return marks
+
+    def _serve(self, sock, addr):
+        conn = None
         try:
-            onboard_cursor.execute("select count(*) from sync_status_var where channel = '%(channel)s' and name = '%(name)s'" % vars())
-            if len(onboard_cursor.fetchall()) != 0:
-                onboard_cursor.execute("delete from sync_status_var where channel = '%(channel)s' and name = '%(name)s'" % vars())
-            else:
-                print("Channel: %(channel)s Name: %(name)s is not in the sync_status_var" % vars())
+            sock.settimeout(None)
+            message = read_message(sock)
+            with self._lock:
+                for table, SQL in message["schema"].items():
+                    self.db._execute(SQL.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+                marks = self.get_marks()
+            sock.sendall(pack({"marks": marks}))
+            conn = self.db.db._get_connection()
+            while not self.stop_event.is_set():
+                message = read_message(sock)
+                self.apply(conn, message)
+                sock.sendall(pack({"ack": message["batch"]}))
         except Exception as e:
-            print(str(e) + "\n" + str(Exception))
-            self.logs.exception("the variable " + channel + "." + name + " couldn't be removed of the watching list")
-            return False
+            self.log.warning("Lost onboard connection from %s (%s)" % (str(addr), e))
+        finally:
+            sock.close()
+            if conn:
+                conn.close()
 
-        c.commit()
-        onboard_cursor.close()
-        return True
-
-    def getRecords(self, name, recordTime):
+    def rebase(self, tables):
         """
-        Get updates over the main link and insert them on the ground
+        Start the tables over after their onboard ids were reset. The
+        rows synchronized so far are kept in <table>_<time>, the table
+        is created again when onboard connects. Tables that were cleared
+        together onboard (e.g. status and its parameters) must be rebased
+        together.
         """
-        with self.lock:
-            if "fast" not in self._connections:
-                # If we dont have the main connection, there is no reason for adding new variables
-                return
-            c = self._connections["fast"]
-            onboard_cursor = c.cursor()
-
-        onboard_cursor = c.cursor()
-        ground_cursor = self._db_conn.cursor()
-
+        suffix = time.strftime("%Y%m%d_%H%M%S")
+        with self._lock:
+            for table in tables:
+                SQL = "SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s"
+                if self.db._execute(SQL, [table]).fetchone()[0]:
+                    self.db._execute("RENAME TABLE `%s` TO `%s_%s`" % (table, table, suffix))
+                    self.log.warning("Rebased %s, the rows synchronized so far are in %s_%s" % (table, table, suffix))
+                self.db._execute("DELETE FROM sync_state WHERE tbl=%s", [table])
+
+    def apply(self, conn, message):
+        """
+        Insert the rows of a batch and move the mark, in one transaction.
+        A batch of the backlog must not start after the mark, rows up to
+        the mark were sent by another link and are skipped. Rows that are
+        here already (priority values are sent twice) are left alone.
+        """
+        table = message["table"]
+        columns = message["columns"]
+        SQL = "INSERT INTO `%s` (%s) VALUES (%s) ON DUPLICATE KEY UPDATE `%s`=`%s`" % \
+              (table,
+               ",".join(["`%s`" % c for c in columns]),
+               ",".join(["%s"] * len(columns)),
+               message["key"], message["key"])
+        rows = message["rows"]
+        cursor = conn.cursor(buffered=True)
         try:
-            onboard_cursor.execute("select id, name, timestamp, value, channel from status where (name = '%(name)s' and timestamp > ((select max(timestamp) from status where name = '%(name)s') - %(recordTime)f))" % vars())
-            records = onboard_cursor.fetchall()
+            conn.start_transaction()
+            if message["last"] is not None:
+                cursor.execute("SELECT last_id FROM sync_state WHERE tbl=%s FOR UPDATE", (table, ))
+                row = cursor.fetchone()
+                mark = row[0] if row else 0
+                if mark < message["first"]:
+                    raise Exception("Batch of %s starts at %s, but the ground only has up to %s" %
+                                    (table, message["first"], mark))
+                index = columns.index(message["key"])
+                rows = [row for row in rows if row[index] > mark]
+            if rows:
+                cursor.executemany(SQL, [tuple([decode_value(v) for v in row]) for row in rows])
+            if message["last"] is not None and message["last"] > mark:
+                cursor.execute("REPLACE INTO sync_state (tbl, last_id) VALUES (%s, %s)", (table, message["last"]))
+            conn.commit()
         except:
-            self._lost_connection("fast")
-
-    def run(self, stop_event, verbose=False):
-        while not stop_event.is_set():
-            self._run(verbose)
-            stop_event.wait(self.period)
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
 
-    def _run(self, verbose=False):
-        with self._lock:
-
-            if "fast" in self._connections:
-                try:
-                    conn = "fast"
-                    c = self._connections[conn]
-                    cursor = c.cursor()
-                    cursor.execute("execute last_values")
-                except:
-                    self._lost_connection(conn)
-
-            elif "slow" in self._connections:
-                try:
-                    conn = "slow"
-                    c = self._connections[conn]
-                    cursor = c.cursor()
-                    cursor.execute("execute IMU_Lon_and_Lat")
-                except:
-                    self._lost_connection(conn)
-            else:
-                self.log.warning("No connection to the plane")
-                return
-
-        ground_cursor = self._db_conn.cursor()
-
-        for row in onboard_cursor.fetchall():
-            if conn == "slow":  # TODO: What does this code do then?
-                # if not self.onboard_con:
-                # We must add the channel which was not retrieved because we have to save bytes in the communication
-                row = row + ('IMU',)
-
-            ground_cursor.execute("insert into status " +
-                                      "(onboard_id, name, timestamp, value, channel, inserted) " +
-                                      "values (\'%s\', \'%s\', \'%s\', \'%s\', \'%s\', now())" % tuple(row))
-            self._db_conn.commit()
-
-        if verbose:
-            try:
-                ground_cursor.execute("select distinct on (name, channel) id, timestamp, inserted, onboard_id, channel, name, value from status where id >= (select max(id) from status)-(select count(*) from (select distinct on (name, channel) name, channel from status) foo)")
-                SyncDB._pretty_ground_status(ground_cursor.fetchall())
-            except:
-                self.logs.exception("It could not retrieve the data from the ground database")
-                print("Ground database failed")
-        ground_cursor.close()
-
-    @staticmethod
-    def _pretty_ground_status(list):
-        print("    id   | timestamp         |          inserted          | onboard_id |      channel      |         name         | value  " +
-            "\n---------+-------------------+----------------------------+------------+-------------------+----------------------+--------")
-        for row in list:
-            print(" %7d | %9f | %26s | %10i | %17s | %20s | %8s " % (row[0], row[1], str(row[2]), row[3], row[4], row[5], row[6]))
-        print("===============================================")
-
-###################################################################
-# Code to be executed when this module is called by the interpreter
 
 if __name__ == '__main__':
-    s = SyncDB.getInstance()
-
-    if s.getReady(5):
-        s.run(threading.Event(), verbose=True)
+    parser = ArgumentParser(description="Synchronize status and log to the ground")
+    parser.add_argument("links", nargs="*", default=["fast", "slow"],
+                        help="Links to sync over (onboard)")
+    parser.add_argument("--ground", action="store_true", default=False,
+                        help="Run the ground side")
+    parser.add_argument("--port", type=int, default=7780,
+                        help="Port to listen to on the ground")
+    parser.add_argument("--rebase", nargs="+", default=[],
+                        help="Tables to start over on the ground after their onboard ids were reset")
+    options = parser.parse_args()
+
+    try:
+        if options.ground:
+            threads = [GroundReceiver(options.port)]
+            if options.rebase:
+                threads[0].rebase(options.rebase)
+        else:
+            threads = [SyncDB(link) for link in options.links]
+        for t in threads:
+            t.start()
+        while not API.api_stop_event.is_set():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        API.shutdown()
@@ -3,6 +3,7 @@ os.chdir(os.path.dirname(__file__))
 import db
 import json
 from CryoCore import API
+from CryoCore.GUI.Web import BinaryData
 API.__is_direct = True
 
 import time
@@ -89,20 +90,34 @@ def list_channels_and_params_full(req):
     return json.dumps({"channels": channelsAndParams})
 
 
-def getmax(req, params, start, end, since=None, since2d=None, aggregate=None):
+def getmax(req, params, start, end, since=None, since2d=None, aggregate=None, format=None):
+    """
+    format="binary" returns typed arrays (see GUI.Web.BinaryData) rather than JSON
+    """
     params = json.loads(params)
     max_id, dataset = db.get_db().get_max_data(params, float(start), float(end), int(since), aggregate)
+    if format == "binary":
+        return BinaryData.encode({"max_id": max_id}, {"max": sorted(dataset.items())})
     return json.dumps({"max_id": max_id, "data": dataset})
 
 
-def get(req, params, start, end, since=0, since2d=0, aggregate=None):
+def get(req, params, start, end, since=0, since2d=0, aggregate=None, format=None, points=None, method="lttb"):
+    """
+    format="binary" returns typed arrays (see GUI.Web.BinaryData) rather than JSON.
+    points limits the number of values per parameter, reduced using
+    method "lttb" or "minmax"
+    """
     params = json.loads(params)
     if int(since) == 0:
         get_last_values = True
     else:
         get_last_values = False
 
-    max_id, max_id2d, dataset = db.get_db().get_data(params, float(start), float(end), int(since), int(since2d), aggregate, get_last_values)
+    binary = format == "binary"
+    max_id, max_id2d, dataset = db.get_db().get_data(params, float(start), float(end), int(since), int(since2d), aggregate, get_last_values,
+                                                     columnar=binary, points=points, method=method)
+    if binary:
+        return BinaryData.encode({"max_id": max_id, "max_id2d": max_id2d, "glv": get_last_values}, dataset)
     # print("GET:", json.dumps({"max_id": max_id, "max_id2d": max_id2d, "data": dataset, "glv": get_last_values}))
     return json.dumps({"max_id": max_id, "max_id2d": max_id2d, "data": dataset, "glv": get_last_values})
 
@@ -4,6 +4,7 @@ import time
 from CryoCore import API
 from CryoCore.Tools import TailLog
 from CryoCore.Core.InternalDB import mysql as sqldb
+from CryoCore.Core.Status import StatusDbReader, Downsample
 
 channel_ids = {}
 param_ids = {}
@@ -190,6 +191,17 @@ value TEXT)""",
         except:
             return {}
 
+    def get_last_change(self):
+        """
+        Return the largest ids of status values and parameters, these
+        change whenever something is added and are used as ETag validators
+        """
+        cursor = self._execute("SELECT (SELECT MAX(id) FROM status), (SELECT MAX(id) FROM status2d), "
+                               "(SELECT MAX(paramid) FROM status_parameter), "
+                               "(SELECT MAX(paramid) FROM status_parameter2d)")
+        row = cursor.fetchone()
+        return {"status": (row[0], row[1]), "params": (row[2], row[3])}
+
     def get_op_clock(self, session, max_time=None, since=0):
         # Must get the max op_clock of all params of a session
         params = [since]
@@ -269,7 +281,14 @@ value TEXT)""",
 
         return params
 
-    def get_data(self, params, start_time, end_time, since=0, since2d=0, aggregate=None, lastValues=False):
+    def get_data(self, params, start_time, end_time, since=0, since2d=0, aggregate=None, lastValues=False,
+                 columnar=False, points=None, method="lttb"):
+        """
+        If columnar is True, 1D parameters are returned as (timestamps, values)
+        numpy arrays rather than lists of (ts, value) tuples.
+        If points is given, each 1D parameter is reduced to at most that
+        many points using method "lttb" or "minmax" (see Downsample)
+        """
         if len(params) == 0:
             raise Exception("No parameters given")
 
@@ -289,7 +308,19 @@ value TEXT)""",
             SQL = SQL[:-4] + ") GROUP BY paramid, timestamp DIV %s" % float(aggregate)
         else:
             SQL = SQL[:-4] + ") ORDER BY paramid, timestamp"
-        if len(p) > 3:
+        if len(p) > 3 and (columnar or points):
+            builder = StatusDbReader.ColumnBuilder()
+            for i, p, ts, v in self._iterate(SQL, p):
+                max_id = max(max_id, i)
+                builder.add(p, ts, v)
+            for param, (ts, values) in builder.get_columns().items():
+                if points:
+                    ts, values = Downsample.downsample(ts, values, int(points), method)
+                if columnar:
+                    dataset[param] = (ts, values)
+                else:
+                    dataset[param] = list(zip(ts.tolist(), values.tolist()))
+        elif len(p) > 3:
             cursor = self._execute(SQL, p)
             for i, p, ts, v in cursor.fetchall():
                 max_id = max(max_id, i)
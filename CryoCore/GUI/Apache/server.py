@@ -1,16 +1,17 @@
 import http.server
 import select
 import JSON
-import io
-import gzip
 import urllib
 import urllib
 import inspect
 import mimetypes
 import os
 import json
+import threading
+import time
 
 from CryoCore import API
+from CryoCore.GUI.Web import HTTPUtils, BinaryData
 
 # We also allow shared memory status listener if possible
 try:
@@ -22,6 +23,33 @@ except:
 
 functions = {o[0]: o[1] for o in inspect.getmembers(JSON) if inspect.isfunction(o[1])}
 
+
+def _status_validator(args):
+    return JSON.db.get_db().get_last_change()["status"]
+
+
+def _params_validator(args):
+    return JSON.db.get_db().get_last_change()["params"]
+
+
+def _config_validator(args):
+    version = args.get("version") or "default"
+    return API.get_config(args.get("root"), version=version).config_validator(version)
+
+
+def _versions_validator(args):
+    return API.get_config().versions_validator()
+
+# Functions whose results only change when the validator does - unchanged
+# results are answered with "304 Not Modified" without calling them
+validators = {
+    "get": _status_validator,
+    "getmax": _status_validator,
+    "list_channels_and_params_full": _params_validator,
+    "cfg_serialize": _config_validator,
+    "cfg_versions": _versions_validator
+}
+
 from SimpleWebSocketServer import SimpleWebSocketServer, WebSocket
 
 
@@ -69,26 +97,37 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             args = {}
         return args
 
-    def _send_text(self, text, mimetype="application/json", response=200, content_range=None):
-        # Only compress text if > 100 bytes
-        if self._compress and len(text) > 100:
-            encoding = "gzip"
-            compressed = io.BytesIO()
-            zipped = gzip.GzipFile(mode="w", fileobj=compressed,
-                                   compresslevel=9)
-            zipped.write(text.encode("utf-8"))
-            zipped.close()
-            text = compressed.getvalue()
-        else:
-            encoding = None
+    def _send_text(self, text, mimetype="application/json", response=200, content_range=None,
+                   etag=None, last_modified=None):
+        if not isinstance(text, bytes):
             text = text.encode("utf-8")
+        # Only compress text if > 100 bytes
+        encoding = None
+        if self._encoding and HTTPUtils.is_compressible(mimetype) and len(text) > HTTPUtils.MIN_COMPRESS_SIZE:
+            encoding = self._encoding
+            text = HTTPUtils.compress(text, encoding)
 
         self.prepare_send(mimetype, len(text), encoding=encoding,
-                          response=response, content_range=content_range, cache="no-cache")
+                          response=response, content_range=content_range, cache="no-cache",
+                          etag=etag, last_modified=last_modified)
         self.wfile.write(text)
         # self.wfile.close()
 
-    def prepare_send(self, type, size=None, response=200, encoding=None, content_range=None, cache=None):
+    def _not_modified(self, etag, last_modified=None):
+        """
+        Send "304 Not Modified" and return True if the client has the
+        current version already
+        """
+        if not HTTPUtils.is_not_modified(self.headers, etag, last_modified):
+            return False
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", 0)
+        self.end_headers()
+        return True
+
+    def prepare_send(self, type, size=None, response=200, encoding=None, content_range=None, cache=None,
+                     etag=None, last_modified=None):
         try:
             self.send_response(response)
         except Exception as e:
@@ -111,6 +150,11 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             self.send_header("Content-Encoding", encoding)
         if cache:
             self.send_header("Cache-Control", cache)
+        if etag:
+            self.send_header("ETag", etag)
+        if last_modified:
+            self.send_header("Last-Modified", HTTPUtils.http_date(last_modified))
+        self.send_header("Vary", "Accept-Encoding")
         self.end_headers()
 
     def failed(self, code, message=None):
@@ -130,10 +174,7 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
         path = self.getPath(strip_args=True)
         args = self._get_params()
 
-        self._compress = False
-        if "Accept-Encoding" in self.headers:
-            if "gzip" in self.headers["Accept-Encoding"]:
-                self._compress = True
+        self._encoding = HTTPUtils.negotiate_encoding(self.headers.get("Accept-Encoding"))
 
         # Check if we provide the requested method
         if path.startswith("/JSON.py/"):
@@ -141,8 +182,17 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             path = path[9:]
             try:
                 if path in functions:
+                    etag = last_modified = None
+                    if path in validators:
+                        validator = validators[path](args)
+                        etag = HTTPUtils.make_etag(validator, self.path, self._encoding)
+                        if self._not_modified(etag, last_modified):
+                            return
                     ret = functions[path](self, **args)
-                    self._send_text(ret)
+                    if isinstance(ret, bytes):
+                        self._send_text(ret, BinaryData.MIMETYPE, etag=etag, last_modified=last_modified)
+                    else:
+                        self._send_text(ret, etag=etag, last_modified=last_modified)
                     return  # ALL OK
                 else:
                     return self.failed(404)
@@ -230,43 +280,119 @@ def getStatusListener():
     return statusListener
 
 
-class LiveHandler(WebSocket):
+class LiveHub:
     """
-    Handle requests for live updates
+    Route status updates to the sockets subscribing to them. Updates are
+    coalesced per socket (only the newest value of each parameter is
+    kept) and sent as one message per socket every frame.
     """
-    last_vals = {}
-    stopped = False
 
-    def monitorThread(self):
-        # last_vals is a map with {(chan, param): (value, timestamp)}
+    def __init__(self, listener, frame_rate=10):
+        self.listener = listener
+        self.frame_interval = 1.0 / frame_rate
+        self._lock = threading.Lock()
+        self._subscribers = {}  # (chan, param) -> set of sockets
+        self._subscriptions = {}  # socket -> set of (chan, param)
+        self._pending = {}  # socket -> {(chan, param): value}
+        self._has_pending = threading.Event()
+        listener.add_callback(self._on_update)
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def subscribe(self, socket, items):
+        with self._lock:
+            subscriptions = self._subscriptions.setdefault(socket, set())
+            for item in items:
+                self._subscribers.setdefault(item, set()).add(socket)
+                subscriptions.add(item)
+        self.listener.add_monitors(items)
+
+        # Send what we have right away
+        current = self.listener.get_last_values(items)
+        with self._lock:
+            pending = self._pending.setdefault(socket, {})
+            for item in items:
+                if current[item] is not None:
+                    pending[item] = current[item]
+        self._has_pending.set()
+
+    def unsubscribe(self, socket, items):
+        with self._lock:
+            for item in items:
+                self._remove(socket, item)
+
+    def remove(self, socket):
+        """
+        Remove all subscriptions of a closed socket
+        """
+        with self._lock:
+            for item in list(self._subscriptions.get(socket, [])):
+                self._remove(socket, item)
+            self._subscriptions.pop(socket, None)
+            self._pending.pop(socket, None)
+
+    def _remove(self, socket, item):
+        if item in self._subscribers:
+            self._subscribers[item].discard(socket)
+            if len(self._subscribers[item]) == 0:
+                del self._subscribers[item]
+        if socket in self._subscriptions:
+            self._subscriptions[socket].discard(item)
+        if socket in self._pending:
+            self._pending[socket].pop(item, None)
+
+    def _on_update(self, updates):
+        with self._lock:
+            for d in updates:
+                key = (d["channel"], d["name"])
+                for socket in self._subscribers.get(key, []):
+                    self._pending.setdefault(socket, {})[key] = d
+        self._has_pending.set()
+
+    def _run(self):
+        while not API.api_stop_event.is_set():
+            if not self._has_pending.wait(1.0):
+                continue
+            self._has_pending.clear()
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+            for socket, values in pending.items():
+                if len(values) == 0:
+                    continue
+                try:
+                    socket.sendMessage(json.dumps({"type": "update", "values": list(values.values())}))
+                except Exception as e:
+                    print("Failed to send live update to", socket.address, e)
+            # Collect updates for a frame before sending again
+            time.sleep(self.frame_interval)
 
-        print(" *** Monitor thread started", self.last_vals.keys())
 
-        # Check for all of the chan, param subscriptions and send any updates
-        listener = getStatusListener()
-        while not self.stopped:
+global liveHub
+liveHub = None
 
-            tosend = []
 
-            vals = listener.get_last_values(self.last_vals.keys())
-            for i in vals:
-                val = vals[i]
-                if val is None:
-                    continue
+def getLiveHub():
+    global liveHub
+    if not liveHub:
+        liveHub = LiveHub(getStatusListener(), API.get_config("System.WebServer")["live_frame_rate"])
+    return liveHub
 
-                if i in self.last_vals and self.last_vals[i] and self.last_vals[i]["ts"] < val["ts"]:
-                    tosend.append(val)
-                    # updated
-                    # tosend["|".join(i)] = val
-                    self.last_vals[i] = val
 
-            if len(tosend) > 0:
-                self.sendMessage(json.dumps({"type": "update", "values": tosend}))
+class LiveHandler(WebSocket):
+    """
+    Handle requests for live updates
+    """
 
-            listener.wait(3.0)  # Wait for any updates
+    def _get_items(self, req):
+        items = []
+        for chan in req["channels"]:
+            for param in req["channels"][chan]:
+                items.append((chan, param))
+        return items
 
     def handleMessage(self):
-        print("GOT LIVE REQUEST", self.data)
         try:
             req = json.loads(self.data)
         except Exception as e:
@@ -277,28 +403,14 @@ class LiveHandler(WebSocket):
 
         try:
             if req["type"] == "subscribe":
-                items = []
-                for chan in req["channels"]:
-                    print("Channel", chan)
-                    for param in req["channels"][chan]:
-                        print("Param", param, req["channels"][chan]);
-                        print("Subscribe to", chan, param)
-                        items.append((chan, param))
-                        self.last_vals[(chan, param)] = {"ts": 0}
+                items = self._get_items(req)
                 if len(items) > 0:
-                    getStatusListener().add_monitors(items)
+                    getLiveHub().subscribe(self, items)
 
             elif req["type"] == "unsubscribe":
-                items = []
-                for chan in req["channels"]:
-                    print("Channel", chan)
-                    for param in req["channels"][chan]:
-                        if (chan, param) in self.last_vals:
-                            del self.last_vals[(chan, param)]
-
-                    # StatusListener don't support removing things yet
-                    # getStatusListener().remove_monitors(items)
-
+                # StatusListener don't support removing things yet, but
+                # we stop sending them
+                getLiveHub().unsubscribe(self, self._get_items(req))
 
         except Exception as e:
             print("Badly shaped live request", req, e)
@@ -306,16 +418,10 @@ class LiveHandler(WebSocket):
 
     def handleConnected(self):
         print("Got LIVE connect from", self.address)
-        self.last_vals = {}
-
-        # Start a thread to check for changes
-        t = threading.Thread(target=self.monitorThread)
-        t.start()
 
     def handleClose(self):
         print("Closed LIVE connection from", self.address)
-        # The statuslistener doesn't support unsubscribing, otherwise we'd clean up here
-        self.stopped = True
+        getLiveHub().remove(self)
 
 try:
     cfg = API.get_config("System.WebServer")
@@ -324,6 +430,7 @@ try:
 
     cfg.set_default("live_port", 8081)
     cfg.set_default("enable_live", False)
+    cfg.set_default("live_frame_rate", 10)
 
 
     log = API.get_log("System.WebServer")
@@ -332,14 +439,14 @@ try:
             print("ERROR: Live is enabled, but no shared memory status listener is available")
             log.error("Live is enabled, but no shared memory status listener is available")
         else:
-            import time
             def run_until_stopped(s):
                 while not API.api_stop_event.is_set():
                     s.serveonce()
-                    time.sleep(0.050)
 
-            # Start the web socket server
-            server = SimpleWebSocketServer('', int(cfg["live_port"]), LiveHandler)
+            # Start the web socket server - serveonce blocks in select, and
+            # queued updates are written at least once per frame
+            server = SimpleWebSocketServer('', int(cfg["live_port"]), LiveHandler,
+                                           selectInterval=1.0 / cfg["live_frame_rate"])
             t = threading.Thread(target=run_until_stopped, args=(server,))
             t.start()
 
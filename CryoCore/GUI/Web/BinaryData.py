@@ -0,0 +1,110 @@
+"""
+Binary encoding of time series for the plot endpoints, an alternative
+to JSON lists of [ts, value] pairs.
+
+Layout (all little endian):
+  uint32       length of the JSON header
+  header       JSON, padded with spaces to a multiple of 8 bytes (incl. length)
+  for each entry in header["columns"]:
+    uint32     number of points n
+    uint32     reserved (0), keeps the arrays 8 byte aligned
+    float64[n] timestamps
+    float64[n] values
+
+Arrays are aligned, so browsers can use them directly as
+new Float64Array(buffer, offset, n) without copying.  Series that are
+not numeric (2D values, text) are put in header["data"] as JSON.
+
+Requires numpy
+"""
+import json
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MIMETYPE = "application/octet-stream"
+
+_LENGTH = struct.Struct("<I")
+_COUNT = struct.Struct("<II")
+
+
+def _as_columns(series):
+    """
+    Return (timestamps, values) as float64 arrays, or None if the series
+    isn't numeric
+    """
+    if isinstance(series, tuple) and len(series) == 2 and hasattr(series[0], "dtype"):
+        ts, values = series
+    else:
+        ts = [s[0] for s in series]
+        values = [s[1] for s in series]
+    try:
+        ts = numpy.asarray(ts, dtype="<f8")
+        values = numpy.asarray(values, dtype="<f8")
+    except (ValueError, TypeError):
+        return None
+    if ts.ndim != 1 or values.ndim != 1 or len(ts) != len(values):
+        return None  # 2D values
+    return (ts, values)
+
+
+def _to_json(series):
+    if isinstance(series, tuple) and len(series) == 2 and hasattr(series[0], "dtype"):
+        return [[float(t), v.tolist() if hasattr(v, "tolist") else v] for t, v in zip(series[0], series[1])]
+    return series
+
+
+def encode(header, dataset):
+    """
+    Encode dataset {key: (timestamps, values) or [(ts, value), ...]}.
+    header is a dict with anything else to return (e.g. max_id).
+    Returns bytes.
+    """
+    if numpy is None:
+        raise Exception("Binary data requires numpy")
+    header = dict(header)
+    header["columns"] = []
+    header["data"] = {}
+    arrays = []
+    for key, series in dataset.items():
+        columns = _as_columns(series)
+        if columns is None:
+            header["data"][key] = _to_json(series)
+            continue
+        header["columns"].append({"param": key, "n": len(columns[0])})
+        arrays.append(columns)
+
+    header_data = json.dumps(header).encode("utf-8")
+    header_data += b" " * (-(_LENGTH.size + len(header_data)) % 8)
+    parts = [_LENGTH.pack(len(header_data)), header_data]
+    for ts, values in arrays:
+        parts.append(_COUNT.pack(len(ts), 0))
+        parts.append(ts.tobytes())
+        parts.append(values.tobytes())
+    return b"".join(parts)
+
+
+def decode(data):
+    """
+    Decode to (header, {key: (timestamps, values)}), mostly for python
+    clients and testing
+    """
+    if numpy is None:
+        raise Exception("Binary data requires numpy")
+    length = _LENGTH.unpack_from(data, 0)[0]
+    pos = _LENGTH.size
+    header = json.loads(data[pos:pos + length].decode("utf-8"))
+    pos += length
+    dataset = {}
+    for column in header["columns"]:
+        n = _COUNT.unpack_from(data, pos)[0]
+        pos += _COUNT.size
+        ts = numpy.frombuffer(data, dtype="<f8", count=n, offset=pos)
+        pos += 8 * n
+        values = numpy.frombuffer(data, dtype="<f8", count=n, offset=pos)
+        pos += 8 * n
+        dataset[column["param"]] = (ts, values)
+    return header, dataset
@@ -0,0 +1,107 @@
+"""
+Helpers for compressed and conditional HTTP responses, shared by the
+web servers.
+
+Data responses are tagged with an ETag derived from a validator that
+changes whenever the underlying data does (e.g. the largest status id or
+the config update time). If the client already has the current version,
+a "304 Not Modified" is returned without running the query at all.
+"""
+import email.utils
+import gzip
+import hashlib
+import io
+import zlib
+
+# Don't bother compressing tiny replies
+MIN_COMPRESS_SIZE = 100
+
+COMPRESSIBLE_TYPES = ["application/json", "application/javascript", "image/svg+xml"]
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Pick the content encoding to use from an Accept-Encoding header,
+    "gzip", "deflate" or None
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        parts = item.strip().split(";")
+        q = 1.0
+        for p in parts[1:]:
+            p = p.strip()
+            if p.startswith("q="):
+                try:
+                    q = float(p[2:])
+                except ValueError:
+                    q = 0
+        accepted[parts[0].strip().lower()] = q
+    for encoding in ["gzip", "deflate"]:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def is_compressible(mimetype):
+    if not mimetype:
+        return False
+    mimetype = mimetype.split(";")[0].strip()
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+
+
+def compress(data, encoding, level=6):
+    """
+    Compress bytes with the given content encoding
+    """
+    if encoding == "gzip":
+        buf = io.BytesIO()
+        zipped = gzip.GzipFile(mode="wb", fileobj=buf, compresslevel=level)
+        zipped.write(data)
+        zipped.close()
+        return buf.getvalue()
+    if encoding == "deflate":
+        return zlib.compress(data, level)
+    return data
+
+
+def make_etag(validator, *keys):
+    """
+    Create a (strong) ETag from a validator and anything else identifying
+    the response, typically the request path and the content encoding
+    """
+    h = hashlib.sha1()
+    for item in (validator,) + keys:
+        h.update(str(item).encode("utf-8"))
+        h.update(b"\0")
+    return '"%s"' % h.hexdigest()[:20]
+
+
+def http_date(timestamp):
+    return email.utils.formatdate(float(timestamp), usegmt=True)
+
+
+def is_not_modified(headers, etag=None, last_modified=None):
+    """
+    Check the conditional request headers. If-None-Match takes precedence
+    over If-Modified-Since as in RFC 7232
+    """
+    if etag and "If-None-Match" in headers:
+        tags = [t.strip() for t in headers["If-None-Match"].split(",")]
+        if "*" in tags:
+            return True
+        for tag in tags:
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
+
+    if last_modified and "If-Modified-Since" in headers:
+        try:
+            since = email.utils.mktime_tz(email.utils.parsedate_tz(headers["If-Modified-Since"]))
+        except (TypeError, ValueError, OverflowError):
+            return False
+        return int(last_modified) <= since
+    return False
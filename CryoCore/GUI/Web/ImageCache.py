@@ -0,0 +1,172 @@
+"""
+Two level (memory + disk) LRU cache for rendered images.
+
+Each entry is an info dict (headers) and the image data. Recently used
+entries are kept in memory, all entries are also written to disk, where
+the least recently used files are removed when the disk budget is
+exceeded. Disk entries are written to a temporary file and renamed, so
+concurrent readers never see partial files.
+
+Usage:
+  cache = ImageCache("/tmp/cache", memory_size=64 * 1048576)
+  result = cache.get(key)
+  if result is None:
+      info, data = render()
+      cache.put(key, info, data)
+"""
+import os
+import os.path
+import json
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+HEADER = struct.Struct("<I")
+
+
+class ImageCache:
+
+    def __init__(self, directory, memory_size=64 * 1048576, disk_size=1024 * 1048576, status=None):
+        """
+        memory_size and disk_size are the budgets in bytes. If status
+        is given, hit and miss counters are reported there.
+        """
+        self.directory = directory
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.status = status
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._disk = OrderedDict()
+        self._disk_used = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # Made by someone else
+        self._load_disk_index()
+
+    def _load_disk_index(self):
+        """
+        Pick up entries from earlier runs, oldest first
+        """
+        files = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".img"):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, filename, stat.st_size))
+        files.sort()
+        for mtime, filename, size in files:
+            self._disk[filename] = size
+            self._disk_used += size
+        with self._lock:
+            self._evict_disk()
+
+    def _filename(self, key):
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".img"
+
+    def get(self, key):
+        """
+        Return (info, data) or None if not cached
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory[key] = self._memory.pop(key)  # Most recently used
+                self.hits += 1
+                self._report()
+                return self._memory[key]
+
+        filename = self._filename(key)
+        entry = self._read(os.path.join(self.directory, filename))
+        with self._lock:
+            if entry is None:
+                self._disk.pop(filename, None)
+                self.misses += 1
+            else:
+                if filename in self._disk:
+                    self._disk[filename] = self._disk.pop(filename)
+                self.disk_hits += 1
+                self._add_memory(key, entry)
+            self._report()
+        return entry
+
+    def put(self, key, info, data):
+        filename = self._filename(key)
+        path = os.path.join(self.directory, filename)
+        info_data = json.dumps(info).encode("utf-8")
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp, "wb") as f:
+                f.write(HEADER.pack(len(info_data)))
+                f.write(info_data)
+                f.write(data)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            # Disk trouble (full?) - still keep it in memory
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            path = None
+
+        with self._lock:
+            if path:
+                size = HEADER.size + len(info_data) + len(data)
+                self._disk_used += size - self._disk.pop(filename, 0)
+                self._disk[filename] = size
+                self._evict_disk()
+            self._add_memory(key, (info, data))
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                length = HEADER.unpack(f.read(HEADER.size))[0]
+                info = json.loads(f.read(length).decode("utf-8"))
+                data = f.read()
+        except (IOError, OSError, ValueError, struct.error):
+            return None
+        try:
+            os.utime(path, None)  # Keep LRU order across restarts
+        except OSError:
+            pass
+        return (info, data)
+
+    def _add_memory(self, key, entry):
+        size = len(entry[1])
+        if size > self.memory_size:
+            return
+        if key in self._memory:
+            self._memory_used -= len(self._memory.pop(key)[1])
+        self._memory[key] = entry
+        self._memory_used += size
+        while self._memory_used > self.memory_size:
+            k, e = self._memory.popitem(last=False)
+            self._memory_used -= len(e[1])
+
+    def _evict_disk(self):
+        while self._disk_used > self.disk_size and len(self._disk) > 0:
+            filename, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+
+    def _report(self):
+        if self.status is None:
+            return
+        self.status["image_cache.hits"] = self.hits
+        self.status["image_cache.disk_hits"] = self.disk_hits
+        self.status["image_cache.misses"] = self.misses
+        self.status["image_cache.memory_used"] = self._memory_used
+        self.status["image_cache.disk_used"] = self._disk_used
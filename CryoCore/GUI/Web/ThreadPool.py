@@ -0,0 +1,149 @@
+"""
+Thread pool for the web servers. Requests are accepted by the server
+thread and queued for a fixed number of workers, so slow database calls
+in one handler do not block everybody else.
+
+If the queue is full, new connections are answered with
+"503 Service Unavailable" immediately rather than piling up.
+
+Usage:
+  class MyWebServer(ThreadPoolMixIn, BaseHTTPServer.HTTPServer):
+      pass
+
+  server = MyWebServer(address, handler)
+  server.start_workers(num_workers=16, max_queue=64, status=status)
+  while ...:
+      server.handle_request()
+  server.stop_workers()
+"""
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+BUSY_RESPONSE = b"HTTP/1.1 503 Service Unavailable\r\n" \
+                b"Retry-After: 1\r\n" \
+                b"Content-Length: 0\r\n" \
+                b"Connection: close\r\n\r\n"
+
+
+class ThreadPoolMixIn:
+    """
+    Mix-in for SocketServer servers handling requests with a bounded
+    pool of worker threads
+    """
+
+    num_workers = 16
+    max_queue = 64
+    publish_interval = 5.0
+
+    def start_workers(self, num_workers=None, max_queue=None, status=None):
+        """
+        Start the workers. If status is given, request metrics are
+        published as status elements every publish_interval seconds.
+        """
+        if num_workers:
+            self.num_workers = num_workers
+        if max_queue:
+            self.max_queue = max_queue
+        self._pool_status = status
+        self._pool_queue = queue.Queue(self.max_queue)
+        self._pool_stop = threading.Event()
+        self._pool_lock = threading.Lock()
+        self._pool_busy = 0
+        self._reset_metrics()
+        self._last_publish = time.time()
+        self._pool_threads = []
+        for i in range(0, self.num_workers):
+            t = threading.Thread(target=self._pool_worker, name="WebWorker-%d" % i)
+            t.daemon = True
+            t.start()
+            self._pool_threads.append(t)
+
+    def stop_workers(self):
+        self._pool_stop.set()
+        for t in self._pool_threads:
+            t.join(2.0)
+
+    def is_busy(self):
+        """
+        True if requests are waiting for a worker - handlers use this to
+        close keep-alive connections to make room
+        """
+        return self._pool_queue.qsize() > 0
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, "_pool_queue"):
+            self.start_workers()
+        try:
+            self._pool_queue.put_nowait((request, client_address))
+        except queue.Full:
+            with self._pool_lock:
+                self._rejected += 1
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except Exception:
+                pass
+            self.shutdown_request(request)
+
+    def _pool_worker(self):
+        while not self._pool_stop.is_set():
+            try:
+                request, client_address = self._pool_queue.get(timeout=1.0)
+            except queue.Empty:
+                self._publish_metrics()
+                continue
+            with self._pool_lock:
+                self._pool_busy += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._pool_lock:
+                    self._pool_busy -= 1
+            self._publish_metrics()
+
+    def _reset_metrics(self):
+        self._requests = 0
+        self._rejected = 0
+        self._latency_total = 0
+        self._latency_max = 0
+
+    def record_request(self, latency):
+        """
+        Called by the handler when a request is completed
+        """
+        with self._pool_lock:
+            self._requests += 1
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+
+    def _publish_metrics(self):
+        if self._pool_status is None:
+            return
+        now = time.time()
+        with self._pool_lock:
+            if now - self._last_publish < self.publish_interval:
+                return
+            interval = now - self._last_publish
+            self._last_publish = now
+            requests = self._requests
+            rejected = self._rejected
+            latency_total = self._latency_total
+            latency_max = self._latency_max
+            busy = self._pool_busy
+            self._reset_metrics()
+
+        self._pool_status["requests_per_sec"] = requests / interval
+        self._pool_status["rejected"] = rejected
+        if requests:
+            self._pool_status["latency_avg"] = latency_total / requests
+        else:
+            self._pool_status["latency_avg"] = 0
+        self._pool_status["latency_max"] = latency_max
+        self._pool_status["busy_workers"] = busy
+        self._pool_status["queue_length"] = self._pool_queue.qsize()
@@ -8,8 +8,6 @@ import threading
 import time
 import re
 import random
-import gzip
-import io
 import json
 import cgi
 import hashlib
@@ -22,7 +20,6 @@ else:
     import BaseHTTPServer
     import SocketServer
     import urllib
-    from StringIO import StringIO
 
 # import MySQLdb
 import mysql.connector as MySQLdb
@@ -37,6 +34,10 @@ except:
     pass  # No HUD support for Google Glass
 
 from CryoCore.Core.InternalDB import mysql as sqldb
+from CryoCore.Core.Status import StatusDbReader, Downsample
+from CryoCore.GUI.Web.ThreadPool import ThreadPoolMixIn
+from CryoCore.GUI.Web import HTTPUtils, BinaryData
+from CryoCore.GUI.Web.ImageCache import ImageCache
 
 # Verbose error messages from CGI module
 import cgitb
@@ -257,6 +258,17 @@ value TEXT)"""]
         except:
             return {}
 
+    def get_last_change(self):
+        """
+        Return the largest ids of status values and parameters, these
+        change whenever something is added and are used as ETag validators
+        """
+        cursor = self._execute("SELECT (SELECT MAX(id) FROM status), (SELECT MAX(id) FROM status2d), "
+                               "(SELECT MAX(paramid) FROM status_parameter), "
+                               "(SELECT MAX(paramid) FROM status_parameter2d)")
+        row = cursor.fetchone()
+        return {"status": (row[0], row[1]), "params": (row[2], row[3])}
+
     def get_op_clock(self, session, max_time=None, since=0):
         # Must get the max op_clock of all params of a session
         params = [since]
@@ -336,7 +348,14 @@ value TEXT)"""]
 
         return params
 
-    def get_data(self, params, start_time, end_time, since=0, since2d=0, aggregate=None):
+    def get_data(self, params, start_time, end_time, since=0, since2d=0, aggregate=None, columnar=False,
+                 points=None, method="lttb"):
+        """
+        If columnar is True, 1D parameters are returned as (timestamps, values)
+        numpy arrays rather than lists of (ts, value) tuples.
+        If points is given, each 1D parameter is reduced to at most that
+        many points using method "lttb" or "minmax" (see Downsample)
+        """
         if len(params) == 0:
             raise Exception("No parameters given")
         print("Getting data between %s and %s (%s)" % (float(start_time) - time.time(), float(end_time) - time.time(), start_time))
@@ -355,7 +374,19 @@ value TEXT)"""]
             SQL = SQL[:-4] + ") GROUP BY paramid, timestamp DIV %d" % aggregate
         else:
             SQL = SQL[:-4] + ") ORDER BY paramid, timestamp"
-        if len(p) > 3:
+        if len(p) > 3 and (columnar or points):
+            builder = StatusDbReader.ColumnBuilder()
+            for i, p, ts, v in self._iterate(SQL, p):
+                max_id = max(max_id, i)
+                builder.add(p, ts, v)
+            for param, (ts, values) in builder.get_columns().items():
+                if points:
+                    ts, values = Downsample.downsample(ts, values, int(points), method)
+                if columnar:
+                    dataset[param] = (ts, values)
+                else:
+                    dataset[param] = list(zip(ts.tolist(), values.tolist()))
+        elif len(p) > 3:
             cursor = self._execute(SQL, p)
             for i, p, ts, v in cursor.fetchall():
                 max_id = max(max_id, i)
@@ -442,7 +473,7 @@ value TEXT)"""]
         return res
 
 
-class MyWebServer(BaseHTTPServer.HTTPServer):
+class MyWebServer(ThreadPoolMixIn, BaseHTTPServer.HTTPServer):
     """
     Non-blocking, multi-threaded IPv6 enabled web server
     """
@@ -461,24 +492,6 @@ class MyWebServer(BaseHTTPServer.HTTPServer):
         else:
             return None
 
-# TODO: Implement class ThreadPoolMixIn  defining
-# def process_request(self, request, client_address):
-# Which queues requests on a queu and executes the handler
-# with requests, client_address as parameter
-#        """Start a new thread to process the request."""
-#        t = threading.Thread(target = self.process_request_thread,
-#                             args = (request, client_address))
-#        if self.daemon_threads:
-#            t.setDaemon (1)
-#        t.start()
-# where process_request_thread(self): is
-#        try:
-#            self.finish_request(request, client_address)
-#            self.close_request(request)
-#        except:
-#            self.handle_error(request, client_address)
-#            self.close_request(request)
-
 
 class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """
@@ -487,15 +500,69 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     server_version = "UAV Onboard/0.1"
 
+    # Keep-alive. An idle connection holds a worker, so it is closed after
+    # keepalive_timeout seconds, or as soon as other requests are waiting
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+    keepalive_timeout = 1.0
+
+    # Content encoding negotiated with the client
+    _encoding = None
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._wait_for_request():
+            self.handle_one_request()
+
+    def _wait_for_request(self):
+        """
+        Wait for the next request on a keep-alive connection, returns
+        False if the connection should be closed
+        """
+        end_by = time.time() + self.keepalive_timeout
+        while time.time() < end_by:
+            if self.server.is_busy():
+                return False
+            # The request might already be buffered
+            self.connection.setblocking(False)
+            try:
+                if self.rfile.peek(1):
+                    return True
+            except Exception:
+                return False
+            finally:
+                self.connection.settimeout(self.timeout)
+            if select.select([self.connection], [], [], 0.1)[0]:
+                return True
+        return False
+
     # Python3 seems to get I/O operation errors all the time on flush, could
     # be that it expects longer connections?
     def handle_one_request(self):
+        self._request_start = None
+        self._has_length = False
         try:
             BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
         except ValueError as e:
             if str(e) == "I/O operation on closed file.":
+                self.close_connection = True
                 return
             raise e
+        if self._request_start:
+            self.server.record_request(time.time() - self._request_start)
+            # Without a length the client can't tell where the reply ends
+            if not self._has_length or self.server.is_busy():
+                self.close_connection = True
+
+    def parse_request(self):
+        self._request_start = time.time()
+        return BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == "content-length":
+            self._has_length = True
+        BaseHTTPServer.BaseHTTPRequestHandler.send_header(self, keyword, value)
 
     def log_message(self, format, *args):
         """
@@ -544,7 +611,8 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def get_log(self):
         return API.get_log("WebGUI.Handler")
 
-    def prepare_send(self, type, size=None, response=200, encoding=None, content_range=None):
+    def prepare_send(self, type, size=None, response=200, encoding=None, content_range=None,
+                     etag=None, last_modified=None):
         try:
             self.send_response(response)
         except Exception as e:
@@ -569,7 +637,36 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if encoding:
             self.send_header("Content-Encoding", encoding)
 
+        if etag or last_modified:
+            # Clients must check with us before using cached data
+            self.send_header("Cache-Control", "no-cache")
+        if etag:
+            self.send_header("ETag", etag)
+        if last_modified:
+            self.send_header("Last-Modified", HTTPUtils.http_date(last_modified))
+        self.send_header("Vary", "Accept-Encoding")
+
+        self.end_headers()
+
+    def _not_modified(self, etag, last_modified=None):
+        """
+        Send "304 Not Modified" and return True if the client has the
+        current version already
+        """
+        if not HTTPUtils.is_not_modified(self.headers, etag, last_modified):
+            return False
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", 0)
         self.end_headers()
+        return True
+
+    def _status_etag(self, what="status"):
+        """
+        ETag for data requests, changes when the status data changes
+        """
+        validator = self.get_db().get_last_change()[what]
+        return HTTPUtils.make_etag(validator, self.path, self._encoding)
 
     def _to_file(self, path):
         """
@@ -608,7 +705,7 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             data = open(p, "r").read()
             self.prepare_send("image/jpeg", len(data))
             self.wfile.write(toBytes(data))
-            self.wfile.close()
+            self.wfile.flush()
             return
         self.failed(404, "Missing file '%s'" % path)
 
@@ -830,37 +927,22 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.end_headers()
         if not headers_only:
             self.wfile.write(toBytes(result["data"]))
-        self.wfile.close()
+        self.wfile.flush()
         return
 
     def _cache_result(self, img_id, quality, scale, crop, histogram, result):
-        # Quick and dirty
-        if not os.path.exists("/tmp/cache"):
-            os.mkdir("/tmp/cache")
-
-        cache_file = "/tmp/cache/%s_%s_%s_%s_%s" % (img_id, quality, scale, crop, histogram)
-        f = open(cache_file, "w")
-        f.write(toBytes(result["data"]))
-        f.close()
-        res = {}
+        info = {}
         for k in list(result.keys()):
             if k == "data":
                 continue
-            res[k] = result[k]
-        f = open(cache_file + ".nfo", "w")
-        f.write(toBytes(json.dumps(res)))
-        f.close()
+            info[k] = result[k]
+        self.server.image_cache.put((img_id, quality, scale, crop, histogram), info, toBytes(result["data"]))
 
     def _get_cached(self, img_id, quality, scale, crop, histogram):
-        cache_file = "/tmp/cache/%s_%s_%s_%s_%s" % (img_id, quality, scale, crop, histogram)
-
-        if os.path.exists(cache_file):
-            f = open(cache_file + ".nfo", "r")
-            result = json.loads(f.read())
-            f.close()
-            f = open(cache_file, "r")
-            result["data"] = f.read()
-            f.close()
+        cached = self.server.image_cache.get((img_id, quality, scale, crop, histogram))
+        if cached:
+            result = dict(cached[0])
+            result["data"] = cached[1]
             return result
         return None
 
@@ -929,9 +1011,12 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
             elif path == "/cfg/versions":
                 cfg = API.get_config()
+                etag = HTTPUtils.make_etag(cfg.versions_validator(), self.path, self._encoding)
+                if self._not_modified(etag):
+                    return
                 versions = cfg.list_versions()
                 serialized = json.dumps(versions)
-                self._send_html(serialized)
+                self._send_html(serialized, etag=etag)
                 return
 
             elif path == "/cfg/serialize":
@@ -945,8 +1030,11 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     version = "default"
 
                 cfg = API.get_config(config_root, version=version)
+                etag = HTTPUtils.make_etag(cfg.config_validator(version), self.path, self._encoding)
+                if self._not_modified(etag):
+                    return
                 serialized = cfg.serialize()
-                return self._send_html(serialized)
+                return self._send_html(serialized, etag=etag)
         except:
             self.server.log.exception("Config request failed: %s=%s" % (path, args))
             return self.failed(400, "Bad request")
@@ -1024,10 +1112,9 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if "upgrade" in list(self.headers.keys()):
             return self._do_ws_request()
 
-        self._compress = False
+        self._encoding = None
         if "Accept-Encoding" in self.headers:
-            if "gzip" in self.headers["Accept-Encoding"]:
-                self._compress = True
+            self._encoding = HTTPUtils.negotiate_encoding(self.headers["Accept-Encoding"])
 
         path = self.getPath(strip_args=True)
         args = self._get_params()
@@ -1156,14 +1243,27 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 aggregate = int(args["aggregate"])
             else:
                 aggregate = None
+            # Unchanged since the client's last poll?
+            etag = self._status_etag()
+            if self._not_modified(etag):
+                return
+            # Binary arrays rather than JSON?
+            binary = args.get("format") == "binary"
             # Now get the data!
             if (path.startswith("/getmax")):
                 ret = self._get_max_data(params, args["start"], args["end"], since, since2d, aggregate)
+                if binary:
+                    ret["data"] = {"max": sorted(ret["data"].items())}
             else:
-                ret = self._get_data(params, args["start"], args["end"], since, since2d, aggregate)
+                ret = self._get_data(params, args["start"], args["end"], since, since2d, aggregate, columnar=binary,
+                                     points=args.get("points"), method=args.get("method", "lttb"))
             if ret:
                 ret["ts"] = time.time()
-                self._send_html(json.dumps(ret))
+                if binary:
+                    dataset = ret.pop("data")
+                    self._send_html(BinaryData.encode(ret, dataset), mimetype=BinaryData.MIMETYPE, etag=etag)
+                else:
+                    self._send_html(json.dumps(ret), etag=etag)
             else:
                 self.failed(404)
             return
@@ -1220,23 +1320,29 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         """
         Return all channels and their parameters as one giant json dump.
         """
+        etag = self._status_etag("params")
+        if self._not_modified(etag):
+            return
         channelsAndParams = {}
         for channel in self.get_db().get_channels():
             params = self.get_db().get_params(channel)
             channelsAndParams[channel] = params
         data = json.dumps({"channels": channelsAndParams})
-        self._send_html(data)
+        self._send_html(data, etag=etag)
 
     def _list_channels_and_params_full(self):
         """
         Return all channels and their parameters as one giant json dump.
         """
+        etag = self._status_etag("params")
+        if self._not_modified(etag):
+            return
         channelsAndParams = {}
         for channel in self.get_db().get_channels():
             params = self.get_db().get_params_with_ids(channel)
             channelsAndParams[channel] = params
         data = json.dumps({"channels": channelsAndParams})
-        self._send_html(data)
+        self._send_html(data, etag=etag)
 
     def _list_channels(self):
         """
@@ -1258,11 +1364,14 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             html += "<div class='param'><a href='javascript:add_param(\"%s\",\"%s\")'>%s</a></div>\n" % (channel, param, param)
         self._send_html(html)
 
-    def _get_data(self, params, start_time, end_time, since=0, since2d=0, aggregate=None):
+    def _get_data(self, params, start_time, end_time, since=0, since2d=0, aggregate=None, columnar=False,
+                  points=None, method="lttb"):
         """
-        Return the dataset of the given parameters
+        Return the dataset of the given parameters, at most points values per
+        parameter if points is given
         """
-        max_id, max_id2d, dataset = self.get_db().get_data(params, start_time, end_time, since, since2d, aggregate)
+        max_id, max_id2d, dataset = self.get_db().get_data(params, start_time, end_time, since, since2d, aggregate,
+                                                           columnar=columnar, points=points, method=method)
         return {"max_id": max_id, "max_id2d": max_id2d, "data": dataset}
 
     def _get_max_data(self, params, start_time, end_time, since=0, aggregate=None):
@@ -1353,28 +1462,22 @@ class MyWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         dataset.reverse()
         return json.dumps({"max_id": largest_id, "data": dataset})
 
-    def _send_html(self, html, mimetype="text/html", response=200, content_range=None):
-        # Only compress text if > 100 bytes
-        if mimetype and mimetype.startswith("text") and self._compress and len(html) > 100:
-            encoding = "gzip"
-            if sys.version_info.major == 3:
-                compressed = io.BytesIO()
-            else:
-                compressed = StringIO()
-            zipped = gzip.GzipFile(mode="w", fileobj=compressed,
-                                   compresslevel=9)
-            zipped.write(toBytes(html))
-            zipped.close()
-            html = compressed.getvalue()
-        else:
-            encoding = None
-
+    def _send_html(self, html, mimetype="text/html", response=200, content_range=None,
+                   etag=None, last_modified=None):
         data = toBytes(html)
+        # Only compress text if > 100 bytes, and never partial content
+        encoding = None
+        if self._encoding and not content_range and HTTPUtils.is_compressible(mimetype) and \
+           len(data) > HTTPUtils.MIN_COMPRESS_SIZE:
+            encoding = self._encoding
+            data = HTTPUtils.compress(data, encoding)
+
         self.prepare_send(mimetype, len(data), encoding=encoding,
-                          response=response, content_range=content_range)
+                          response=response, content_range=content_range,
+                          etag=etag, last_modified=last_modified)
 
         self.wfile.write(data)
-        self.wfile.close()
+        self.wfile.flush()
 
 
 class WebServer(threading.Thread):
@@ -1388,14 +1491,25 @@ class WebServer(threading.Thread):
         self.log = API.get_log("WebGUI")
         self.cfg = API.get_config("System.WebServer")
         self.cfg.require(["web_root"])
+        self.cfg.set_default("num_workers", 16)
+        self.cfg.set_default("max_queue", 64)
+        self.cfg.set_default("image_cache.directory", "/tmp/cache")
+        self.cfg.set_default("image_cache.memory_size", 64 * 1048576)
+        self.cfg.set_default("image_cache.disk_size", 1024 * 1048576)
 
         self.log.debug("Initializing WebServer")
         self.server = MyWebServer(('0.0.0.0', int(port)), MyWebHandler)
         self.server.cfg = self.cfg
         self.server.root_cfg = API.get_config()
         self.server.status = API.get_status("System.WebServer")
+        self.server.start_workers(self.cfg["num_workers"], self.cfg["max_queue"],
+                                  status=self.server.status)
         self.server.db = db
         self.server.picture_supplier = None  # PictureSupplier()
+        self.server.image_cache = ImageCache(self.cfg["image_cache.directory"],
+                                             memory_size=self.cfg["image_cache.memory_size"],
+                                             disk_size=self.cfg["image_cache.disk_size"],
+                                             status=self.server.status)
 
         try:
             from Instruments.TriOS.TriOS import DBDump
@@ -1417,6 +1531,7 @@ class WebServer(threading.Thread):
                 # waiting for us
                 pass
 
+        self.server.stop_workers()
         self.log.info("Stopped")
 
     def stop(self):
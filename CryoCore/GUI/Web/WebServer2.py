@@ -33,6 +33,7 @@ from Common.Utils import *
 #from Common.PictureSupplier import PictureSupplier
 from Tools import TailLog, HUD
 from Common.InternalDB import mysql as sqldb
+from CryoCore.GUI.Web.ThreadPool import ThreadPoolMixIn
 
 global channel_ids 
 global param_ids
@@ -290,7 +291,7 @@ class StatusDB(sqldb):
         return max_id, dataset
 
 
-class MyWebServer(http.server.HTTPServer):
+class MyWebServer(ThreadPoolMixIn, http.server.HTTPServer):
     """
     Non-blocking, multi-threaded IPv6 enabled web server
     """
@@ -313,25 +314,6 @@ class MyWebServer(http.server.HTTPServer):
         else:
             return None
 
-# TODO: Implement class ThreadPoolMixIn  defining
-#def process_request(self, request, client_address):
-# Which queues requests on a queu and executes the handler
-# with requests, client_address as parameter
-#        """Start a new thread to process the request."""
-#        t = threading.Thread(target = self.process_request_thread,
-#                             args = (request, client_address))
-#        if self.daemon_threads:
-#            t.setDaemon (1)
-#        t.start()
-# where process_request_thread(self): is 
-#        try:
-#            self.finish_request(request, client_address)
-#            self.close_request(request)
-#        except:
-#            self.handle_error(request, client_address)
-#            self.close_request(request)
-
-
 
 class MyWebHandler(http.server.BaseHTTPRequestHandler):
     """
@@ -1068,6 +1050,7 @@ class WebServer(threading.Thread):
         self.server.cfg = self.cfg
         
         self.server.root_cfg = API.get_config()
+        self.server.start_workers()
         
         self.server.db = db
         self.server.picture_supplier = None #PictureSupplier()
@@ -1093,6 +1076,7 @@ class WebServer(threading.Thread):
                 # waiting for us
                 pass
 
+        self.server.stop_workers()
         self.log.info("Stopped")
 
     def stop(self):
@@ -6,7 +6,7 @@
 # By Daniel Stodle, daniel@norut.no, 2012
 
 import os, sys, MySQLdb, threading, time
-import http.server, socketserver, json, base64
+import http.server, socketserver, json, base64, logging
 
 db								= None
 simulateLiveMode				= False
@@ -151,6 +151,16 @@ class MVDatabase:
 					pass
 		return item
 	
+	def executeStreaming(s, SQL, name="", params=[]):
+		""" Like execute, but uses an unbuffered (server side) cursor so rows are only transferred as
+			they are read. The cursor must be read to the end (or closed) before the connection is reused.
+		"""
+		SQL = SQL.replace("?", "%s")
+		conn		= s.getNewConnection(name)
+		cursor		= conn.cursor(MySQLdb.cursors.SSCursor)
+		cursor.execute(SQL, params)
+		return cursor
+	
 	def getRows(s, cursor, convertTypes=False):
 		""" Returns a list of rows from the given cursor, converting strings to native types (float, int)
 			if convertTypes == True. None-values are replaced with "?" and values identical to the previous
@@ -158,32 +168,45 @@ class MVDatabase:
 			new values in the interpolator where no new value actually exists. This is important for correctly
 			interpolating lat/lon, for instance.
 		"""
-		list		= []
+		return list(s.iterRows(cursor, convertTypes))
+	
+	def iterRows(s, cursor, convertTypes=False, chunkSize=1000):
+		""" Generator version of getRows, fetches chunkSize rows at the time so memory use is bounded.
+		"""
 		prev		= []
 		while True:
-			row		= cursor.fetchone()
-			if row == None:
+			rows	= cursor.fetchmany(chunkSize)
+			if not rows:
 				break
-			item	= [x for x in row]
-			if len(prev) > 0:
-				for i in range(0,len(item)):
-					if row[i] == None:
-						item[i]	= "?"
-					elif row[i] == prev[i]:
-						item[i]	= "*"
-					else:
-						prev[i]	= item[i]
-					if convertTypes:
-						item[i]	= s.convertToNativeType(item[i])
-			else:
-				if convertTypes:
+			for row in rows:
+				item	= [x for x in row]
+				if len(prev) > 0:
 					for i in range(0,len(item)):
-						item[i]	= s.convertToNativeType(item[i])
-				prev	= [x for x in item]
-			list.append(item)
-		return list
+						if row[i] == None:
+							item[i]	= "?"
+						elif row[i] == prev[i]:
+							item[i]	= "*"
+						else:
+							prev[i]	= item[i]
+						if convertTypes:
+							item[i]	= s.convertToNativeType(item[i])
+				else:
+					if convertTypes:
+						for i in range(0,len(item)):
+							item[i]	= s.convertToNativeType(item[i])
+					prev	= [x for x in item]
+				yield item
 	
 	def getParameterData(s, database, cid, pid, firstTimestamp=None, lastTimestamp=None):
+		try:
+			return list(s.iterParameterData(database, cid, pid, firstTimestamp, lastTimestamp))
+		except Exception as e:
+			print(e)
+			return []
+	
+	def iterParameterData(s, database, cid, pid, firstTimestamp=None, lastTimestamp=None):
+		""" Streams [timestamp, value] rows for a parameter, a full flight doesn't fit nicely in memory
+		"""
 		params	= [cid, pid]
 		query	= [	"select timestamp, value from status where chanid=? and paramid=? order by timestamp;",
 					"select timestamp, value from status where chanid=? and paramid=? and timestamp >? order by timestamp;",
@@ -192,39 +215,21 @@ class MVDatabase:
 			params.append(firstTimestamp)
 			if lastTimestamp != None:
 				params.append(lastTimestamp)
+		# Executed here rather than in the generator so errors are raised before we start replying
+		cursor	= s.executeStreaming(query[len(params)-2], database, params)
+		# We need ints and floats converted to native types for items fetched from the status table.
+		return s.iterAndClose(cursor, True)
+	
+	def iterAndClose(s, cursor, convertTypes=False):
 		try:
-			cursor	= s.execute(query[len(params)-2], database, params)
-			# We need ints and floats converted to native types for items fetched from the status table.
-			return s.getRows(cursor, True)
-			list		= []
-			prev		= None
-			while True:
-				row		= cursor.fetchone()
-				if row == None:
-					break
-				ts		= row[0]
-				item	= row[1]
-				if prev != None:
-					if prev == item:
-						item	= "*"
-					prev		= item
-				else:
-					prev		= item
-				if item == None:
-					item		= "?"
-				# Figure out what this is.. a string? int() accepts only integers, float takes stuff like 1.2 and 1e4. If either fails, it's a string.
-				try:
-					item		= int(item)
-				except ValueError:
-					try:
-						item	= float(item)
-					except ValueError:
-						pass
-				list.append([ts, item])
-			return list
-		except Exception as e:
-			print(e)
-			return []
+			for item in s.iterRows(cursor, convertTypes):
+				yield item
+		finally:
+			try:
+				cursor.close()
+				cursor.connection.close()
+			except:
+				pass
 	
 	def getIMUView(s, database, firstTimestamp=None, lastTimestamp=None):
 		params	= []
@@ -338,6 +343,23 @@ class MVDatabase:
 	def toJSON(s, data):
 		return json.dumps(data, separators=(',',':'))
 	
+	def toJSONChunks(s, rows, chunkSize=1000):
+		""" Encode an iterable of rows as a JSON list, yielding the text in pieces
+		"""
+		encoder		= json.JSONEncoder(separators=(',',':'))
+		yield "["
+		first		= True
+		chunk		= []
+		for row in rows:
+			chunk.append(encoder.encode(row))
+			if len(chunk) >= chunkSize:
+				yield ("" if first else ",") + ",".join(chunk)
+				first	= False
+				chunk	= []
+		if chunk:
+			yield ("" if first else ",") + ",".join(chunk)
+		yield "]"
+	
 	def toPrettyJSON(s, data):
 		return json.dumps(data, sort_keys=True, indent=2)
 	
@@ -376,6 +398,8 @@ get /databases
 """
 
 class RequestHandler(http.server.BaseHTTPRequestHandler):
+	log	= logging.getLogger("FlightDatabaseServer")
+	
 	def do_GET(s):
 		global lastRequestTime, liveModeTimeOffset, lastLiveModeTimeOffsetAdjust
 		try:
@@ -436,10 +460,31 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
 						pid				= int(params[1])
 						firstTimestamp	= params[2] if len(params) > 2 else None
 						lastTimestamp	= params[3] if len(params) > 3 else None
-						data			= db.toJSON(db.getParameterData(database, cid, pid, firstTimestamp, lastTimestamp))
 					except Exception as e:
 						s.send_error(404, "Format: paramValue/chanID/paramID[/firstTimestamp[/secondTimestamp]]\n%s" % (e))
 						return
+					try:
+						rows			= db.iterParameterData(database, cid, pid, firstTimestamp, lastTimestamp)
+					except Exception as e:
+						# Query errors give an empty reply, as getParameterData does
+						s.log.exception("paramValue query failed for %s" % s.path)
+						rows			= []
+					try:
+						# Rows are streamed from the database, only the encoded reply is held in memory.
+						# It is sent once all rows are read, so a failure can't give a truncated 200 reply.
+						chunks			= [chunk.encode("utf-8") for chunk in db.toJSONChunks(rows)]
+					except Exception as e:
+						s.log.exception("paramValue failed reading rows for %s" % s.path)
+						s.send_error(500, "Query failed: %s" % e)
+						return
+					s.send_response(200)
+					s.send_header("Content-type", contentType)
+					s.send_header("Content-Length", str(sum([len(chunk) for chunk in chunks])))
+					s.end_headers()
+					for chunk in chunks:
+						s.wfile.write(chunk)
+					s.wfile.close()
+					return
 				else:
 					s.send_error(404, "Unknown query %s" % s.path)
 					return
@@ -16,10 +16,10 @@ from CryoCore.Core import InternalDB
 
 usage = """usage: %prog [options] [command]
   Commands:
-    export <item1> [item2] ... - export data (as NetCDF)
-    dump  <item1> [item2] ...  - dump data (native dumps)
+    export <item1> [item2] ... - export data ('status' as compressed numpy files, others as NetCDF)
+    dump  [table1] [table2] ... - dump the database or some tables (native, incremental dumps)
     clear <item1> [item2] ...  - clear data
-    restore <item1> [item2] ... - restore a datadump
+    restore [table1] [table2] ... - restore a datadump
     repair - Repair all tables (if possible)
     """
 
@@ -34,7 +34,7 @@ parser.add_option("-v", "--verbose", action="store_true", default=False,
                   help="Verbose mode - say more about what's going on")
 
 parser.add_option("-c", "--compress", action="store_true", default=False,
-                  help="Compress database files after export")
+                  help="Compress exported files, and dumps harder (slower)")
 
 parser.add_option("", "--clear", action="store_true", default=False,
                   help="Clear the selected items after successful export")
@@ -42,6 +42,33 @@ parser.add_option("", "--clear", action="store_true", default=False,
 parser.add_option("", "--yes", action="store_true", default=False,
                   help="Always answer 'yes'. THIS IS DANGEROUS!")
 
+parser.add_option("", "--partition", dest="partition", type="int", default=3600,
+                  help="Seconds of status data per exported file (default 3600)")
+
+parser.add_option("", "--workers", dest="workers", type="int", default=4,
+                  help="Number of parallel export workers (default 4)")
+
+parser.add_option("", "--full", action="store_true", default=False,
+                  help="Dump everything, not just what is new since the last dump")
+
+parser.add_option("", "--before", dest="before", type="float", default=None,
+                  help="Only clear data older than this time (negative is relative to now)")
+
+parser.add_option("", "--truncate", action="store_true", default=False,
+                  help="Truncate tables that are cleared completely instead of deleting in chunks")
+
+parser.add_option("", "--chunk-size", dest="chunk_size", type="int", default=10000,
+                  help="Rows (ids) deleted per transaction when clearing (default 10000)")
+
+parser.add_option("", "--duty-cycle", dest="duty_cycle", type="float", default=0.5,
+                  help="Fraction of the time spent deleting, the rest is pauses (default 0.5)")
+
+parser.add_option("", "--replica", dest="replica", default=None,
+                  help="Config root of a replica database, clearing waits for it to catch up")
+
+parser.add_option("", "--max-lag", dest="max_lag", type="float", default=5.0,
+                  help="Max replica lag in seconds when clearing (default 5)")
+
 parser.add_option("-u", "--user", dest="db_user",
                   help="User to run postgres as",
                   default="pilot")
@@ -60,12 +87,36 @@ def check_destination(destination):
         os.makedirs(destination)
 
 
+def export_status(options):
+    """
+    Export the status tables as columnar files. Exports into an existing
+    directory resume from where the last export stopped. --clear only
+    deletes the status updates that were exported, parameters and
+    channels are kept so the ids stay valid.
+    """
+    from CryoCore.Core.Status.ColumnarExport import StatusExporter
+    target = os.path.join(options.destination, "status")
+    e = StatusExporter(target, partition_size=options.partition, num_workers=options.workers)
+    if options.verbose:
+        print("Exporting status to", target, "from id", e.get_state()["last_id"])
+    num = e.export()
+    if options.verbose:
+        print("Exported", num, "status updates")
+    if options.clear:
+        last_id = e.get_state()["last_id"]
+        if not _should_delete(options, "status up to id %d" % last_id):
+            return
+        num = _get_cleaner(options, e).delete_range("status", "id", "id<=%s", [last_id])
+        if options.verbose:
+            print("Cleared", num, "exported status updates")
+
+
 def export_databases(options, items):
     """
-    Export data (as NetCDF)
+    Export data (status as columnar files, others as NetCDF)
     """
     # Possible for export:
-    supported_items = ["imu", "gps", "trios", "metpack"]
+    supported_items = ["status", "imu", "gps", "trios", "metpack"]
     if "all" in items:
         items = supported_items
 
@@ -76,6 +127,10 @@ def export_databases(options, items):
                                 (item, supported_items))
         print("Exporting", item)
 
+        if item == "status":
+            export_status(options)
+            continue
+
         target = os.path.join(options.destination, item + ".nc")
         if os.path.exists(target):
             raise Exception("File %s already exists" % target)
@@ -118,58 +173,58 @@ def compress(options, filename):
         print("Failed to compress", filename)
 
 
+def _get_dumper(options, directory):
+    from CryoCore.Core.Backup import DatabaseDumper
+    cfg = API.get_config("System.InternalDB")
+    db = InternalDB.mysql("ManageData", cfg)
+    compresslevel = 6
+    if options.compress:
+        compresslevel = 9
+    return DatabaseDumper(db, directory, num_workers=options.workers, compresslevel=compresslevel)
+
+
 def dump_databases(options, items):
     """
-    Perform SQL dumps
+    Dump the database (or the given tables) natively. Dumping to the same
+    destination again only adds the new rows of the append only tables
+    (status, log...), unless --full is given.
     """
-    # Just dump all
-    supported_items = ["db"]
-    if 0:
-        supported_items = ["status", "log", "imu", "trios", "laser"]
-        if "all" in items:
-            items = supported_items
-        for item in items:
-            item = item.lower()
-
-            if item not in supported_items:
-                raise Exception("Can't dump '%s', only %s or 'all' is supported" %
-                                    (item, supported_items))
+    tables = None
+    if len(items) > 0 and "db" not in items and "all" not in items:
+        tables = items
 
     print("Exporting database")
-
-    target = os.path.join(options.destination, "cryocore.sql")
-    if os.path.exists(target):
-        raise Exception("File %s already exists" % target)
-
+    target = os.path.join(options.destination, "cryocore")
     if options.verbose:
         print("Exporting to", target)
-
-    # database name should be item + "db"
-    cfg = API.get_config("System.InternalDB")
-    t = open(target, "w")
-    p = subprocess.Popen(["mysqldump",
-                          "-u", cfg["db_user"],
-                          "-p%s" % cfg["db_password"],
-                          cfg["db_name"]], stdout=t)
-    while p.poll() is None:
-        time.sleep(0.2)
-    retval = p.poll()
-    if retval != 0:
-        print(" *** Error dumping database return value", retval)
+    dumper = _get_dumper(options, target)
+    try:
+        rows = dumper.dump(tables, full=options.full)
+    except Exception as e:
+        print(" *** Error dumping database:", e)
         return
-
-    if options.compress:
-        compress(options, target)
+    if options.verbose:
+        print("Dumped", rows, "rows")
 
     if options.clear:
-        print("Clearing database for", item)
-        clear_databases(options, [item])
+        clear_databases(options, ["all"])
 
 
 def restore_databases(options, items):
     """
-    Perform SQL dumps
+    Restore native dumps (see dump_databases) or SQL dumps
     """
+    from CryoCore.Core.Backup import MANIFEST
+    for directory in [options.source, os.path.join(options.source, "cryocore")]:
+        if os.path.exists(os.path.join(directory, MANIFEST)):
+            tables = None
+            if len(items) > 0 and "db" not in items and "all" not in items:
+                tables = items
+            print("Restoring from", directory)
+            rows = _get_dumper(options, directory).restore(tables)
+            print("Restore completed,", rows, "rows")
+            return
+
     supported_items = ["db"]
     # supported_items = ["status", "log", "imu", "trios", "laser"]
     if "all" in items:
@@ -274,10 +329,33 @@ def _should_delete(options, item):
     return True
 
 
+def _get_cleaner(options, db):
+    from CryoCore.Core.Maintenance import TableCleaner
+    replica = None
+    if options.replica:
+        replica = InternalDB.mysql("ManageData.Replica", API.get_config(options.replica), is_direct=True)
+
+    def progress(table, deleted, fraction):
+        if options.verbose and deleted is not None:
+            sys.stdout.write("\r  %s: %d rows deleted (%d%%)  " % (table, deleted, 100 * fraction))
+            if fraction >= 1.0:
+                sys.stdout.write("\n")
+            sys.stdout.flush()
+    return TableCleaner(db, chunk_size=options.chunk_size, duty_cycle=options.duty_cycle,
+                        replica=replica, max_lag=options.max_lag, progress=progress)
+
+
 def clear_databases(options, items):
     """
-    Clear the given databases
+    Clear the given databases. Rows (or with --before, only older rows)
+    are deleted in small chunks. With --truncate, tables are truncated
+    instead, ids continue from where they were
     """
+    before = None
+    if options.before is not None:
+        before = options.before
+        if before < 0:
+            before += time.time()
 
     supported_items = ["status", "log", "imu", "trios", "laser", "sample", "arduimu"]
     if "all" in items:
@@ -289,34 +367,44 @@ def clear_databases(options, items):
             raise Exception("Can't clear '%s', only %s or 'all' is supported" %
                                 (item, supported_items))
 
-        if not _should_delete(options, item):
+        what = item
+        if before is not None:
+            what = "%s before %s" % (item, time.ctime(before))
+        if not _should_delete(options, what):
             continue
 
-        # CLEAR DATABASE
-        # Get the correct config for the databas
-        configs = {"status": "System.Status.Postgres",
-                   "imu": "Instruments.IMU",
-                   "trios": "Instruments.Trios",
-                   "log": "System.LogDB"}
+        # Tables as (name, primary key, time column)
+        tables = {"status": [("status", "id", "timestamp"),
+                             ("status2d", "id", "timestamp"),
+                             ("status_parameter", "paramid", None),
+                             ("status_parameter2d", "paramid", None),
+                             ("status_channel", "chanid", None)],
+                  "imu": [("imu", "id", None)],
+                  "trios": [("instrument", "id", None),
+                            ("sample", "id", "timestamp")],
+                  "log": [("log", "id", "time")],
+                  "laser": [("laser", "id", None),
+                            ("laserscanner", "id", None)],
+                  "arduimu": [("arduimu", "id", None)],
+                  "sample": [("sample", "id", "timestamp")]}
         cfg = API.get_config("System.InternalDB")
         db = InternalDB.mysql("ManageData", cfg)
-        # Should be ready to clear the tables...
-        sqls = {"status": ["truncate table status",
-                           "delete from status_parameter",
-                           "delete from status_channel"],
-                "imu": ["delete from imu"],
-                "trios": ["delete from instrument",
-                          "truncate table sample "],
-                "log": ["truncate table log"],
-                "laser": ["truncate table laser",
-                "truncate table laserscanner"],
-                "arduimu": ["truncate table arduimu"],
-                "sample": ["delete from sample"]}
+        cleaner = _get_cleaner(options, db)
         try:
-            for SQL in sqls[item]:
-                db._execute(SQL)
+            for table, key, time_column in tables[item]:
+                if before is not None:
+                    if not time_column:
+                        if options.verbose:
+                            print("Not clearing", table, "by time")
+                        continue
+                    num = cleaner.clear(table, time_column, before, key=key)
+                else:
+                    num = cleaner.clear(table, key=key, truncate=options.truncate)
+                if options.verbose:
+                    print("Cleared", table, "" if num is None else "(%d rows)" % num)
         except Exception as e:
             print(" *** Error clearing %s: %s" % (item, e))
+            print(" *** Running the same clear again will continue where this one stopped")
             continue
 
         if options.verbose:
@@ -1,5 +1,7 @@
+import csv
 import sys
 import time
+import tempfile
 
 import sqlite3
 
@@ -27,6 +29,7 @@ class BasicDb:
         self.conn = sqlite3.connect(self.db_file)
         self.filters = []
         self.default_show = default_show
+        self.chunk_size = 1000
         
     def _execute(self, SQL, params=[]):
         for i in range(0,3):
@@ -40,6 +43,19 @@ class BasicDb:
                 else:
                     raise e
 
+    def _iterate(self, SQL, params=[]):
+        """
+        Yield the rows of a query, fetching chunk_size rows at the time
+        so big databases can be processed without reading them all into memory
+        """
+        cursor = self._execute(SQL, params)
+        while True:
+            rows = cursor.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
     def add_filter(self, filter):
         """
         Add a callback that will be showed or hidden - will be called
@@ -57,9 +73,7 @@ class BasicDb:
 
         last_id = 0
         rows = 0
-        cursor = self._execute(SQL,params)
-
-        for row in cursor.fetchall():
+        for row in self._iterate(SQL, params):
             rows += 1
             if row[ID] > last_id:
                 last_id = row[ID]
@@ -90,13 +104,20 @@ class DBtoSVN(BasicDb):
         """
         BasicDb.__init__(self, db_file)
         self.print_mode = print_mode
-        self.target = open(svn_file, "w")
+        self.target = open(svn_file, "w", newline="")
 
+        # Only channels and names are needed for the header - tracking every
+        # value would keep the whole database in memory
         self.keys = {}
-        for item in [CHANNEL, NAME, VALUE]:
+        for item in [CHANNEL, NAME]:
             self.keys[item] = []
-        self.data = []
-    
+        self._channel_index = {}
+
+        # Rows are spooled to a temporary file while processing, the header
+        # and relative times can only be written when we've seen them all
+        self._spool = tempfile.TemporaryFile(mode="w+", newline="")
+        self._spool_writer = csv.writer(self._spool)
+
         self._start_time = time.time()
 
         self.process(SQL)
@@ -107,12 +128,13 @@ class DBtoSVN(BasicDb):
         """
         if row[TIMESTAMP] < self._start_time:
             self._start_time = row[TIMESTAMP]
-        for item in [CHANNEL, NAME, VALUE]:
+        for item in [CHANNEL, NAME]:
             if not row[item] in self.keys[item]:
                 if item == CHANNEL:
                     print("Found new channel",row[item])
+                    self._channel_index[row[item]] = len(self.keys[item])
                 self.keys[item].append(row[item])
-        self.data.append(row)
+        self._spool_writer.writerow([repr(row[TIMESTAMP]), self._channel_index[row[CHANNEL]], row[VALUE]])
             
     def finalize(self):
         """
@@ -120,28 +142,74 @@ class DBtoSVN(BasicDb):
         """
         if self.print_mode == "by_channel":
             # The channels will have separate columns
-            self.target.write(",".join(["Time"] + self.keys[CHANNEL]) + "\n")
-            channel = {}
+            target = csv.writer(self.target, lineterminator="\n")
+            target.writerow(["Time"] + self.keys[CHANNEL])
             for i in range(0,len(self.keys[CHANNEL])):
-                channel[self.keys[CHANNEL][i]] = i
                 print("Channel",self.keys[CHANNEL][i],"=",i)
 
-            for row in self.data:
+            self._spool.seek(0)
+            for ts, col_num, value in csv.reader(self._spool):
                 # Sort on the channel
-                line = [str(row[TIMESTAMP]-self._start_time)]
-                col_num = channel[row[CHANNEL]]
-                line += [""]*col_num
-                line += [str(row[VALUE])]
+                line = [str(float(ts)-self._start_time)]
+                line += [""]*int(col_num)
+                line += [value]
                 
-                self.target.write(",".join(line) + "\n")
+                target.writerow(line)
+            self._spool.close()
         else:
             raise Exception("Not supported mode %s"%self.print_mode)
         
+
+class DBtoNPZ(BasicDb):
+    """
+    Export to per-channel compressed numpy files partitioned by time, in
+    the same layout as CryoCore.Core.Status.ColumnarExport so it can be
+    read with its OfflineStatusReader
+    """
+
+    def __init__(self, db_file, destination, SQL, partition_size=3600):
+        from CryoCore.Core.Status import ColumnarExport, StatusDbReader
+        self._export = ColumnarExport
+        self._builder_class = StatusDbReader.ColumnBuilder
+        BasicDb.__init__(self, db_file)
+        self.destination = destination
+        self.partition_size = partition_size
+        self._builders = {}
+        self._current = None
+
+        self.process(SQL)
+
+    def process_row(self, row):
+        partition = int(row[TIMESTAMP] // self.partition_size) * self.partition_size
+        if self._current is not None and partition > self._current:
+            # Rows are (mostly) in time order, write out what's done
+            self._write(lambda p: p < partition)
+        self._current = max(partition, self._current or partition)
+        key = (row[CHANNEL], partition)
+        if key not in self._builders:
+            self._builders[key] = [self._builder_class(), row[ID], row[ID]]
+        builder = self._builders[key]
+        builder[0].add(row[NAME], row[TIMESTAMP], row[VALUE])
+        builder[1] = min(builder[1], row[ID])
+        builder[2] = max(builder[2], row[ID])
+
+    def _write(self, which):
+        for key in list(self._builders.keys()):
+            if which(key[1]):
+                builder, first_id, last_id = self._builders.pop(key)
+                self._export.write_partition(self.destination, key[0], key[1],
+                                             first_id, last_id, builder.get_columns())
+
+    def finalize(self):
+        self._write(lambda p: True)
+
+
 if __name__ == "__main__":
 
     if len(sys.argv) < 4:
         print("""Usage:
     %s <database file> <svn file> <print_mode> [expression] [exceptions?] ...
+    print_mode is "by_channel" or "npz" (svn file is then a directory)
     Exceptions are not yet implemented. ;)
 """%sys.argv[0])
         raise SystemExit("Need at least a database file, an svn file and one parameter")
@@ -158,6 +226,9 @@ if __name__ == "__main__":
     #exceptions = sys.argv[2:]
     #print "Exceptions:",exceptions
     
-    db = DBtoSVN(db_file, svn_file, SQL, print_mode)
+    if print_mode == "npz":
+        db = DBtoNPZ(db_file, svn_file, SQL)
+    else:
+        db = DBtoSVN(db_file, svn_file, SQL, print_mode)
     db.finalize()
     
@@ -133,8 +133,24 @@ class StatusValue:
                 added = True
         parent.update_value(value, timestamp)
         return added
+
+    def find(self, path):
+        """
+        Return the node for path or None
+        """
+        names = path.split(".")
+        node = self
+        for index in range(0, len(names)):
+            node = node.child_map.get(".".join(names[0:index+1]))
+            if node is None:
+                return None
+        return node
     
     def renderToScreen(self, screen, line, width, selected=False):
+        """
+        Returns True if the row was drawn as flashing
+        """
+        flashing = False
         try:
             marker = "> "
             if self.expand or self.filter:
@@ -152,6 +168,7 @@ class StatusValue:
                 if self.flash > 0:
                     self.flash -= 1
                     color = curses.color_pair(4)
+                    flashing = True
                 screen.hline(line, 0, " ", width, color)
                 screen.addstr(line, x, displayName, color)
                 if width - truncateLength - 2 > 0:
@@ -166,6 +183,7 @@ class StatusValue:
                     screen.addstr(line, width - truncateLength - 2, "+=", color)
         except:
             if log: log.exception("Error rendering to screen")
+        return flashing
 
 
 def readEscape(window):
@@ -307,20 +325,46 @@ class ConsoleUI:
         self.filter_recent = True
         self.recent_seconds = options.recent_seconds
         self.root.setRecursiveExpand(self.expand_all)
-    
+        # Rows as last drawn, only changed rows are redrawn
+        self._rendered = None
+        self._rendered_selected = None
+        self._flashing = set()
+        self._changed = set()
+        self._full_redraw = True
+        self._last_visible = 0
+
     def import_initial_status(self, allow_none):
         print("Importing existing status.. stand by.")
         ts = TailStatus("Tools.StatusUI", None)
         ts.create_pc_index()
-        channels = ts.get_channels()
-        for channel in channels:
-            params = ts.get_params(channel)
-            #print(f"{channel} : {params}")
-            for param in params:
-                last_value, timestamp = ts.get_last_value(channel, param)
-                if last_value is not None or allow_none:
-                    self.root.add_or_update(f"{channel}.{param}", last_value, timestamp)
+        for channel, param, last_value, timestamp in ts.get_last_values(allow_none):
+            if last_value is not None or allow_none:
+                self.root.add_or_update(f"{channel}.{param}", last_value, timestamp)
         print("Ready!")
+
+    def apply_updates(self):
+        """
+        Apply the status items updated since last time. Returns True if
+        the tree changed shape (new nodes)
+        """
+        added = False
+        last_values = self.listener.get_last_values()
+        for key in self.listener.get_dirty():
+            value = last_values.get(key)
+            if value is None:
+                continue
+            path = ".".join(key)
+            node = self.root.find(path)
+            if node is not None and node.is_leaf and node.timestamp == value.get("ts"):
+                continue
+            if node is None:
+                added = True
+                self.root.add_or_update(path, value["value"], value.get("ts"))
+                node = self.root.find(path)
+            else:
+                node.update_value(value["value"], value.get("ts"))
+            self._changed.add(node)
+        return added
     
     def updateFilter(self):
         if len(self.filterEditor.value) > 0:
@@ -384,6 +428,7 @@ class ConsoleUI:
         c = self.screen.getch()
         if c == -1:
             return
+        self._full_redraw = True
         if c == curses.KEY_RESIZE:
             self.resize_screen()
             return
@@ -406,13 +451,28 @@ class ConsoleUI:
             self.categoryScroll = len(self.visible) - self.categoryHeight
         if self.categoryScroll < 0:
             self.categoryScroll = 0
+        rows = self.visible[self.categoryScroll:self.categoryScroll + self.categoryHeight]
+        full = self._full_redraw or rows != self._rendered or self.selected != self._rendered_selected
+        if not full and len(self._changed) == 0 and len(self._flashing) == 0:
+            return
+        flashing = set()
         for i in range(0, self.categoryHeight):
-            if i + self.categoryScroll >= len(self.visible):
-                self.categoryWindow.hline(i, 0, " ", self.width)
+            if i >= len(rows):
+                if full:
+                    self.categoryWindow.hline(i, 0, " ", self.width)
                 continue
-            self.visible[i + self.categoryScroll].renderToScreen(self.categoryWindow, i, self.width, i + self.categoryScroll == self.selected)
-
-        if len(self.visible) > 0:
+            node = rows[i]
+            if full or node in self._changed or node in self._flashing or node.flash > 0:
+                if node.renderToScreen(self.categoryWindow, i, self.width, i + self.categoryScroll == self.selected):
+                    flashing.add(node)
+        # Flashing rows must be drawn once more to clear the highlight
+        self._flashing = flashing
+        self._changed = set()
+        self._rendered = rows
+        self._rendered_selected = self.selected
+        self._full_redraw = False
+
+        if full and len(self.visible) > 0:
             scrollBarLength = float(self.categoryHeight) / float(len(self.visible))
             scrollBarStart = float(self.categoryScroll) / float(len(self.visible))
             for i in range(0, self.categoryHeight):
@@ -465,21 +525,29 @@ class ConsoleUI:
         self.selected = 0
         self.categoryScroll = 0
         self.visible = self.root.getVisible([], False, self.filter_recent, self.recent_seconds)
+        truncateLength = self.width - self.root.measure_label() - 10
         while not API.api_stop_event.is_set():
             self.refresh()
             self.getInput()
-            status = self.listener.get_last_values()
-            added = False
-            for key, value in status.items():
-                path = ".".join(key)
-                added |= self.root.add_or_update(path, value["value"])
+            added = self.apply_updates()
             if added and len(self.filterEditor.value) > 0:
                 self.root.checkFilter(self.filterEditor.value)
-            self.visible = self.root.getVisible([], len(self.filterEditor.value) > 0, self.filter_recent, self.recent_seconds)
-            truncateLength = self.width - self.root.measure_label() - 10
+            # The tree only needs walking if it changed shape, or if "recent"
+            # rows may have appeared or expired (checked once a second)
+            if added or self._full_redraw or \
+               (self.filter_recent and (len(self._changed) > 0 or time.time() - self._last_visible > 1.0)):
+                self.visible = self.root.getVisible([], len(self.filterEditor.value) > 0, self.filter_recent, self.recent_seconds)
+                self._last_visible = time.time()
+            # Labels get longer as nodes are added, and the width changes on resize
+            if added or self._full_redraw:
+                truncate = self.width - self.root.measure_label() - 10
+                if truncate != truncateLength:
+                    truncateLength = truncate
+                    self._full_redraw = True
     
     def refresh(self):
         if self.helpMode:
+            self._full_redraw = True
             for y in range(0, self.categoryWindow.getmaxyx()[0]):
                 self.categoryWindow.hline(y, 0, " ", self.width)
                 if y < len(self.help):
@@ -13,6 +13,8 @@ from argparse import ArgumentParser
 
 from CryoCore import API
 from CryoCore.Core.InternalDB import mysql
+from CryoCore.Core.Replay import LogReplay
+from CryoCore.Core.Maintenance import TableCleaner
 
 try:
     import argcomplete
@@ -90,7 +92,8 @@ class TailLog(mysql):
         """
         if options.verbose:
             print("Deleting log messages")
-        self._execute("DELETE FROM log")
+        # Truncates (keeping the ids), or deletes in small chunks if that's not possible
+        TableCleaner(self).clear("log", truncate=True)
 
         if options.verbose:
             print("Clear DONE")
@@ -217,30 +220,54 @@ class TailLog(mysql):
 
         last_pos = 0
         start_id = last_id
+        replay = None
+        next_replay = None
         while True:
             try:
-                t = ""
-                if self.clock:
-                    if self.clock.pos() < last_pos:
-                        last_id = start_id
-                    last_pos = self.clock.pos()
-                    t = " AND time<%f " % last_pos
-                rows = 0
-                if options.verbose:
-                    print("Searching")
-                if len(args) > 0:
-                    SQL = args[0] + " AND id>%s"
-                    params = [last_id]
-                elif search:
-                    SQL = "SELECT * FROM log WHERE id>%s AND level>=%s AND " + t + search + " ORDER BY id"
-                    params = [last_id, API.log_level_str[options.level]]
+                if replay:
+                    results = replay.get()
                 else:
-                    SQL = "SELECT * FROM log WHERE id>%s AND level>=%s" + t + " ORDER BY id"
-                    params = [last_id, API.log_level_str[options.level]]
-
-                SQL += " LIMIT 10000"
-                cursor = self._execute(SQL, params)
-                for row in cursor.fetchall():
+                    t = ""
+                    if self.clock:
+                        if self.clock.pos() < last_pos:
+                            last_id = start_id
+                        last_pos = self.clock.pos()
+                        if len(args) == 0:
+                            if not next_replay:
+                                SQL = "SELECT * FROM log WHERE id>%s AND id<=%s AND level>=%s"
+                                if search:
+                                    SQL += " AND " + search
+                                # A connection of its own, the replay reads from another thread
+                                db = mysql(self.name + ".Replay", config=API.get_config("System.LogDB"),
+                                           can_log=False, is_direct=True)
+                                next_replay = LogReplay(self.clock, db, SQL + " ORDER BY id",
+                                                        [API.log_level_str[options.level]], TIMESTAMP)
+                            # The history ends where the replay will start reading, by id, so
+                            # rows with the same time are neither skipped nor shown twice
+                            end_id = next_replay._find_id(last_pos)
+                            t = " AND id<=%d " % end_id
+                    if options.verbose:
+                        print("Searching")
+                    if len(args) > 0:
+                        SQL = args[0] + " AND id>%s"
+                        params = [last_id]
+                    elif search:
+                        SQL = "SELECT * FROM log WHERE id>%s AND level>=%s " + t + " AND " + search + " ORDER BY id"
+                        params = [last_id, API.log_level_str[options.level]]
+                    else:
+                        SQL = "SELECT * FROM log WHERE id>%s AND level>=%s" + t + " ORDER BY id"
+                        params = [last_id, API.log_level_str[options.level]]
+
+                    SQL += " LIMIT 10000"
+                    cursor = self._execute(SQL, params)
+                    results = cursor.fetchall()
+                    if next_replay and len(results) < 10000:
+                        # Done with the history, prefetch rows ahead of the clock from now on
+                        replay = next_replay
+                        replay.seek(last_pos, end_id)
+                        replay.start()
+                rows = 0
+                for row in results:
                     rows += 1
                     if row[ID] > last_id:
                         last_id = row[ID]
@@ -269,7 +296,7 @@ class TailLog(mysql):
                 if rows == 0:
                     if not options.follow:
                         break
-                    if options.realtime:
+                    if options.realtime and not replay:
                         # If we're doing realtime logs, start monitoring the event bus from now on.
                         # We might get a few duplicates, but not too many.
                         self._follow_realtime(options)
@@ -83,8 +83,8 @@ class CSVExporter:
         if words and not self._parameters:
             found = -1
             for word in words:
-                found = max(found, name.find(_word))
-                found = max(found, channel.find(_word))
+                found = max(found, name.find(word))
+                found = max(found, channel.find(word))
             if found == -1:
                 return
 
@@ -117,6 +117,12 @@ class TailStatus(mysql):
 
         self.filters = []
         self.default_show = default_show
+        self._names = {}
+        self._names2d = {}
+
+        # Polling interval when following, grows while there is nothing new
+        self.min_idle = 0.1
+        self.max_idle = 2.0
 
     def add_filter(self, filter):
         """
@@ -188,7 +194,30 @@ class TailStatus(mysql):
             if row:
                 return row
         return None, None
-    
+
+    def get_last_values(self, allow_none=False):
+        """
+        Snapshot of the last value of every parameter in a single query,
+        returns a list of (channel, name, value, timestamp). With
+        allow_none, parameters without values (and 2D parameters) are
+        included with value and timestamp None.
+        """
+        if allow_none:
+            join = "LEFT JOIN"
+        else:
+            join = "JOIN"
+        SQL = "SELECT status_channel.name, status_parameter.name, status.value, status.timestamp " +\
+              "FROM status_parameter JOIN status_channel ON status_parameter.chanid=status_channel.chanid " +\
+              join + " (SELECT paramid, MAX(id) AS id FROM status GROUP BY paramid) AS last " +\
+              "ON last.paramid=status_parameter.paramid " +\
+              join + " status ON status.id=last.id"
+        cursor = self._execute(SQL)
+        ret = list(cursor.fetchall())
+        if allow_none:
+            cursor = self._execute("SELECT status_channel.name, status_parameter2d.name, NULL, NULL FROM status_parameter2d, status_channel WHERE status_parameter2d.chanid=status_channel.chanid")
+            ret.extend(cursor.fetchall())
+        return ret
+
     def create_pc_index(self):
         cursor = self._execute("select count(1) from INFORMATION_SCHEMA.STATISTICS where table_schema=DATABASE() AND table_name='status' AND index_name='pc_index'")
         row = cursor.fetchone()
@@ -237,21 +266,20 @@ class TailStatus(mysql):
         else:
             last_id_2d = 0
 
-        params = []
         raw_params = []
         for p in options.parameters:
             if p.find(":") == -1:
                 raise Exception("Bad parameter specification '%s', must be channel:paramname" % p)
             chan, param = p.split(":", 1)
             raw_params.append( (chan, param) )
-            paramid = self.get_param_id(chan, param)
-            params.append(paramid)
-        if len(options.parameters) == 0:
-            additional = ""
-            additional2d = ""
-        else:
-            additional = " AND (" + ("status.paramid=%s OR " * len(options.parameters))[:-4] + ")"
-            additional2d = " AND (" + ("status2d.paramid=%s OR " * len(options.parameters))[:-4] + ")"
+
+        # Channel and parameter filters are done by the database
+        self._load_names()
+        additional, params = self._get_sql_filter(self._names, options)
+        additional2d, params2d = self._get_sql_filter(self._names2d, options)
+        filtered = options.channel or options.parameters
+        if filtered:
+            param_marks = self._get_param_marks()
 
         if options.timeseries:
 
@@ -271,6 +299,9 @@ class TailStatus(mysql):
                         if param.find(word) > -1:
                             options.parameters.append(param)
 
+            if not options.follow:
+                self._export_timeseries(options)
+                return
             exporter = CSVExporter(options.timeseries, options.parameters, options)
         else:
             exporter = None
@@ -278,11 +309,12 @@ class TailStatus(mysql):
         start_id = last_id
         start_id_2d = last_id_2d
         last_pos = 0
+        idle_time = self.min_idle
         while True:
             try:
-                def process_results(c, max_id, is2D=None):
+                def process_results(rows, max_id, is2D=None):
                     r = 0
-                    for row in c.fetchall():
+                    for row in rows:
                         r += 1
                         if row[ID] > max_id:
                             max_id = row[ID]
@@ -317,26 +349,30 @@ class TailStatus(mysql):
                         last_id_2d = start_id_2d
                     last_pos = self.clock.pos()
                     t = "AND timestamp<%f " % last_pos
-                SQL = "SELECT id,timestamp,status_parameter2d.name,status_channel.name,value,sizex,sizey,posx,posy "\
-                      "FROM status2d,status_parameter2d,status_channel "\
-                      "WHERE status2d.chanid=status_channel.chanid " + t + \
-                      "AND status2d.paramid=status_parameter2d.paramid AND id>%s" + additional2d + " ORDER BY id"
-                a = [last_id_2d]
-                a.extend(params)
-                cursor = self._execute(SQL, a)
-                (r, i) = process_results(cursor, last_id_2d, True)
+                bound = bound2d = ""
+                if filtered and options.follow:
+                    # Parameters added since we started might match too. Rows up
+                    # to these ids were added after their parameters.
+                    bound = "AND id<=%d " % (self._execute("SELECT MAX(id) FROM status").fetchone()[0] or 0)
+                    bound2d = "AND id<=%d " % (self._execute("SELECT MAX(id) FROM status2d").fetchone()[0] or 0)
+                    marks = self._get_param_marks()
+                    if marks != param_marks:
+                        param_marks = marks
+                        self._load_names()
+                        additional, params = self._get_sql_filter(self._names, options)
+                        additional2d, params2d = self._get_sql_filter(self._names2d, options)
+                # Only the status tables are queried, names are resolved here
+                SQL = "SELECT id,timestamp,paramid,value,posx,posy FROM status2d "\
+                      "WHERE id>%s " + t + bound2d + additional2d + " ORDER BY id"
+                # Read in chunks of ids, a full export would otherwise need all rows in memory
+                (r, i) = process_results(self._resolve_rows(self._iterate_by_id(SQL, params2d, last_id_2d), True),
+                                         last_id_2d, True)
                 rows += r
                 last_id_2d = i
 
-                SQL = "SELECT id,timestamp,status_parameter.name,status_channel.name,value "\
-                      "FROM status,status_parameter,status_channel "\
-                      "WHERE status.chanid=status_channel.chanid " + t + \
-                      "AND status.paramid=status_parameter.paramid AND "\
-                      "id>%s" + additional + " ORDER BY id"
-                a = [last_id]
-                a.extend(params)
-                cursor = self._execute(SQL, a)
-                (r, i) = process_results(cursor, last_id)
+                SQL = "SELECT id,timestamp,paramid,value FROM status "\
+                      "WHERE id>%s " + t + bound + additional + " ORDER BY id"
+                (r, i) = process_results(self._resolve_rows(self._iterate_by_id(SQL, params, last_id)), last_id)
                 rows += r
                 last_id = i
 
@@ -346,8 +382,11 @@ class TailStatus(mysql):
                 if rows == 0:
                     if options.realtime:
                         self._follow_realtime(options, raw_params)
-                    # No new activity, wait a bit before we try again
-                    time.sleep(1)
+                    # No new activity, wait a bit longer each time before we try again
+                    time.sleep(idle_time)
+                    idle_time = min(idle_time * 2, self.max_idle)
+                else:
+                    idle_time = self.min_idle
             except Exception:
                 import traceback
                 traceback.print_exc()
@@ -355,6 +394,108 @@ class TailStatus(mysql):
             finally:
                 pass
 
+    def _export_timeseries(self, options):
+        """
+        Export a time range (--since to --until) to CSV without following
+        """
+        from CryoCore.Core.Status.TimeSeriesExport import TimeSeriesExporter
+        start = end = None
+        if options.since:
+            start = float(options.since)
+            if start < 0:
+                start += time.time()
+        if options.until:
+            end = float(options.until)
+            if end < 0:
+                end += time.time()
+        elif start is not None:
+            end = time.time()
+        if options.rate and start is None:
+            raise Exception("Resampling needs --since")
+        exporter = TimeSeriesExporter(options.parameters)
+        rows = exporter.export(options.timeseries, start, end, rate=options.rate, method=options.method,
+                               fill=options.fill, chunks=options.chunks, num_workers=options.workers)
+        print("Exported %d rows to %s" % (rows, options.timeseries))
+
+    def _load_names(self):
+        """
+        Load the paramid -> (channel, name) maps
+        """
+        self._names = {}
+        SQL = "SELECT paramid, status_channel.name, status_parameter.name FROM status_parameter, status_channel "\
+              "WHERE status_parameter.chanid=status_channel.chanid"
+        for paramid, channel, name in self._execute(SQL).fetchall():
+            self._names[paramid] = (channel, name)
+        self._names2d = {}
+        SQL = "SELECT paramid, status_channel.name, status_parameter2d.name, sizex, sizey FROM status_parameter2d, status_channel "\
+              "WHERE status_parameter2d.chanid=status_channel.chanid"
+        for paramid, channel, name, sizex, sizey in self._execute(SQL).fetchall():
+            self._names2d[paramid] = (channel, name, sizex, sizey)
+
+    def _get_param_marks(self):
+        """
+        The highest parameter ids, they change when parameters are added
+        """
+        return (self._execute("SELECT MAX(paramid) FROM status_parameter").fetchone()[0],
+                self._execute("SELECT MAX(paramid) FROM status_parameter2d").fetchone()[0])
+
+    def _matches(self, options, channel, name):
+        """
+        Check a parameter against the channel and parameter options
+        """
+        if options.channel and channel != options.channel:
+            return False
+        if not options.parameters:
+            return True
+        if not hasattr(self, "_param_filters"):
+            self._param_filters = []
+            for r in options.parameters:
+                if r.startswith(":"):
+                    r = ".*" + r
+                self._param_filters.append(re.compile(r))
+        l = ":".join([channel, name])
+        for r in self._param_filters:
+            if r.match(l):
+                return True
+        return False
+
+    def _get_sql_filter(self, names, options):
+        """
+        Return (SQL, args) selecting the parameters matching the channel and
+        parameter options, parameters are regular expressions on "channel:name"
+        """
+        if not options.channel and not options.parameters:
+            return "", []
+        paramids = []
+        for paramid, info in names.items():
+            if self._matches(options, info[0], info[1]):
+                paramids.append(paramid)
+        if len(paramids) == 0:
+            return " AND FALSE", []
+        return " AND paramid IN (" + ",".join(["%s"] * len(paramids)) + ")", paramids
+
+    def _resolve_rows(self, rows, is2D=False):
+        """
+        Turn rows from the status tables into printable rows
+        """
+        for row in rows:
+            if is2D:
+                id, ts, paramid, value, posx, posy = row
+                if paramid not in self._names2d:
+                    self._load_names()  # New parameter
+                    if paramid not in self._names2d:
+                        self._names2d[paramid] = ("?", str(paramid), None, None)
+                channel, name, sizex, sizey = self._names2d[paramid]
+                yield (id, ts, name, channel, value, sizex, sizey, posx, posy)
+            else:
+                id, ts, paramid, value = row
+                if paramid not in self._names:
+                    self._load_names()
+                    if paramid not in self._names:
+                        self._names[paramid] = ("?", str(paramid))
+                channel, name = self._names[paramid]
+                yield (id, ts, name, channel, value)
+
     def _follow_realtime(self, options, raw_params):
         import traceback
         import json
@@ -382,6 +523,8 @@ class TailStatus(mysql):
                     for item in data:
                         try:
                             d = json.loads(item.decode("utf-8"))
+                            if not self._matches(options, d["channel"], d["name"]):
+                                continue
                             row = [ -1, d["ts"], d["name"], d["channel"], d["value"] ]
                             do_print = True
                             if len(self.filters) > 0:
@@ -574,6 +717,16 @@ if __name__ == "__main__":
         parser.add_argument("--fill", action="store_true",
                             help="When exporting timeseries, the last value from all listed instruments is used "
                                  "whenever a value is flushed. If not given, non-aligning items are left empty")
+        parser.add_argument("--until", dest="until",
+                            help="Export up to a given time - negative is regarded as relative from now")
+        parser.add_argument("--rate", dest="rate", type=float, default=None,
+                            help="Resample the time series to this many rows per second")
+        parser.add_argument("--method", dest="method", default="ffill", choices=["ffill", "interpolate"],
+                            help="How to resample: last value (ffill) or linear interpolation")
+        parser.add_argument("--chunks", dest="chunks", type=int, default=1,
+                            help="Split the exported time range in this many chunks, exported in parallel")
+        parser.add_argument("--workers", dest="workers", type=int, default=4,
+                            help="Number of parallel workers when exporting chunks")
         
         parser.add_argument("-r", "--realtime", action="store_true", default=True, help="Dump realtime status from shared memory")
 
@@ -634,34 +787,6 @@ if __name__ == "__main__":
             tail.print_last(sys.argv[1])
             raise SystemExit()
 
-        if options.channel:
-            def filter_channel(row):
-                if row[CHANNEL] == options.channel:
-                    return True
-                return False
-            tail.add_filter(filter_channel)
-
-        if options.parameters:
-            opts = []
-            for r in options.parameters:
-                if r.startswith(":"):
-                    r = ".*" + r
-                opts.append(re.compile(r))
-            options.filters = opts
-
-            def filter_params(row):
-                l = ":".join([row[CHANNEL], row[NAME]])
-                match = False
-                for r in options.filters:
-                    if r.match(l):
-                        match = True
-                        break
-
-                    #return r.match(l) is not None
-                return match
-
-            tail.add_filter(filter_params)
-
         tail.print_status(options)
 
     finally:
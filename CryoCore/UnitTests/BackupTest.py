@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from CryoCore.Core import API, Backup
+from CryoCore.UnitTests.FakeDB import FakeDB
+
+
+class BackupTest(unittest.TestCase):
+    """
+    Unit tests for incremental database dumps
+    """
+
+    def setUp(self):
+        # Log locally, there is no database
+        patcher = mock.patch.object(API, "get_log", logging.getLogger)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.mkdtemp()
+        self.db = FakeDB({"SHOW CREATE TABLE": [("log", "CREATE TABLE log (id INTEGER PRIMARY KEY, message TEXT)")],
+                          "SET SESSION": [],
+                          "START TRANSACTION": []})
+        self.db._execute("CREATE TABLE log (id INTEGER PRIMARY KEY, message TEXT)")
+        self.dumper = Backup.DatabaseDumper(self.db, os.path.join(self.directory, "dump"),
+                                            batch_size=10, stop_event=threading.Event(), settle_time=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add(self, first, last):
+        for i in range(first, last + 1):
+            self.db._execute("INSERT INTO log (id, message) VALUES (%s, %s)", [i, "message %d" % i])
+
+    def testIncremental(self):
+        self.add(1, 25)
+        self.assertEqual(self.dumper.dump(["log"]), 25)
+        self.assertEqual(self.dumper.get_manifest()["high_water"]["log"], 25)
+        # Each batch is read in its own snapshot
+        self.assertEqual(len(self.db.executed("START TRANSACTION WITH CONSISTENT SNAPSHOT")), 3)
+        self.assertEqual(sorted([s[1] for s in self.db.executed("SELECT * FROM `log` WHERE id>%s AND id<=%s")]),
+                         [(0, 10), (10, 20), (20, 25)])
+
+        # Only new rows are dumped
+        self.assertEqual(self.dumper.dump(["log"]), 0)
+        self.add(26, 30)
+        self.assertEqual(self.dumper.dump(["log"]), 5)
+        files = [f["file"] for run in self.dumper.get_manifest()["runs"] for f in run["files"]]
+        self.assertEqual(files, ["log.1-10.json.gz", "log.11-20.json.gz", "log.21-25.json.gz",
+                                 "log.26-30.json.gz"])
+
+        # A full dump starts over
+        self.assertEqual(self.dumper.dump(["log"], full=True), 30)
+
+    def testTruncated(self):
+        self.add(1, 25)
+        self.dumper.dump(["log"])
+        self.db._execute("DELETE FROM log")
+        self.add(1, 5)
+
+        # The ids started over, dump them again without overwriting the old files
+        self.assertEqual(self.dumper.dump(["log"]), 5)
+        manifest = self.dumper.get_manifest()
+        self.assertEqual(manifest["high_water"]["log"], 5)
+        self.assertEqual(manifest["epoch"]["log"], 1)
+        self.assertEqual(manifest["runs"][-1]["files"][0]["file"], "log.reset1.1-5.json.gz")
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "dump", "log.1-10.json.gz")))
+
+        self.add(6, 8)
+        self.assertEqual(self.dumper.dump(["log"]), 3)
+        self.assertEqual(self.dumper.get_manifest()["epoch"]["log"], 1)
+
+    def testSettle(self):
+        self.add(1, 10)
+        # Rows committed while settling have lower ids than the mark
+        with mock.patch.object(self.dumper.stop_event, "wait", side_effect=lambda timeout: self.add(11, 12)):
+            self.assertEqual(self.dumper.dump(["log"]), 10)
+        self.assertEqual(self.dumper.get_manifest()["high_water"]["log"], 10)
+        self.assertEqual(self.dumper.dump(["log"]), 2)
+
+    def testRestoreOnce(self):
+        self.add(1, 25)
+        self.dumper.dump(["log"])
+        self.add(26, 30)
+        self.dumper.dump(["log"])
+        self.dumper.dump(["log"], full=True)
+        self.add(31, 35)
+        self.dumper.dump(["log"])
+
+        restored = []
+        with mock.patch.object(self.dumper, "_restore_job", side_effect=lambda f: restored.append(f["file"]) or 0):
+            self.dumper.restore(["log"])
+        self.assertEqual(sorted(restored), ["log.1-10.json.gz", "log.11-20.json.gz", "log.21-30.json.gz",
+                                            "log.31-35.json.gz"])
+
+    def testValues(self):
+        for value in [None, 1, 1.5, "text", b"\x00\xff"]:
+            self.assertEqual(Backup.decode_value(json.loads(json.dumps(Backup.encode_value(value)))), value)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+import numpy
+
+from CryoCore.GUI.Web import BinaryData
+
+
+class BinaryDataTest(unittest.TestCase):
+    """
+    Unit tests for the binary plot data encoding
+    """
+
+    def testRoundTrip(self):
+        ts = numpy.arange(100, dtype=float) + 1500000000.0
+        dataset = {"1": (ts, numpy.sin(ts)),
+                   "2": [(1.0, 10), (2.0, 20.5)],
+                   "3": []}
+        header, decoded = BinaryData.decode(BinaryData.encode({"max_id": 42}, dataset))
+        self.assertEqual(header["max_id"], 42)
+        self.assertEqual(header["data"], {})
+        self.assertTrue(numpy.array_equal(decoded["1"][0], ts))
+        self.assertTrue(numpy.array_equal(decoded["1"][1], numpy.sin(ts)))
+        self.assertEqual(list(decoded["2"][0]), [1.0, 2.0])
+        self.assertEqual(list(decoded["2"][1]), [10.0, 20.5])
+        self.assertEqual(len(decoded["3"][0]), 0)
+
+    def testAligned(self):
+        for name in ["a", "ab", "abc", "abcd"]:
+            data = BinaryData.encode({"name": name}, {"1": [(1.0, 2.0)]})
+            length = BinaryData._LENGTH.unpack_from(data, 0)[0]
+            self.assertEqual((BinaryData._LENGTH.size + length) % 8, 0)
+            self.assertEqual(len(data) % 8, 0)
+
+    def testNotNumeric(self):
+        dataset = {"text": [(1.0, "on"), (2.0, "off")],
+                   "2d": [(1.0, [1, 2]), (2.0, [3, 4])],
+                   "2d numpy": (numpy.array([1.0, 2.0]), numpy.array([[1, 2], [3, 4]]))}
+        header, decoded = BinaryData.decode(BinaryData.encode({}, dataset))
+        self.assertEqual(decoded, {})
+        self.assertEqual(header["data"]["text"], [[1.0, "on"], [2.0, "off"]])
+        self.assertEqual(header["data"]["2d"], [[1.0, [1, 2]], [2.0, [3, 4]]])
+        self.assertEqual(header["data"]["2d numpy"], [[1.0, [1, 2]], [2.0, [3, 4]]])
+
+
+if __name__ == "__main__":
+    unittest.main()
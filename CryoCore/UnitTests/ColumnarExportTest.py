@@ -0,0 +1,87 @@
+import logging
+import shutil
+import tempfile
+import threading
+import unittest
+
+from CryoCore.Core.Status import ColumnarExport
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+class ColumnarExportTest(unittest.TestCase):
+    """
+    Unit tests for the resumable columnar status export
+    """
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.destination)
+        self.max_id = 1000
+        self.fail = set()
+
+    def make_exporter(self):
+        exporter = ColumnarExport.StatusExporter.__new__(ColumnarExport.StatusExporter)
+        exporter.log = logging.getLogger("ColumnarExportTest")
+        exporter.destination = self.destination
+        exporter.partition_size = 3600
+        exporter.batch_size = 100
+        exporter.num_workers = 1
+        exporter.channels = None
+        exporter._lock = threading.Lock()
+        exporter._params = {}
+        exporter._skipped = set()
+        exporter._done = {}
+        exporter._execute = self._execute
+        exporter._iterate = self._iterate
+        return exporter
+
+    def _execute(self, SQL, args=None):
+        if SQL.startswith("SELECT MAX(id)"):
+            return FakeCursor([(self.max_id, )])
+        return FakeCursor([(1, "value", "Channel")])
+
+    def _iterate(self, SQL, args):
+        first_id, last_id = args
+        if first_id in self.fail:
+            raise Exception("Failed")
+        for i in range(first_id + 1, last_id + 1):
+            yield (1, float(i), i)
+
+    def read(self):
+        reader = ColumnarExport.OfflineStatusReader(self.destination)
+        ts, values = reader.get_columns([("Channel", "value")])[("Channel", "value")]
+        return list(ts)
+
+    def testResume(self):
+        exporter = self.make_exporter()
+        self.max_id = 950
+        self.assertEqual(exporter.export(), 950)
+        self.assertEqual(exporter.get_state()["last_id"], 950)
+
+        # A batch fails, but a later one is written
+        self.fail.add(950)
+        self.max_id = 1205
+        exporter.num_workers = 3
+        self.assertRaises(Exception, exporter.export)
+        self.assertEqual(exporter.get_state()["last_id"], 950)
+
+        # Boundaries don't depend on where we resumed, nothing is read twice
+        self.fail = set()
+        self.max_id = 1210
+        exporter.export()
+        self.assertEqual(exporter.get_state()["last_id"], 1210)
+        self.assertEqual(self.read(), [float(i) for i in range(1, 1211)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+import unittest
+
+from CryoCore.Core import CommunicationQueue as CQ
+from CryoCore.Core import Queue
+
+
+class CommunicationQueueTest(unittest.TestCase):
+    """
+    Unit tests for the multi-priority communication queue
+    """
+
+    def setUp(self):
+        self.q = CQ.CommunicationQueue(logging.getLogger("CommunicationQueueTest"))
+
+    def drain(self, num):
+        return [self.q.getMessage() for i in range(num)]
+
+    def testPriority(self):
+        self.q.postMessage(CQ.PRIO_LOW, b"low")
+        self.q.postMessage(CQ.PRIO_HIGH, b"high")
+        self.assertEqual(self.q.getMessage(CQ.PRIO_LOW), b"low")
+        self.assertEqual(self.q.getMessage(CQ.PRIO_LOW), None)
+        self.assertEqual(self.q.getMessage(), b"high")
+        self.assertEqual(self.q.getMessage(), None)
+
+    def testWeights(self):
+        # All priorities busy, messages of one quantum each
+        q = CQ.CommunicationQueue(logging.getLogger("CommunicationQueueTest"), sizeof=lambda m: len(m[1]))
+        for priority in CQ.Priorities:
+            for i in range(200):
+                q.postMessage(priority, (priority, b"x" * 8192))
+
+        counts = dict([(p, 0) for p in CQ.Priorities])
+        for i in range(150):
+            priority, m = q.getMessage()
+            counts[priority] += 1
+        # Shares follow the 8:4:2:1 weights
+        self.assertEqual(counts, {CQ.PRIO_HIGH: 80, CQ.PRIO_MED: 40, CQ.PRIO_LOW: 20, CQ.PRIO_BULKDATA: 10})
+
+    def testNoStarvation(self):
+        for i in range(1000):
+            self.q.postMessage(CQ.PRIO_HIGH, b"h" * 100)
+        self.q.postMessage(CQ.PRIO_BULKDATA, b"b" * 100)
+        self.assertTrue(b"b" * 100 in self.drain(1000))
+
+    def testNoSavedCredit(self):
+        # An idle priority doesn't save up credit for later
+        self.q.postMessage(CQ.PRIO_BULKDATA, b"b")
+        self.assertEqual(self.q.getMessage(), b"b")
+        for i in range(100):
+            self.q.postMessage(CQ.PRIO_BULKDATA, b"b" * 1000)
+            self.q.postMessage(CQ.PRIO_HIGH, b"h" * 1000)
+        first = self.drain(80)
+        self.assertTrue(first.count(b"h" * 1000) > first.count(b"b" * 1000))
+
+    def testFull(self):
+        q = CQ.CommunicationQueue(logging.getLogger("CommunicationQueueTest"), max_messages=2)
+        q.postMessage(CQ.PRIO_LOW, b"1")
+        q.postMessage(CQ.PRIO_LOW, b"2")
+        self.assertRaises(Queue.Full, q.postMessage, CQ.PRIO_LOW, b"3", timeout=0.1)
+        # Other priorities have their own room
+        q.postMessage(CQ.PRIO_HIGH, b"4", timeout=0.1)
+
+        threading.Timer(0.1, q.getMessage, [CQ.PRIO_LOW]).start()
+        q.postMessage(CQ.PRIO_LOW, b"3", timeout=2.0)
+        self.assertEqual(q.qsize(CQ.PRIO_LOW), 2)
+
+    def testWait(self):
+        threading.Timer(0.1, self.q.postMessage, [CQ.PRIO_MED, b"m"]).start()
+        t = time.time()
+        self.assertEqual(self.q.getMessage(timeout=2.0), b"m")
+        self.assertTrue(time.time() - t < 1.0)
+        self.assertEqual(self.q.getMessage(timeout=0.1), None)
+
+    def testStats(self):
+        self.q.postMessage(CQ.PRIO_MED, b"12345")
+        stats = self.q.get_stats()
+        self.assertEqual(stats["medium"]["depth"], 1)
+        self.assertEqual(stats["medium"]["bytes"], 5)
+        self.q.getMessage()
+        stats = self.q.get_stats()
+        self.assertEqual(stats["medium"]["delivered"], 1)
+        self.assertEqual(stats["medium"]["bytes"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+import numpy
+
+from CryoCore.Core.Status import Downsample
+
+
+class DownsampleTest(unittest.TestCase):
+    """
+    Unit tests for downsampling status series
+    """
+
+    def setUp(self):
+        self.ts = numpy.arange(10000, dtype=float)
+        self.values = numpy.sin(self.ts / 100.0)
+        self.values[5555] = 10.0  # A spike
+
+    def testFits(self):
+        for method in Downsample.METHODS:
+            ts, values = Downsample.downsample(self.ts[:50], self.values[:50], 100, method)
+            self.assertEqual(len(ts), 50)
+        ts, values = Downsample.downsample(self.ts, self.values, None)
+        self.assertEqual(len(ts), 10000)
+        self.assertRaises(Exception, Downsample.downsample, self.ts, self.values, 100, "bad")
+
+    def testLTTB(self):
+        ts, values = Downsample.downsample(self.ts, self.values, 500, "lttb")
+        self.assertEqual(len(ts), 500)
+        self.assertEqual(ts[0], 0)
+        self.assertEqual(ts[-1], 9999)
+        self.assertTrue(numpy.all(numpy.diff(ts) > 0))
+        self.assertTrue(5555 in ts)
+        self.assertTrue(numpy.array_equal(values, self.values[ts.astype(numpy.int64)]))
+
+    def testMinMax(self):
+        ts, values = Downsample.downsample(self.ts, self.values, 500, "minmax")
+        self.assertTrue(len(ts) <= 500)
+        self.assertTrue(numpy.all(numpy.diff(ts) > 0))
+        self.assertEqual(values.max(), 10.0)
+        self.assertEqual(values.min(), self.values.min())
+
+    def testText(self):
+        values = numpy.array(["v%d" % i for i in range(1000)], dtype=object)
+        ts, values = Downsample.downsample(self.ts[:1000], values, 10)
+        self.assertEqual(len(ts), 10)
+        self.assertEqual(values[0], "v0")
+        self.assertEqual(values[-1], "v999")
+
+
+if __name__ == "__main__":
+    unittest.main()
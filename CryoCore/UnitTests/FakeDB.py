@@ -0,0 +1,130 @@
+"""
+A stand-in for InternalDB.mysql and its connections in unit tests, so
+they don't need a MySQL server.
+
+Every statement is recorded in FakeDB.statements as (SQL, args).
+Statements matching a prefix in FakeDB.answers get that answer, anything
+else is run on an in-memory sqlite database - only plain SQL that MySQL
+and sqlite share. MySQL specific statements (ON DUPLICATE KEY UPDATE,
+FOR UPDATE, SHOW ..., TRUNCATE) must be answered, and the tests check
+the statements that were sent rather than emulating them. Transactions
+are not emulated either, every statement is committed.
+
+An answer is a list of rows, a Result, an exception to raise, or a
+function (SQL, args) returning one of those.
+"""
+import sqlite3
+import threading
+
+
+class Result:
+    def __init__(self, rows=None, columns=None, rowcount=0):
+        self.rows = rows or []
+        self.columns = columns
+        self.rowcount = rowcount
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+        self.description = None
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def execute(self, SQL, args=()):
+        args = tuple(args or ())
+        with self.db.lock:
+            self.db.statements.append((SQL, args))
+            answer = self.db._answer(SQL, args)
+            if answer is None:
+                cursor = self.db.conn.execute(SQL.replace("%s", "?"), args)
+                self.rows = cursor.fetchall()
+                self.description = cursor.description
+                self.rowcount = cursor.rowcount
+                self.lastrowid = cursor.lastrowid
+            else:
+                self.rows = list(answer.rows)
+                self.description = [(c, ) for c in answer.columns] if answer.columns else None
+                self.rowcount = answer.rowcount
+        return self
+
+    def executemany(self, SQL, args):
+        args = [tuple(a) for a in args]
+        with self.db.lock:
+            self.db.statements.append((SQL, args))
+            if self.db._answer(SQL, args) is None:
+                self.rowcount = self.db.conn.executemany(SQL.replace("%s", "?"), args).rowcount
+
+    def fetchone(self):
+        if self.rows:
+            return self.rows.pop(0)
+        return None
+
+    def fetchmany(self, size):
+        rows = self.rows[:size]
+        self.rows = self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows = self.rows
+        self.rows = []
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeDB:
+    """
+    Provides _execute() like InternalDB.mysql, and is its own
+    connection (db._get_connection())
+    """
+
+    def __init__(self, answers=None):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        self.answers = answers or {}
+        self.statements = []
+        self.db = self
+
+    def _answer(self, SQL, args):
+        for prefix, answer in self.answers.items():
+            if SQL.startswith(prefix):
+                if callable(answer):
+                    answer = answer(SQL, args)
+                if isinstance(answer, Exception):
+                    raise answer
+                if not isinstance(answer, Result):
+                    answer = Result(answer)
+                return answer
+        return None
+
+    def _execute(self, SQL, args=None, **kwargs):
+        return self.cursor().execute(SQL, args)
+
+    def executed(self, prefix):
+        """
+        Return [(SQL, args)] of the statements starting with prefix
+        """
+        with self.lock:
+            return [s for s in self.statements if s[0].startswith(prefix)]
+
+    # Connection
+    def _get_connection(self):
+        return self
+
+    def cursor(self, buffered=True):
+        return FakeCursor(self)
+
+    def start_transaction(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
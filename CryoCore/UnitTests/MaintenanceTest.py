@@ -0,0 +1,76 @@
+import threading
+import unittest
+
+from CryoCore.Core.Maintenance import TableCleaner
+from CryoCore.UnitTests.FakeDB import FakeDB, Result
+
+
+class MaintenanceTest(unittest.TestCase):
+    """
+    Unit tests for the TableCleaner
+    """
+
+    def setUp(self):
+        self.db = FakeDB()
+        self.db._execute("CREATE TABLE log (id INTEGER PRIMARY KEY, time DOUBLE)")
+        for i in range(1, 1001):
+            self.db._execute("INSERT INTO log (id, time) VALUES (%s, %s)", [i, i])
+        self.progress = []
+        self.cleaner = TableCleaner(self.db, chunk_size=100, duty_cycle=1.0, stop_event=threading.Event(),
+                                    progress=lambda table, deleted, fraction: self.progress.append((deleted, fraction)))
+
+    def count(self):
+        return self.db._execute("SELECT COUNT(*) FROM log").fetchone()[0]
+
+    def testChunks(self):
+        self.assertEqual(self.cleaner.delete_range("log"), 1000)
+        self.assertEqual(self.count(), 0)
+        self.assertEqual(len(self.db.executed("DELETE")), 10)
+        self.assertEqual(self.progress[-1], (1000, 1.0))
+
+    def testWhere(self):
+        self.assertEqual(self.cleaner.delete_range("log", "id", "time<%s", [250.5]), 250)
+        self.assertEqual(self.count(), 750)
+        self.assertEqual(self.db._execute("SELECT MIN(id) FROM log").fetchone()[0], 251)
+
+        # Nothing left to delete
+        self.assertEqual(self.cleaner.delete_range("log", "id", "time<%s", [250.5]), 0)
+
+    def testResume(self):
+        stop_event = threading.Event()
+        cleaner = TableCleaner(self.db, chunk_size=100, duty_cycle=1.0, stop_event=stop_event,
+                               progress=lambda table, deleted, fraction: stop_event.set())
+        self.assertEqual(cleaner.delete_range("log"), 100)
+        self.assertEqual(self.cleaner.delete_range("log"), 900)
+        self.assertEqual(self.count(), 0)
+
+    def testTruncate(self):
+        db = FakeDB({"SELECT AUTO_INCREMENT": [(990, )],
+                     "SELECT COUNT(*) FROM INFORMATION_SCHEMA": [(0, )],
+                     "TRUNCATE": [],
+                     "ALTER TABLE": []})
+        db._execute("CREATE TABLE log (id INTEGER PRIMARY KEY, time DOUBLE)")
+        db._execute("INSERT INTO log (id, time) VALUES (1000, 1000)")
+        cleaner = TableCleaner(db, stop_event=threading.Event())
+
+        # Only when asked for
+        db.answers["SELECT MIN"] = [(None, None)]
+        self.assertEqual(cleaner.clear("log"), 0)
+        self.assertFalse(db.executed("TRUNCATE"))
+
+        self.assertEqual(cleaner.clear("log", truncate=True), None)
+        self.assertEqual([s[0] for s in db.statements[-2:]],
+                         ["TRUNCATE TABLE log", "ALTER TABLE log AUTO_INCREMENT=1001"])
+
+    def testReplicationLag(self):
+        replica = FakeDB({"SHOW REPLICA STATUS": Exception("You have an error in your SQL syntax"),
+                          "SHOW SLAVE STATUS": Result([(12, )], ["Seconds_Behind_Master"])})
+        cleaner = TableCleaner(self.db, replica=replica, stop_event=threading.Event())
+        self.assertEqual(cleaner.replication_lag(), 12)
+
+        replica.answers["SHOW REPLICA STATUS"] = Result([(3, )], ["Seconds_Behind_Source"])
+        self.assertEqual(cleaner.replication_lag(), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
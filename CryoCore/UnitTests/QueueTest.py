@@ -0,0 +1,120 @@
+import unittest
+import threading
+import time
+
+from CryoCore.Core import Queue
+
+
+class QueueTest(unittest.TestCase):
+    """
+    Unit tests for the Queue class
+    """
+
+    def testOrder(self):
+        q = Queue.Queue()
+        for i in range(10):
+            q.put(i)
+        self.assertEqual(q.qsize(), 10)
+        self.assertEqual([q.get() for i in range(10)], list(range(10)))
+        self.assertTrue(q.empty())
+        self.assertRaises(Queue.Empty, q.get, block=False)
+
+    def testFull(self):
+        q = Queue.Queue(maxsize=2)
+        q.put(1)
+        q.put(2)
+        self.assertTrue(q.full())
+        self.assertRaises(Queue.Full, q.put, 3, block=False)
+        t = time.time()
+        self.assertRaises(Queue.Full, q.put, 3, timeout=0.2)
+        self.assertTrue(time.time() - t >= 0.2)
+
+        # A blocked producer continues when there is room
+        threading.Timer(0.1, q.get).start()
+        q.put(3, timeout=2.0)
+        self.assertEqual([q.get(), q.get()], [2, 3])
+
+    def testTimeout(self):
+        q = Queue.Queue()
+        t = time.time()
+        self.assertRaises(Queue.Empty, q.get, timeout=0.2)
+        self.assertTrue(time.time() - t >= 0.2)
+        threading.Timer(0.1, q.put, ["x"]).start()
+        self.assertEqual(q.get(timeout=2.0), "x")
+
+    def testContent(self):
+        q = Queue.Queue()
+        for i in range(10):
+            q.put(i)
+        self.assertEqual(q.get_on_content(func=lambda x: x == 5), 5)
+        self.assertRaises(Queue.NoMatch, q.get_on_content, block=False, func=lambda x: x == 5)
+        self.assertEqual(q.qsize(), 9)
+        self.assertEqual([q.get() for i in range(9)], [0, 1, 2, 3, 4, 6, 7, 8, 9])
+
+        # Wait for a matching item while others arrive
+        def produce():
+            for i in range(20):
+                q.put(i)
+                time.sleep(0.005)
+        threading.Thread(target=produce).start()
+        self.assertEqual(q.get_on_content(timeout=2.0, func=lambda x: x == 15), 15)
+        self.assertRaises(Queue.Empty, q.get_on_content, timeout=0.1, func=lambda x: x == 100)
+
+    def testKeyed(self):
+        q = Queue.Queue(key=lambda item: item[0])
+        for i in range(5):
+            q.put(("a", i))
+            q.put(("b", i))
+        self.assertEqual(q.get_on_content(key="b"), ("b", 0))
+        self.assertEqual(q.get_on_content(key="b"), ("b", 1))
+        self.assertEqual(q.get(), ("a", 0))
+        self.assertEqual(q.get_on_content(key="a"), ("a", 1))
+        self.assertRaises(Queue.Empty, q.get_on_content, key="c", block=False)
+        self.assertEqual(q.qsize(), 6)
+        self.assertEqual([q.get() for i in range(6)],
+                         [("a", 2), ("b", 2), ("a", 3), ("b", 3), ("a", 4), ("b", 4)])
+
+        # Waiting on a key
+        threading.Timer(0.1, q.put, [("c", 1)]).start()
+        self.assertEqual(q.get_on_content(key="c", timeout=2.0), ("c", 1))
+        self.assertTrue(q.empty())
+
+    def testDeadEntries(self):
+        # The item at the front is never taken, items behind it are
+        q = Queue.Queue(key=lambda item: item[0])
+        q.put(("stuck", 0))
+        for i in range(10000):
+            q.put(("a", i))
+            q.put(("b", i))
+            self.assertEqual(q.get_on_content(key="b"), ("b", i))
+            self.assertEqual(q.get_on_content(func=lambda x: x[0] == "a"), ("a", i))
+        self.assertEqual(q.qsize(), 1)
+        self.assertTrue(len(q.items) < 200)
+        self.assertTrue(len(q._keyed["stuck"]) == 1)
+        self.assertEqual(q.get(), ("stuck", 0))
+        self.assertTrue(q.empty())
+
+        q.put(("a", 1))
+        self.assertEqual(q.get_on_content(key="a"), ("a", 1))
+
+    def testThreads(self):
+        q = Queue.Queue(maxsize=10)
+        received = []
+
+        def consume():
+            for i in range(500):
+                received.append(q.get(timeout=5.0))
+
+        consumers = [threading.Thread(target=consume) for i in range(2)]
+        for c in consumers:
+            c.start()
+        for i in range(1000):
+            q.put(i, timeout=5.0)
+        for c in consumers:
+            c.join()
+        self.assertEqual(sorted(received), list(range(1000)))
+
+
+if __name__ == "__main__":
+    print("Testing Queue")
+    unittest.main()
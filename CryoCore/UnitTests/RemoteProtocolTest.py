@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import threading
+import unittest
+
+from CryoCore.Core.Status import RemoteProtocol, RemoteStatusReporter
+
+
+class FakeHolder:
+    def get_name(self):
+        return "holder"
+
+
+class FakeElement:
+    def __init__(self, name, value, ts=1.0):
+        self.status_holder = FakeHolder()
+        self.name = name
+        self.value = value
+        self.ts = ts
+
+    def get_name(self):
+        return self.name
+
+    def get_value(self):
+        return self.value
+
+    def get_timestamp(self):
+        return self.ts
+
+
+class FakeLoop:
+    def __init__(self):
+        self.calls = []
+
+    def call_soon_threadsafe(self, func, *args):
+        self.calls.append((func, args))
+
+
+class FakeTransport:
+    def __init__(self):
+        self.buffered = 0
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+
+class FakeWriter:
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.data = b""
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class RemoteProtocolTest(unittest.TestCase):
+    """
+    Unit tests for the remote status framing and the reporter's outbound
+    queues
+    """
+
+    def make_reporter(self, **cfg):
+        reporter = RemoteStatusReporter.RemoteStatusReporter.__new__(RemoteStatusReporter.RemoteStatusReporter)
+        reporter.log = logging.getLogger("RemoteProtocolTest")
+        reporter.cfg = {"max_queue": 10000, "max_buffer": 4194304, "send_timeout": 5.0,
+                        "batch_delay": 0, "batch_size": 1000}
+        reporter.cfg.update(cfg)
+        reporter.lock = threading.Lock()
+        reporter.clients = []
+        reporter.loop = FakeLoop()
+        return reporter
+
+    def decode(self, data):
+        return RemoteProtocol.FrameDecoder().feed(data)
+
+    def testSplit(self):
+        messages = [{"updates": [["a.b", 1.0, i]]} for i in range(10)]
+        data = b"".join([RemoteProtocol.encode(m) for m in messages])
+
+        # Whatever way the stream is split, the same messages come out
+        for size in [1, 3, 7, len(data)]:
+            decoder = RemoteProtocol.FrameDecoder()
+            received = []
+            for i in range(0, len(data), size):
+                received.extend(decoder.feed(data[i:i + size]))
+            self.assertEqual(received, messages)
+            self.assertEqual(decoder.pending(), 0)
+
+    def testPartial(self):
+        frame = RemoteProtocol.encode({"list": ["a.b"], "id": 1})
+        decoder = RemoteProtocol.FrameDecoder()
+        self.assertEqual(decoder.feed(frame[:2]), [])
+        self.assertEqual(decoder.feed(frame[2:-1]), [])
+        self.assertEqual(decoder.pending(), len(frame) - 1)
+        self.assertEqual(decoder.feed(frame[-1:] + frame), [{"list": ["a.b"], "id": 1}] * 2)
+
+    def testOversized(self):
+        decoder = RemoteProtocol.FrameDecoder(max_frame_size=100)
+        self.assertEqual(len(decoder.feed(RemoteProtocol.encode("x" * 90))), 1)
+        frame = RemoteProtocol.encode("x" * 200)
+        # Refused as soon as the header is in, not when the frame is complete
+        self.assertRaises(Exception, decoder.feed, frame[:RemoteProtocol.HEADER.size])
+
+    def testCoalesce(self):
+        reporter = self.make_reporter()
+        client = RemoteStatusReporter._Client(("test", 1), FakeWriter())
+        for i in range(5):
+            reporter._send_update(FakeElement("a", i, float(i)), client)
+        reporter._send_update(FakeElement("b", object()), client)
+        # Only the latest value of each element, in the order they were first queued
+        self.assertEqual([v[:2] for v in client.pending.values()], [["holder.a", 4.0], ["holder.b", 1.0]])
+        self.assertEqual(client.pending["holder.a"][2], 4)
+        self.assertTrue(isinstance(client.pending["holder.b"][2], str))
+        # The sender is woken once
+        self.assertEqual(len(reporter.loop.calls), 1)
+
+    def testMaxQueue(self):
+        reporter = self.make_reporter(max_queue=2)
+        client = RemoteStatusReporter._Client(("test", 1), FakeWriter())
+        reporter._send_update(FakeElement("a", 1), client)
+        reporter._send_update(FakeElement("b", 1), client)
+        reporter._send_update(FakeElement("a", 2), client)
+        self.assertEqual(len(reporter.loop.calls), 1)
+
+        reporter._send_update(FakeElement("c", 1), client)
+        func, args = reporter.loop.calls[-1]
+        self.assertEqual(args, (client, "queue full"))
+        func(*args)
+        self.assertTrue(client.closed)
+        self.assertTrue(client.writer.closed)
+
+    def testSender(self):
+        reporter = self.make_reporter(batch_size=2)
+        client = RemoteStatusReporter._Client(("test", 1), FakeWriter())
+        reporter.clients.append(client)
+
+        async def run():
+            sender = asyncio.ensure_future(reporter._sender(client))
+            for i in range(5):
+                reporter._send_update(FakeElement(str(i), i), client)
+            reporter._queue_message(client, {"list": [], "id": 1})
+            client.wakeup.set()
+            while not client.writer.data:
+                await asyncio.sleep(0.01)
+
+            # A client that doesn't read is dropped
+            client.writer.transport.buffered = reporter.cfg["max_buffer"] + 1
+            reporter._send_update(FakeElement("0", 10), client)
+            client.wakeup.set()
+            await asyncio.wait_for(sender, 2.0)
+        asyncio.run(run())
+
+        messages = self.decode(client.writer.data)
+        self.assertEqual(messages[0], {"list": [], "id": 1})
+        self.assertEqual([len(m["updates"]) for m in messages[1:4]], [2, 2, 1])
+        self.assertTrue(client.closed)
+        self.assertEqual(reporter.clients, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+import logging
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+from CryoCore.Core import API
+from CryoCore.Core.Status import RemoteProtocol, RemoteStatus
+
+
+class FakeReporter(threading.Thread):
+    """
+    Accepts connections and records the requests, like a remote status
+    reporter would receive them
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(4)
+        self.address = self.socket.getsockname()
+        self.requests = []
+        self.connections = []
+        self.cond = threading.Condition()
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except OSError:
+                return
+            with self.cond:
+                self.connections.append(conn)
+                self.cond.notify_all()
+            threading.Thread(target=self._read, args=(conn, ), daemon=True).start()
+
+    def _read(self, conn):
+        decoder = RemoteProtocol.FrameDecoder()
+        while True:
+            try:
+                data = conn.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            with self.cond:
+                self.requests.extend(decoder.feed(data))
+                self.cond.notify_all()
+
+    def wait_for(self, what, timeout=5.0):
+        end_by = time.time() + timeout
+        with self.cond:
+            while not what():
+                if time.time() > end_by:
+                    raise Exception("Timed out, got %s" % self.requests)
+                self.cond.wait(0.1)
+
+    def send(self, message):
+        self.connections[-1].sendall(RemoteProtocol.encode(message))
+
+    def commands(self, cmd):
+        with self.cond:
+            return [r["param"] for r in self.requests if r.get("cmd") == cmd]
+
+    def close(self):
+        self.socket.close()
+        for conn in self.connections:
+            conn.close()
+
+
+class FakeHolder:
+    def __init__(self):
+        self.updates = []
+
+    def _deliver(self, name, ts, value):
+        self.updates.append((name, value))
+
+
+class RemoteStatusTest(unittest.TestCase):
+    """
+    Unit tests for the shared connection to remote status reporters
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(API, "get_log", logging.getLogger)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reporter = FakeReporter()
+        self.addCleanup(self.reporter.close)
+        self.holders = []
+
+    def tearDown(self):
+        for holder in self.holders:
+            self.conn.remove_holder(holder)
+
+    def connect(self, num_holders=2):
+        self.holders = [FakeHolder() for i in range(num_holders)]
+        for holder in self.holders:
+            self.conn = RemoteStatus.get_connection(self.reporter.address, holder)
+        self.reporter.wait_for(lambda: self.conn.connected and self.reporter.connections)
+        return self.holders
+
+    def testSubscribe(self):
+        a, b = self.connect()
+        self.conn.subscribe(a, "x.y")
+        self.conn.subscribe(b, "x.y")
+        self.reporter.wait_for(lambda: len(self.reporter.requests) == 2)
+        # The second holder only asks for the current value
+        self.assertEqual([r["type"] for r in self.reporter.requests], ["onchange", "once"])
+
+        self.reporter.send({"updates": [["x.y", 1.0, 42], ["x.z", 1.0, 2]]})
+        self.reporter.wait_for(lambda: a.updates and b.updates)
+        self.assertEqual(a.updates, [("x.y", 42)])
+        self.assertEqual(b.updates, [("x.y", 42)])
+
+    def testUnsubscribe(self):
+        a, b = self.connect()
+        self.conn.subscribe(a, "all")
+        self.conn.subscribe(b, "x.y")
+        self.reporter.send({"updates": [["x.y", 1.0, 1], ["x.z", 1.0, 2]]})
+        self.reporter.wait_for(lambda: len(a.updates) == 2)
+
+        # "all" still covers x.y, nothing is sent
+        self.conn.unsubscribe(b, "x.y")
+        self.conn.subscribe(b, "x.y")
+        # Only x.z is no longer wanted, b still wants x.y
+        self.conn.unsubscribe(a)
+        self.reporter.wait_for(lambda: self.reporter.commands("UNSUBSCRIBE"))
+        self.assertEqual(self.reporter.commands("UNSUBSCRIBE"), ["x.z"])
+
+        self.conn.unsubscribe(b)
+        self.reporter.wait_for(lambda: len(self.reporter.commands("UNSUBSCRIBE")) == 2)
+        self.assertEqual(self.reporter.commands("UNSUBSCRIBE"), ["x.z", "all"])
+
+    def testReconnect(self):
+        a, b = self.connect()
+        self.conn.subscribe(a, "x.y")
+        self.conn.subscribe(b, "x.z", "periodic", 2.0)
+        self.reporter.wait_for(lambda: len(self.reporter.requests) == 2)
+
+        self.reporter.connections[-1].shutdown(socket.SHUT_RDWR)
+        self.reporter.wait_for(lambda: len(self.reporter.connections) == 2 and len(self.reporter.requests) == 4)
+        self.assertEqual(sorted([(r["param"], r["type"]) for r in self.reporter.requests[2:]]),
+                         [("x.y", "onchange"), ("x.z", "periodic")])
+
+    def testHolders(self):
+        a, b = self.connect()
+        conn = self.conn
+        # b has no subscriptions, but still uses the connection
+        self.conn.subscribe(a, "x.y")
+        conn.remove_holder(a)
+        self.assertFalse(conn.stop_event.is_set())
+        conn.remove_holder(b)
+        self.assertTrue(conn.stop_event.is_set())
+        self.holders = []
+
+        holder = RemoteStatus.RemoteStatusHolder.__new__(RemoteStatus.RemoteStatusHolder)
+        holder.stop_event = threading.Event()
+        holder.elements = {}
+        holder._arrival = threading.Condition()
+        holder.conn = conn
+        self.assertRaises(Exception, holder._wait_for, "x.y")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import logging
+import threading
+import unittest
+from unittest import mock
+
+from CryoCore.Core import API
+from CryoCore.Core.Replay import LogReplay
+from CryoCore.UnitTests.FakeDB import FakeDB
+
+
+class FakeClock:
+    def __init__(self, pos):
+        self._pos = pos
+
+    def pos(self):
+        return self._pos
+
+    def vel(self):
+        return 1.0
+
+
+class ReplayTest(unittest.TestCase):
+    """
+    Unit tests for reading log rows ahead of a clock
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(API, "get_log", logging.getLogger)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = FakeDB()
+        self.db.conn.execute("CREATE TABLE log (id INTEGER PRIMARY KEY, message TEXT, time DOUBLE)")
+        # Several rows share a time
+        for i, t in enumerate([1, 2, 2, 2, 3, 3, 4, 5]):
+            self.db.conn.execute("INSERT INTO log VALUES (?, ?, ?)", (i + 1, "m%d" % (i + 1), t))
+        self.clock = FakeClock(2.0)
+        self.replay = LogReplay(self.clock, self.db, "SELECT * FROM log WHERE id>%s AND id<=%s ORDER BY id",
+                                time_index=2, id_step=3, stop_event=threading.Event())
+
+    def read_all(self, pos):
+        while True:
+            items, last_id, ts = self.replay._fetch(self.replay._last_id)
+            self.replay._buffer.extend(items)
+            self.replay._last_id = last_id
+            if ts is None:
+                break
+        return [row[0] for row in self.replay.get(pos)]
+
+    def testFetch(self):
+        self.assertEqual(self.replay._find_id(2.0), 1)
+        self.replay._seek(2.0)
+        items, last_id, ts = self.replay._fetch(1)
+        self.assertEqual([row[0] for t, row in items], [2, 3, 4])
+        self.assertEqual((last_id, ts), (4, 2))
+        self.assertEqual(self.read_all(10.0), [2, 3, 4, 5, 6, 7, 8])
+
+    def testSeekId(self):
+        # Continue after what was already shown, even in the middle of a time
+        self.replay._seek(2.0, 3)
+        self.assertEqual(self.read_all(3.0), [4, 5, 6])
+        self.assertEqual(self.read_all(10.0), [7, 8])
+
+
+if __name__ == "__main__":
+    unittest.main()
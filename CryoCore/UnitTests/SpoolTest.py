@@ -0,0 +1,122 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from CryoCore.Core import InternalDB, Spool
+from CryoCore.Core.Status import MySQLReporter
+
+
+class SpoolTest(unittest.TestCase):
+    """
+    Unit tests for the disk spool
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def replay(self, spool):
+        rows = []
+        for segment, segment_rows in spool.read_segments():
+            rows.extend(segment_rows)
+            spool.remove(segment)
+        return rows
+
+    def testReplay(self):
+        spool = Spool.Spool(self.directory)
+        self.assertTrue(spool.is_empty())
+        for i in range(100):
+            spool.append(["id", i, "value %d" % i])
+        self.assertFalse(spool.is_empty())
+        self.assertEqual(self.replay(spool), [["id", i, "value %d" % i] for i in range(100)])
+        self.assertTrue(spool.is_empty())
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def testRotate(self):
+        spool = Spool.Spool(self.directory, segment_size=1024, max_size=4096)
+        for i in range(1000):
+            spool.append([i, "x" * 50])
+        self.assertTrue(spool.dropped > 0)
+        self.assertTrue(len(spool) <= 4096 + 1024)
+
+        # The newest rows are kept, in order
+        rows = self.replay(spool)
+        self.assertEqual(rows[-1], [999, "x" * 50])
+        self.assertEqual([r[0] for r in rows], list(range(rows[0][0], 1000)))
+
+    def testConsumed(self):
+        spool = Spool.Spool(self.directory)
+        for i in range(10):
+            spool.append([i])
+        for segment, rows in spool.read_segments():
+            spool.consumed(segment, 4)
+        # Appended after the partial replay, must come after the rest
+        spool.append([10])
+        self.assertEqual(self.replay(spool), [[i] for i in range(4, 11)])
+
+    def testLocked(self):
+        spool = Spool.Spool(self.directory)
+        spool.append([1])
+        for segment, rows in spool.read_segments():
+            # Someone else is replaying this segment
+            self.assertEqual(list(spool.read_segments()), [])
+        self.assertEqual(self.replay(spool), [[1]])
+
+    def testCorrupt(self):
+        spool = Spool.Spool(self.directory)
+        spool.append([1])
+        spool.append([2])
+        spool.close()
+        segment = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(segment, "ab") as f:
+            f.write(b"\x00\x00\x00\x10garbage")
+        self.assertEqual(self.replay(spool), [[1], [2]])
+
+    def make_reporter(self, execute):
+        reporter = MySQLReporter.MySQLStatusReporter.__new__(MySQLReporter.MySQLStatusReporter)
+        reporter.log = logging.getLogger("SpoolTest")
+        reporter.cfg = {"spool.max_latency": 5.0}
+        reporter._addLock = threading.Lock()
+        reporter._addTimer = None
+        reporter._spool = Spool.Spool(self.directory)
+        reporter._spool_lock = threading.RLock()
+        reporter._spooling = False
+        reporter._last_replay = 0
+        reporter._execute = execute
+        return reporter
+
+    def testReporterSlow(self):
+        statements = []
+
+        def execute(SQL, args, insist_direct=False, connection=None):
+            statements.append(SQL)
+            raise InternalDB.TooSlowException("Timed out")
+
+        reporter = self.make_reporter(execute)
+        reporter._addList = [[i, 1, 1, "v", None, None] for i in range(1000)]
+        reporter.commit_jobs()
+
+        # Gives up after the first batch, which is still queued, the rest is spooled
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(reporter._spooling)
+        self.assertEqual([r[1] for r in self.replay(reporter._spool)], list(range(150, 1000)))
+
+    def testReporterFailed(self):
+        def execute(SQL, args, insist_direct=False, connection=None):
+            if args[0] >= 300:
+                raise Exception("Gone")
+
+        reporter = self.make_reporter(execute)
+        reporter._addList = [[i, 1, 1, "v", None, None] for i in range(1000)]
+        reporter.commit_jobs()
+        self.assertTrue(reporter._spooling)
+        self.assertEqual([r[1] for r in self.replay(reporter._spool)], list(range(300, 1000)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from CryoCore.Core.Status import StatusListener
+
+
+class StatusListenerTest(unittest.TestCase):
+    """
+    Unit tests for following status updates from the database
+    """
+
+    def testSettle(self):
+        listener = StatusListener.StatusListenerDB.__new__(StatusListener.StatusListenerDB)
+        listener.settle_time = 60
+        listener._seen = []
+        # Nothing is old enough yet, rows below 10 may still be committed
+        self.assertEqual(listener._get_settled(10, 5), 5)
+        self.assertEqual(listener._get_settled(12, 5), 5)
+        listener._seen[0] = (0, 10)
+        self.assertEqual(listener._get_settled(20, 5), 10)
+        # Never moves backwards
+        listener._seen = [(0, 3)]
+        self.assertEqual(listener._get_settled(20, 10), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 import time
 import threading
+from unittest import mock
 
 from CryoCore.Core import Status
 
@@ -395,6 +396,31 @@ class StatusTest(unittest.TestCase):
         time.sleep(0.5)
 
 
+    def test_resume(self):
+        class FakeReader:
+            channel = {"a": (1.0, 1), "b": (1.0, 2)}
+            current = {"a": (5.0, 10), "b": (5.0, 20), "c": (5.0, 30)}
+
+            def get_last_channel_values(self, channel):
+                return dict(self.channel)
+
+            def get_last_status_value(self, channel, name):
+                return self.current[name]
+
+        reader = FakeReader()
+        status = Status.StatusHolder.__new__(Status.StatusHolder)
+        threading.Thread.__init__(status)
+        status.name = "UnitTestResume"
+        status._resume_values = None
+        status._status_lock = threading.RLock()
+        with mock.patch("CryoCore.Core.Status.Status._get_status_reader", return_value=reader):
+            self.assertEqual(status._get_resume_value("a"), (1.0, 1))
+            self.assertEqual(status._get_resume_value("c"), (None, None))
+            # The channel snapshot is stale by now, fetch reads the current value
+            self.assertEqual(status._get_resume_value("b", fetch=True), (5.0, 20))
+            self.assertEqual(status._get_resume_value("c", fetch=True), (5.0, 30))
+
+
 class DummyCb:
     def __init__(self):
         self.clear()
@@ -0,0 +1,144 @@
+import logging
+import socket
+import threading
+import unittest
+
+from CryoCore.Core import sync_ground_db
+from CryoCore.Core.TokenBucket import TokenBucket
+from CryoCore.UnitTests.FakeDB import FakeDB
+
+
+class FakeCounter:
+    def inc(self, value=1):
+        pass
+
+
+class FakeStatus(dict):
+    def __getitem__(self, key):
+        return FakeCounter()
+
+
+class SyncTest(unittest.TestCase):
+    """
+    Unit tests for synchronizing to the ground
+    """
+
+    def setUp(self):
+        # Row inserts on the ground are MySQL specific, they are only recorded
+        self.ground = FakeDB({"SELECT last_id FROM sync_state WHERE tbl=%s FOR UPDATE": self._lock_mark,
+                              "INSERT INTO `log`": []})
+        self.ground._execute("CREATE TABLE sync_state (tbl VARCHAR(128) PRIMARY KEY, last_id BIGINT)")
+        self.receiver = sync_ground_db.GroundReceiver.__new__(sync_ground_db.GroundReceiver)
+        self.receiver.log = logging.getLogger("GroundReceiver")
+
+        self.onboard = FakeDB()
+        self.onboard._execute("CREATE TABLE log (id INTEGER PRIMARY KEY, message TEXT)")
+
+    def _lock_mark(self, SQL, args):
+        return self.ground.conn.execute("SELECT last_id FROM sync_state WHERE tbl=?", args).fetchall()
+
+    def batch(self, first, last, rows, message="message"):
+        return {"batch": 1, "table": "log", "key": "id", "columns": ["id", "message"],
+                "rows": [[i, "%s %d" % (message, i)] for i in rows], "first": first, "last": last}
+
+    def get_inserted(self):
+        """
+        Rows inserted on the ground
+        """
+        rows = []
+        for SQL, args in self.ground.executed("INSERT INTO `log`"):
+            self.assertEqual(SQL, "INSERT INTO `log` (`id`,`message`) VALUES (%s,%s) ON DUPLICATE KEY UPDATE `id`=`id`")
+            rows.extend(args)
+        return rows
+
+    def get_mark(self):
+        return self.ground._execute("SELECT last_id FROM sync_state WHERE tbl='log'").fetchone()[0]
+
+    def testApply(self):
+        self.receiver.apply(self.ground, self.batch(0, 10, range(1, 11)))
+        self.receiver.apply(self.ground, self.batch(10, 20, range(11, 21)))
+        self.assertEqual(self.get_mark(), 20)
+        self.assertEqual([r[0] for r in self.get_inserted()], list(range(1, 21)))
+
+        # Another link sending the same rows only adds the new ones
+        self.receiver.apply(self.ground, self.batch(0, 25, range(1, 26), "other"))
+        self.assertEqual(self.get_mark(), 25)
+        self.assertEqual(self.get_inserted()[20:], [(i, "other %d" % i) for i in range(21, 26)])
+
+        # A batch after a gap is refused
+        self.assertRaises(Exception, self.receiver.apply, self.ground, self.batch(30, 40, range(31, 41)))
+        self.assertEqual(self.get_mark(), 25)
+        self.assertEqual(len(self.get_inserted()), 25)
+
+    def testPriority(self):
+        # Priority values go ahead of the mark, and are sent again later
+        self.receiver.apply(self.ground, self.batch(None, None, [5]))
+        self.assertEqual(self.ground._execute("SELECT * FROM sync_state").fetchall(), [])
+        self.assertFalse(self.ground.executed("SELECT last_id"))
+        self.receiver.apply(self.ground, self.batch(0, 10, range(1, 11)))
+        self.assertEqual([r[0] for r in self.get_inserted()], [5] + list(range(1, 11)))
+
+    def make_sync(self):
+        sync = sync_ground_db.SyncDB.__new__(sync_ground_db.SyncDB)
+        sync.log = logging.getLogger("SyncDB")
+        sync.status = FakeStatus()
+        sync.cfg = {"batch_size": 4, "window": 2, "settle_time": 0, "priority": []}
+        sync.stop_event = threading.Event()
+        sync.db = self.onboard
+        sync.bucket = TokenBucket(1000000, 1000000)
+        sync._marks = {}
+        sync._priority_marks = {}
+        sync._columns = {"log": ["id", "message"]}
+        sync._in_flight = []
+        sync._batch = 0
+        sync._seen = {}
+        sync._reset = set()
+        return sync
+
+    def testSync(self):
+        for i in range(1, 11):
+            self.onboard._execute("INSERT INTO log (id, message) VALUES (%s, %s)", [i, "message %d" % i])
+
+        sync = self.make_sync()
+        sync.sock, ground = socket.socketpair()
+
+        def serve():
+            try:
+                while True:
+                    message = sync_ground_db.read_message(ground)
+                    self.receiver.apply(self.ground, message)
+                    ground.sendall(sync_ground_db.pack({"ack": message["batch"]}))
+            except Exception:
+                pass
+        t = threading.Thread(target=serve)
+        t.start()
+        try:
+            self.assertEqual(sync.send_backlog("log", "id"), 10)
+            while sync._in_flight:
+                sync._wait_ack()
+            self.assertEqual(self.get_inserted(), self.onboard._execute("SELECT * FROM log").fetchall())
+            self.assertEqual(self.get_mark(), 10)
+
+            # The onboard table was truncated, it must be rebased
+            self.onboard._execute("DELETE FROM log")
+            self.onboard._execute("INSERT INTO log (id, message) VALUES (1, 'new')")
+            self.assertEqual(sync.send_backlog("log", "id"), 0)
+            self.assertTrue("log" in sync._reset)
+            self.assertEqual(len(self.get_inserted()), 10)
+        finally:
+            sync.sock.close()
+            ground.close()
+            t.join()
+
+    def testSettle(self):
+        sync = self.make_sync()
+        sync.cfg["settle_time"] = 60
+        sync._marks["log"] = 5
+        # Nothing is old enough yet
+        self.assertEqual(sync._get_settled("log", 10), 5)
+        sync._seen["log"][0] = (0, 10)
+        self.assertEqual(sync._get_settled("log", 20), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()